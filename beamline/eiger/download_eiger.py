@@ -9,12 +9,14 @@ import glob
 import os
 import shutil
 import urllib.request, urllib.parse, urllib.error
+import http.client
+import threading
+import queue
 import subprocess
 import traceback
 import re
 import sys
 from yamtbx.util import safe_copy
-from yamtbx.util import get_temp_local_dir
 
 #eiger_host = "192.168.163.204"
 #default_tmpd = "/dev/shm"
@@ -178,8 +180,8 @@ def check_files(e, prefix, bssid):
         total_bytes = 0
         startt=time.time()
         for f in files:
-            u = urllib.request.urlopen("http://%s/data/%s" % (e._host, f))
-            total_bytes += int(u.info().getheaders("Content-Length")[0])
+            u = urllib.request.urlopen(urllib.request.Request("http://%s/data/%s" % (e._host, f), method="HEAD"))
+            total_bytes += int(u.headers.get("Content-Length"))
             u.close()
 
         print(now(), "On server: %d files %d bytes (%.3f sec)" % (len(files), total_bytes, time.time()-startt))
@@ -229,103 +231,220 @@ def modify_master(tmp, trg, bssid, omega_offset_by_trigger=None):
     p.wait()
 # modify_master()
 
-def download_files(e, files, wdir, bssid, tmpdir=None, omega_offset_by_trigger=None):
-    """
-    If bssid is not None, 'files' contains bssid+prefix_(master.h5|data_*.h5).
-
-    When `tmpdir' is not None, download files to tmpdir once and then copy to destination.
-    Files in tmpdir are kept, and will be used for hit-extraction.
-    """
+hdf5_signature = b"\x89HDF\r\n\x1a\n"
 
-    failed_files = []
+class DownloadError(Exception): pass
+class FatalDownloadError(DownloadError): pass # retry won't help
+class NoSpaceError(FatalDownloadError): pass
 
-    for f in files:
-        src = "http://%s/data/%s" % (e._host, f)
-        #tmpfd, tmp = tempfile.mkstemp(prefix=f, dir=default_tmpd)
-        #os.close(tmpfd)
-        tmp = None
-        if not bssid:
-            trg = os.path.join(wdir, f)
-        else:
-            assert f.startswith(bssid)
-            trg = os.path.join(wdir, f[len(bssid):])
-        
-        dl_failed = False
-        for i in range(10):
-            dl_failed = False
-            print(now(), " donwloading %s (%dth try).." % (f, i+1))
-            startt = time.time()
-            try:
-                u = urllib.request.urlopen(src)
-                file_bytes = u.info().getheaders("Content-Length")[0]
-                u.close()
-
-                print(now(), "  file size on server %s = %s" % (f, file_bytes))
-                tmpd = get_temp_local_dir("eigerdl", min_bytes=int(file_bytes), additional_tmpd=wdir)
-                if tmpd is None:
-                    print(now(), "  ERROR: no space available to download this file!")
-                    dl_failed = True
-                    break
-                print(now(), "  to %s" % tmpd)
-                tmp = os.path.join(tmpd, f)
-                urllib.request.urlretrieve(src, tmp)
-            except:
-                print(traceback.format_exc())
-                dl_failed = True # if success in last trial, dl_failed==False
-                
-
-            eltime = time.time() - startt
+def hdf5_eof_address(head):
+    """
+    End-of-file address written in the HDF5 superblock (at the beginning of the file).
+    The file is truncated if it is shorter than this. Returns None if not known.
+    """
+    if len(head) < 9 or head[:8] != hdf5_signature: return None
+    ver = head[8]
+    if ver in (0, 1):
+        so = head[13]
+        pos = 24 + (4 if ver == 1 else 0) # base address, free-space address, EOF address
+    elif ver in (2, 3):
+        so = head[9]
+        pos = 12 # base address, superblock extension address, EOF address
+    else:
+        return None
 
-            if tmp and os.path.isfile(tmp):
-                print(now(), "  done in %.2f sec. %.3f KB/s" % (eltime, os.path.getsize(tmp)/1024/eltime))
-                break
-            print() 
+    if so not in (2, 4, 8) or len(head) < pos + 3*so: return None
+    base = int.from_bytes(head[pos:pos+so], "little")
+    return base + int.from_bytes(head[pos+2*so:pos+3*so], "little")
+# hdf5_eof_address()
 
-            # retry if downloading failed
-            time.sleep(1)
+def verify_h5(filename, is_master):
+    """Check if h5py can read the file (structure only, not the data)"""
+    with h5py.File(filename, "r") as h:
+        if is_master: list(h["/entry/data"].keys())
+        else: h["/entry/data/data"].shape
+# verify_h5()
 
-        if dl_failed:
-            print(now(), "  Download failed. Keeping on server: %s" % src)
-            failed_files.append(f)
+def fetch_file(conn, f, part, tee_part=None, chunk_bytes=4*1024**2):
+    """
+    Download f from the DCU to part, resuming from the existing part file with HTTP Range.
+    The data is also written to tee_part if given. The HDF5 signature and the EOF address
+    in the superblock are checked when the first bytes arrive, and the file size at the end.
+    """
+    offset = os.path.getsize(part) if os.path.isfile(part) else 0
+    headers = {"Range": "bytes=%d-" % offset} if offset > 0 else {}
+    conn.request("GET", "/data/%s" % urllib.parse.quote(f), headers=headers)
+    r = conn.getresponse()
+
+    if r.status == 416: # part is broken (larger than the file). start again.
+        r.read()
+        os.remove(part)
+        raise DownloadError("range not satisfiable; removed partial file")
+    elif r.status == 206:
+        m = re.search(r"bytes ([0-9]+)-[0-9]+/([0-9]+)", r.getheader("Content-Range", ""))
+        if not m or int(m.group(1)) != offset:
+            r.read()
+            raise DownloadError("unexpected Content-Range: %s" % r.getheader("Content-Range"))
+        total = int(m.group(2))
+    elif r.status == 200:
+        offset = 0
+        total = int(r.getheader("Content-Length", -1))
+    else:
+        r.read()
+        raise DownloadError("HTTP %d %s" % (r.status, r.reason))
+
+    if total >= 0 and shutil.disk_usage(os.path.dirname(part)).free < total - offset:
+        r.close()
+        raise NoSpaceError("no space in %s for %d bytes" % (os.path.dirname(part), total - offset))
+
+    if offset > 0:
+        print(now(), "  resuming %s from %d/%d bytes" % (f, offset, total))
+        with open(part, "rb") as ifs: head = ifs.read(256)
+        if tee_part and (not os.path.isfile(tee_part) or os.path.getsize(tee_part) != offset):
+            shutil.copyfile(part, tee_part)
+    else:
+        head = b""
 
-        if not tmp or not os.path.isfile(tmp): continue
+    ofs = open(part, "r+b" if offset > 0 else "wb")
+    tfs = open(tee_part, "r+b" if offset > 0 else "wb") if tee_part else None
+    try:
+        for x in (ofs, tfs):
+            if x: x.seek(offset); x.truncate()
+
+        received = offset
+        eof = hdf5_eof_address(head)
+        while True:
+            data = r.read1(chunk_bytes) # returns what arrived, so that received data are kept on error
+            if not data: break
+            if len(head) < 256:
+                head += data[:256-len(head)]
+                if len(head) >= 8 and head[:8] != hdf5_signature:
+                    ofs.truncate(0)
+                    raise FatalDownloadError("not an HDF5 file")
+                if eof is None:
+                    eof = hdf5_eof_address(head)
+                    if eof is not None and total >= 0 and eof > total:
+                        raise DownloadError("file on server is truncated (%d < %d bytes)" % (total, eof))
+            ofs.write(data)
+            if tfs: tfs.write(data)
+            received += len(data)
+    finally:
+        ofs.close()
+        if tfs: tfs.close()
+
+    if total >= 0 and received != total:
+        raise DownloadError("incomplete: %d/%d bytes" % (received, total))
+    if eof is not None and received < eof:
+        raise DownloadError("truncated HDF5: %d < %d bytes" % (received, eof))
+
+    return received - offset
+# fetch_file()
+
+def download_one(conn, e, f, wdir, bssid, tmpdir, omega_offset_by_trigger, delete_lock, ntries=10):
+    """
+    Download one file directly to wdir (and tmpdir). Delete it on the server after verification.
+    Returns True if succeeded.
+    """
+    if not bssid:
+        trg = os.path.join(wdir, f)
+    else:
+        assert f.startswith(bssid)
+        trg = os.path.join(wdir, f[len(bssid):])
+
+    is_master = f.endswith("_master.h5")
+    part = os.path.join(wdir, ".%s.part" % os.path.basename(trg))
+    tee = os.path.join(tmpdir, os.path.basename(trg)) if tmpdir else None
+    # master is modified after download, so copied to tmpdir afterwards
+    tee_part = os.path.join(tmpdir, ".%s.part" % os.path.basename(trg)) if tmpdir and not is_master else None
+
+    ok = False
+    for i in range(ntries):
+        print(now(), " downloading %s (%dth try).." % (f, i+1))
+        startt = time.time()
+        try:
+            nbytes = fetch_file(conn, f, part, tee_part)
+            verify_h5(part, is_master)
+            eltime = time.time() - startt
+            print(now(), "  %s done in %.2f sec. %.3f KB/s" % (f, eltime, nbytes/1024/max(eltime, 1e-3)))
+            ok = True
+            break
+        except FatalDownloadError as err:
+            print(now(), "  ERROR: %s" % err)
+            break
+        except:
+            print(traceback.format_exc())
+            conn.close() # reconnects at next request
+
+        # retry if downloading failed
+        time.sleep(1)
+
+    if not ok:
+        print(now(), "  Download failed. Keeping on server: %s" % f)
+        return False
 
-        if f.endswith("_master.h5"):
+    try:
+        if is_master:
             try:
-                modify_master(tmp, tmp+"-fix.h5", bssid, omega_offset_by_trigger)
-                if tmpdir: safe_copy(tmp+"-fix.h5", os.path.join(tmpdir, os.path.basename(trg)))
-                startt = time.time()
-                safe_copy(tmp+"-fix.h5", trg, move=True)
-                eltime = time.time() - startt
-                print(now(), "  local_copy done in %.2f sec. %.3f KB/s" % (eltime, os.path.getsize(trg)/1024/eltime))
+                modify_master(part, trg, bssid, omega_offset_by_trigger)
+                verify_h5(trg, True)
+                os.remove(part)
             except:
                 print(traceback.format_exc())
-                if os.path.isfile(tmp):
-                    if tmpdir: safe_copy(tmp, os.path.join(tmpdir, os.path.basename(trg)))
-                    startt = time.time()
-                    safe_copy(tmp, trg, move=True)
-                    eltime = time.time() - startt
-                    print(now(), "  local_copy done in %.2f sec. %.3f KB/s" % (eltime, os.path.getsize(trg)/1024/eltime))
-
-            if os.path.isfile(tmp): os.remove(tmp)
+                os.rename(part, trg)
+            if tee: safe_copy(trg, tee)
         else:
-            try:
-                if tmpdir: safe_copy(tmp, os.path.join(tmpdir, os.path.basename(trg)))
-                startt = time.time()
-                safe_copy(tmp, trg, move=True)
-                eltime = time.time() - startt
-                print(now(), "  local_copy done in %.2f sec. %.3f KB/s" % (eltime, os.path.getsize(trg)/1024/eltime))
-            except:
-                dl_failed = True
-                print(now(), "  local_copy failed. Keeping on server: %s" % src)
-                failed_files.append(f)
+            os.rename(part, trg)
+            if tee_part: os.rename(tee_part, tee)
+    except:
+        print(traceback.format_exc())
+        print(now(), "  local file operation failed. Keeping on server: %s" % f)
+        return False
+
+    # delete from server
+    with delete_lock:
+        e.fileWriterFiles(f, method="DELETE")
 
-        # delete from server
-        if not dl_failed:
-            e.fileWriterFiles(f, method="DELETE")
+    return True
+# download_one()
 
-        os.rmdir(os.path.dirname(tmp))
+def download_files(e, files, wdir, bssid, tmpdir=None, omega_offset_by_trigger=None, nconn=4):
+    """
+    If bssid is not None, 'files' contains bssid+prefix_(master.h5|data_*.h5).
 
+    Files are downloaded with nconn concurrent connections, directly to wdir.
+    When `tmpdir' is not None, data are written to tmpdir at the same time.
+    Files in tmpdir are kept, and will be used for hit-extraction.
+    Partial files (.*.part) are resumed in the next trial. Returns the list of failed files.
+    """
+
+    failed_files = []
+    delete_lock = threading.Lock()
+    file_queue = queue.Queue()
+    for f in files: file_queue.put(f)
+
+    def worker():
+        conn = http.client.HTTPConnection(e._host, timeout=60)
+        try:
+            while True:
+                try: f = file_queue.get_nowait()
+                except queue.Empty: break
+
+                try:
+                    ok = download_one(conn, e, f, wdir, bssid, tmpdir, omega_offset_by_trigger, delete_lock)
+                except:
+                    print(traceback.format_exc())
+                    ok = False
+                if not ok: failed_files.append(f)
+        finally:
+            conn.close()
+    # worker()
+
+    startt = time.time()
+    threads = [threading.Thread(target=worker) for i in range(max(1, min(nconn, len(files))))]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    print(now(), "  %d files (%d failed) in %.2f sec with %d connections" % (len(files), len(failed_files),
+                                                                          time.time()-startt, len(threads)))
     return failed_files
 # download_files()
 
@@ -381,7 +500,7 @@ def run(prefix, wdir, bssid, jobmode, opts):
         files = [x for x in files if x not in failed_files]
 
         if files:
-            failed_files.extend(download_files(e, files, wdir, bssid, tmpdir, opts.omega_offset_by_trigger))
+            failed_files.extend(download_files(e, files, wdir, bssid, tmpdir, opts.omega_offset_by_trigger, opts.nconn))
             last_dl_time = time.time()
         elif time.time() - last_dl_time > timeout:
             print(now(), "Download timeout!")
@@ -459,6 +578,7 @@ if __name__ == "__main__":
     parser.add_option("--ssh-host", action="store", type=str, dest="ssh_host", help="for hit-extract (when --no-sge)")
     parser.add_option("--omega-offset-by-trigger", action="store", type=float, dest="omega_offset_by_trigger", default=0)
     parser.add_option("--eiger-host", action="store", type=str, dest="eiger_host", default="192.168.163.204")
+    parser.add_option("--nconn", action="store", type=int, dest="nconn", default=4, help="number of concurrent downloads")
 
     opts, args = parser.parse_args(sys.argv[1:])
 
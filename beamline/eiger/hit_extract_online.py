@@ -12,6 +12,7 @@ import traceback
 import re
 import pysqlite2.dbapi2 as sqlite3
 import glob
+import collections
 
 def get_nspots(dbfile, prefix): # prefix must include _
     re_file = re.compile(re.escape(prefix)+"[0-9]+\..{1,3}$")
@@ -34,7 +35,7 @@ def get_nspots(dbfile, prefix): # prefix must include _
     return []
 # get_nspots()
 
-def create_hitsonly_h5(master_h5, dbfile, hits_h5, spots_min):
+def create_hitsonly_h5(master_h5, dbfile, hits_h5, spots_min, nproc=1):
     start_time = time.time()
 
     prefix = os.path.basename(master_h5)[:-len("master.h5")]
@@ -66,15 +67,19 @@ def create_hitsonly_h5(master_h5, dbfile, hits_h5, spots_min):
     for k in list(h["/entry/data"].keys()):
         del h["/entry/data"][k]
 
+    # compressed chunks are copied without decompression where possible
+    hit_frames = collections.OrderedDict()
     for name, nsp in sorted(hits):
+        hit_frames[int(os.path.splitext(name[len(prefix):])[0])] = (name, nsp)
+
+    rootgrp = h["/entry/data"]
+    for frameno, item in eiger.read_raw_frames(master_h5, list(hit_frames), nproc=nproc):
+        name, nsp = hit_frames[frameno]
         print(" hit: %s %d" %(name, nsp))
-        frameno = int(os.path.splitext(name[len(prefix):])[0])
-        data = eiger.extract_data(master_h5, frameno, return_raw=True)
         grpname = "%s%.6d"%(prefix, frameno)
-        rootgrp = h["/entry/data"]
         rootgrp.create_group(grpname)
-        if data is not None:
-            eiger.compress_h5data(h, "/entry/data/%s/data"%grpname, data, chunks=None, compression="bslz4")
+        if item is not None:
+            eiger.write_raw_frame(h, "/entry/data/%s/data"%grpname, item)
             rootgrp["%s/data"%grpname].attrs["n_spots"] = nsp
         else:
             print("  error: data not found (%s)" % name)
@@ -96,7 +101,7 @@ def create_hitsonly_h5(master_h5, dbfile, hits_h5, spots_min):
     
 # run()
 
-def run(master_h5, master_h5_ctime, dbfile, tmpdir=None, spots_min=3, remove_files=False):
+def run(master_h5, master_h5_ctime, dbfile, tmpdir=None, spots_min=3, remove_files=False, nproc=1):
     """
     Download must be finished when this script started!!
     Everything in tmpdir will be removed!
@@ -118,7 +123,7 @@ def run(master_h5, master_h5_ctime, dbfile, tmpdir=None, spots_min=3, remove_fil
         if not tmpdir: tmpdir = get_temp_local_dir("hitsonly", min_gb=1)
         hits_h5 = os.path.join(tmpdir, prefix+"onlyhits.h5")
         print("tmpdir is %s" %tmpdir)
-        create_hitsonly_h5(master_h5_in_tmp, dbfile, hits_h5, spots_min)
+        create_hitsonly_h5(master_h5_in_tmp, dbfile, hits_h5, spots_min, nproc)
 
         if not os.path.isfile(hits_h5):
             raise Exception("Generation of %s failed" % hits_h5)
@@ -149,6 +154,7 @@ if __name__ == "__main__":
     parser.add_option("--min-spots", action="store", dest="spots_min", type=int, default=3)
     parser.add_option("--ctime-master", action="store", dest="ctime_master", type=int)
     parser.add_option("--tmpdir", action="store", dest="tmpdir", type=str)
+    parser.add_option("--nproc", action="store", dest="nproc", type=int, default=4, help="number of processes to read data files")
 
     opts, args = parser.parse_args(sys.argv[1:])
 
@@ -162,6 +168,6 @@ if __name__ == "__main__":
     if opts.tmpdir=="None": opts.tmpdir = None
 
     print("Command args:")
-    print("  %s %s --min-spots=%s --ctime-master=%s --tmpdir=%s" %(master_h5, dbfile, opts.spots_min, opts.ctime_master, opts.tmpdir))
+    print("  %s %s --min-spots=%s --ctime-master=%s --tmpdir=%s --nproc=%s" %(master_h5, dbfile, opts.spots_min, opts.ctime_master, opts.tmpdir, opts.nproc))
 
-    run(master_h5, master_h5_ctime, dbfile, tmpdir=opts.tmpdir, spots_min=opts.spots_min)
+    run(master_h5, master_h5_ctime, dbfile, tmpdir=opts.tmpdir, spots_min=opts.spots_min, nproc=opts.nproc)
@@ -45,6 +45,9 @@ dry_run = False
 skip_bad_files = False
  .type = bool
  .help = "Set true if you want to ignore bad files (too few reflections)"
+use_cache = False
+ .type = bool
+ .help = "Save parsed XDS_ASCII data in sidecar files (.npz) and reuse them next time"
 
 d_min = 3
  .type = float
@@ -91,11 +94,11 @@ def run(params):
     if params.method == "brehm_diederichs":
         rb = BrehmDiederichs(xac_files, params.streamin, params.space_group, max_delta=params.max_delta,
                              d_min=params.d_min, min_ios=params.min_ios,
-                             nproc=params.nproc, log_out=log_out)
+                             nproc=params.nproc, log_out=log_out, use_cache=params.use_cache)
     elif params.method == "selective_breeding":
         rb = KabschSelectiveBreeding(xac_files, params.streamin, params.space_group, max_delta=params.max_delta,
                                      d_min=params.d_min, min_ios=params.min_ios,
-                                     nproc=params.nproc, log_out=log_out)
+                                     nproc=params.nproc, log_out=log_out, use_cache=params.use_cache)
     elif params.method == "reference":
         import iotbx.file_reader
 
@@ -135,12 +138,12 @@ def run(params):
 
         rb = ReferenceBased(xac_files, params.streamin, params.space_group, ref_array, max_delta=params.max_delta,
                             d_min=params.d_min, min_ios=params.min_ios,
-                            nproc=params.nproc, log_out=log_out)
+                            nproc=params.nproc, log_out=log_out, use_cache=params.use_cache)
     elif params.method == "precalc":
         if params.precalc is None:
             raise SystemExit("Give a json file to precalc=")
         rb = ReindexResolver(xac_files, params.streamin, params.space_group,
-                             log_out=log_out)
+                             log_out=log_out, use_cache=params.use_cache)
         if xac_files:
             rb.read_xac_files()
         else:
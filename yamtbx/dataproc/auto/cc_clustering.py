@@ -9,12 +9,12 @@ from __future__ import print_function
 from __future__ import unicode_literals
 from cctbx.array_family import flex
 from cctbx import miller
-from libtbx import easy_mp
 from libtbx.utils import null_out
 from libtbx.utils import Sorry
 from yamtbx.util import call
 from yamtbx.dataproc.xds.xds_ascii import XDS_ASCII
 from yamtbx.dataproc.auto.blend import load_xds_data_only_indices
+from yamtbx.dataproc.auto.pairwise_cc import PairwiseCC
 import os
 import numpy
 import collections
@@ -34,11 +34,11 @@ def calc_cc(ari, arj):
       return float("nan"), ari.size()
 # calc_cc()
 
-def read_xac_files(xac_files, d_min=None, d_max=None, min_ios=None):
+def read_xac_files(xac_files, d_min=None, d_max=None, min_ios=None, use_cache=False):
     arrays = collections.OrderedDict()
 
     for f in xac_files:
-        xac = XDS_ASCII(f, i_only=True)
+        xac = XDS_ASCII(f, i_only=True, use_cache=use_cache)
         xac.remove_rejected()
         a = xac.i_obs().resolution_filter(d_min=d_min, d_max=d_max)
         a = a.as_non_anomalous_array().merge_equivalents(use_internal_variance=False).array()
@@ -49,8 +49,8 @@ def read_xac_files(xac_files, d_min=None, d_max=None, min_ios=None):
 # read_xac_files()
 
 class CCClustering(object):
-    def __init__(self, wdir, xac_files, d_min=None, d_max=None, min_ios=None):
-        self.arrays = read_xac_files(xac_files, d_min=d_min, d_max=d_max, min_ios=min_ios)
+    def __init__(self, wdir, xac_files, d_min=None, d_max=None, min_ios=None, use_cache=False):
+        self.arrays = read_xac_files(xac_files, d_min=d_min, d_max=d_max, min_ios=min_ios, use_cache=use_cache)
         self.wdir = wdir
         self.clusters = {}
         self.all_cc = {} # {(i,j):cc, ...}
@@ -123,17 +123,12 @@ class CCClustering(object):
                 for r in failed: msg += " %s\n%s\n" % (r, "\n".join(["  %s"%x for x in failed[r]]))
                 raise Sorry("intensity normalization failed by following reason(s):\n%s"%msg)
                     
-        # Prep 
-        args = []
-        for i in range(len(self.arrays)-1):
-            for j in range(i+1, len(self.arrays)):
-                args.append((i,j))
-           
-        # Calc all CC
-        worker = lambda x: calc_cc(list(self.arrays.values())[x[0]], list(self.arrays.values())[x[1]])
-        results = easy_mp.pool_map(fixed_func=worker,
-                                   args=args,
-                                   processes=nproc)
+        # Calc all CC at once
+        ccmat, nrefmat = PairwiseCC.from_miller_arrays(list(self.arrays.values())).calc_all(nproc=nproc)
+        iu = numpy.triu_indices(len(self.arrays), 1)
+        args = list(zip(iu[0].tolist(), iu[1].tolist()))
+        results = list(zip(ccmat[iu].tolist(), nrefmat[iu].tolist()))
+        del ccmat, nrefmat
 
         # Check NaN and decide which data to remove
         idx_bad = {}
@@ -21,7 +21,7 @@ from yamtbx.dataproc.xds import xparm
 from yamtbx.dataproc.xds.command_line import estimate_resolution_by_spotxds
 from yamtbx.dataproc.adxv import Adxv
 from yamtbx.dataproc import dataset
-from yamtbx.dataproc.bl_logfiles import BssJobLog
+from yamtbx.dataproc.bl_logfiles import BssJobLog, LogFileTail
 from yamtbx.dataproc.auto.command_line.multi_check_cell_consistency import CellGraph
 from yamtbx.util import batchjob, directory_included, read_path_list, safe_float, expand_wildcard_in_list
 from yamtbx.util.xtal import format_unit_cell
@@ -295,7 +295,7 @@ class BssJobs(object):
     def __init__(self):
         self.jobs = {} # { (path+prefix, number range) as key: }
         self.jobs_prefix_lookup = {} # {prefix: number_range in keys of self.jobs}
-        self.bsslogs_checked = {}
+        self.bsslogs_checked = {} # {filename: LogFileTail}
 
         self.procjobs = {} # key: batchjob
 
@@ -305,6 +305,7 @@ class BssJobs(object):
         self._prev_job_finished = False
         self._current_prefix = None
         self._joblogs = []
+        self._joblog_cache = {} # {joblog: BssJobLog} for pending joblogs
         self._chaches = {} # chache logfile objects. {filename: [timestamp, objects..]
         self.cell_graph = CellGraph(tol_length=config.params.merging.cell_grouping.tol_length,
                                     tol_angle=config.params.merging.cell_grouping.tol_angle)
@@ -346,11 +347,14 @@ class BssJobs(object):
         for bsslog in bsslogs:
             #print "reading", bsslog
 
-            last_line = self.bsslogs_checked.get(bsslog, -1)
+            if bsslog not in self.bsslogs_checked:
+                self.bsslogs_checked[bsslog] = LogFileTail(bsslog)
+            lines, restarted = self.bsslogs_checked[bsslog].read_new_lines() # only lines appended since last check
+            if restarted: mylog.warning("%s was truncated or replaced. Reading from the beginning." % bsslog)
+
             read_job_flag = False
-            for i, l in enumerate(open(bsslog)):
+            for i, l in enumerate(lines):
                 try:
-                    if i <= last_line: continue
                     if l.startswith("echo "): continue # Must skip this line.
 
                     if "Beamline Scheduling Software Start" in l:
@@ -414,12 +418,10 @@ class BssJobs(object):
 
                 except Exception as e:
                     mylog.error("Unhandled error occurred when reading %s" % bsslog)
-                    mylog.error(" Line %d-> %s <" % (i, l.rstrip()))
+                    mylog.error(" Line %d (of new lines)-> %s <" % (i, l.rstrip()))
                     mylog.error(traceback.format_exc())
                     raise e
 
-            self.bsslogs_checked[bsslog] = i
-            # Check if start number and bss log were found. If not, set line number
     # check_bss_log()
 
     def update_jobs(self, date, daystart=-2): #, joblogs, prev_job_finished, job_is_running):
@@ -437,7 +439,11 @@ class BssJobs(object):
                 mylog.info("Joblog not found. not created yet? pending: %s"%joblog)
                 continue
 
-            bjl = BssJobLog(joblog, remove_overwritten=True)
+            if joblog in self._joblog_cache:
+                bjl = self._joblog_cache[joblog]
+                bjl.update() # parse only appended lines
+            else:
+                bjl = self._joblog_cache[joblog] = BssJobLog(joblog, remove_overwritten=True)
             prefix = os.path.splitext(joblog)[0] # XXX what if .gz etc?
             is_running_job = (self._job_is_running and i == len(self._joblogs)-1)
 
@@ -510,6 +516,7 @@ class BssJobs(object):
 
         remove_idxes = list(set(remove_idxes))
         for i in sorted(remove_idxes, reverse=True):
+            self._joblog_cache.pop(self._joblogs[i][0], None)
             del self._joblogs[i]
 
         mylog.debug("remaining joblogs= %s" % self._joblogs)
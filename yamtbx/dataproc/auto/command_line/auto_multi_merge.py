@@ -100,6 +100,9 @@ batch {
  sh_max_jobs = 1
   .type = int
   .help = maximum number of concurrent jobs when engine=sh
+ sh_max_cores = None
+  .type = int
+  .help = maximum number of cores used by concurrent jobs when engine=sh (each job counts nproc_each). Larger jobs wait and smaller ones may start first.
  mem_per_cpu = default
   .type = str
   .help = mem_per_cpu (slurm --mem option)
@@ -455,7 +458,7 @@ def run(params):
     elif params.batch.engine == "sge":
         batchjobs = batchjob.SGE(pe_name=params.batch.sge_pe_name)
     elif params.batch.engine == "sh":
-        batchjobs = batchjob.ExecLocal(max_parallel=params.batch.sh_max_jobs)
+        batchjobs = batchjob.ExecLocal(max_parallel=params.batch.sh_max_jobs, max_cores=params.batch.sh_max_cores)
     else:
         batchjobs = None
 
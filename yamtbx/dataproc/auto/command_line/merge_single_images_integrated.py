@@ -9,10 +9,13 @@ from __future__ import unicode_literals
 from yamtbx.dataproc.xds import xds_ascii
 from yamtbx.dataproc.crystfel import hkl as crystfel_hkl
 from yamtbx.util import read_path_list
+from yamtbx.util import bounded_imap_unordered
+from yamtbx.util import shared_store
 import yamtbx_utils_ext
 from cctbx import miller
 from cctbx import crystal
 from cctbx import sgtbx
+from cctbx import uctbx
 from cctbx.array_family import flex
 from libtbx import easy_mp
 import iotbx.scalepack.merge
@@ -70,6 +73,9 @@ correct_peak = false
 cancel_rlp = false
  .type = bool
  .help = divide intensities by RLP
+use_cache = false
+ .type = bool
+ .help = save parsed XDS_ASCII data in a sidecar file (.npz) and reuse it next time
 
 calc_split = false
  .type = bool
@@ -159,7 +165,7 @@ def get_data_from_xac(params, xac):
     if xac.endswith(".pkl"):
         tmp = pickle.load(open(xac, "rb"))
     else:
-        tmp = xds_ascii.XDS_ASCII(xac)
+        tmp = xds_ascii.XDS_ASCII(xac, use_cache=params.use_cache)
         
     sel_remove = flex.bool(tmp.iobs.size(), False)
 
@@ -359,14 +365,41 @@ def mc_integration(params, input_files, input_type, scale_ref=None, split_idxes=
         return i, tmp, k, b
     # load_xds_or_dials()
 
+    shm_prefix = shared_store.new_prefix()
+
+    def load_to_shared(i, file_in, scout):
+        # Only the name of shared memory is sent back to the main process, instead of pickled data
+        i, tmp, k, b = load_xds_or_dials(i, file_in, scout)
+        shared = shared_store.SharedArrays.from_arrays(zip(("indices", "data", "sigmas"),
+                                                           shared_store.miller_array_as_numpy(tmp)),
+                                                       prefix=shm_prefix)
+        shared.close()
+        return i, shared.descriptor(), tmp.unit_cell().parameters(), k, b
+    # load_to_shared()
+
+    def data_from_shared(results):
+        try:
+            for i, desc, cell, k, b in results:
+                shared = shared_store.SharedArrays.attach(desc)
+                indices, data, sigmas = shared_store.numpy_as_flex(shared["indices"], shared["data"], shared["sigmas"])
+                shared.unlink()
+                yield i, indices, data, sigmas, uctbx.unit_cell(cell), k, b
+        finally:
+            # free data in flight when stopped by an error (stop workers first)
+            if hasattr(results, "close"): results.close()
+            shared_store.unlink_all(shm_prefix)
+    # data_from_shared()
+
     if params.nproc > 1:
-        # It may cost much memory..
-        xds_data = easy_mp.pool_map(fixed_func=lambda x: load_xds_or_dials(x[0],x[1], scale_strs),
-                                    args=[x for x in enumerate(input_files)],
-                                    processes=params.nproc)
+        # Files are read in parallel and merged in the order of completion.
+        # Number of loaded but not yet merged data is bounded, so memory does not grow with number of files.
+        xds_data = data_from_shared(bounded_imap_unordered(lambda x: load_to_shared(x[0],x[1], scale_strs),
+                                                           enumerate(input_files),
+                                                           processes=params.nproc))
     else:
         # create generator
-        xds_data = (load_xds_or_dials(i, x, scale_strs) for i, x in enumerate(input_files))
+        xds_data = ((i, x.indices(), x.data(), x.sigmas(), x.unit_cell(), k, b)
+                    for i, x, k, b in (load_xds_or_dials(i, f, scale_strs) for i, f in enumerate(input_files)))
 
     merger = yamtbx_dataproc_crystfel_ext.merge_equivalents_crystfel()
     merger_split = None
@@ -377,34 +410,32 @@ def mc_integration(params, input_files, input_type, scale_ref=None, split_idxes=
     cells = []
     bs = [] # b-factor list
     bs_split = [[], []] # b-factor list for split data
-    for i, x, k, b in xds_data:
-        sys.stdout.write("Merging %7d\r" % (i+1))
+    for n_merged, (i, indices, data, sigmas, uc, k, b) in enumerate(xds_data):
+        sys.stdout.write("Merging %7d\r" % (n_merged+1))
         sys.stdout.flush()
 
-        data, sigmas = x.data(), x.sigmas()
-
         if None not in (k,b):
             data *= k
             sigmas *= k
 
             if b == b: # nan if not calculated
-                d_star_sq = x.unit_cell().d_star_sq(x.indices())
+                d_star_sq = uc.d_star_sq(indices)
                 data *= flex.exp(-b*d_star_sq)
                 sigmas *= flex.exp(-b*d_star_sq)
                 bs.append(b)
 
         if params.sigma_calculation == "population":
-            merger.add_observations(x.indices(), data)
+            merger.add_observations(indices, data)
         else: # experimental
-            merger.add_observations(x.indices(), data, sigmas)
+            merger.add_observations(indices, data, sigmas)
 
-        cells.append(x.unit_cell().parameters())
+        cells.append(uc.parameters())
         if split_idxes is not None:
             if b is not None and b==b: bs_split[split_idxes[i]].append(b)
             if params.sigma_calculation == "population":
-                merger_split[split_idxes[i]].add_observations(x.indices(), data)
+                merger_split[split_idxes[i]].add_observations(indices, data)
             else: # experimental
-                merger_split[split_idxes[i]].add_observations(x.indices(), data, sigmas)
+                merger_split[split_idxes[i]].add_observations(indices, data, sigmas)
 
     print("\nDone.")
 
@@ -177,6 +177,9 @@ cc_clustering {
  min_ios = None
   .type = float
   .help = minimum I/sigma for CC calculation
+ use_cache = false
+  .type = bool
+  .help = Save parsed XDS_ASCII data in sidecar files (.npz) and reuse them next time
  min_cmpl = 90
   .type = float
   .help = minimum completeness of cluster for merging
@@ -235,6 +238,9 @@ batch {
  sh_max_jobs = 1
   .type = int
   .help = maximum number of concurrent jobs when engine=sh
+ sh_max_cores = None
+  .type = int
+  .help = maximum number of cores used by concurrent jobs when engine=sh (each job counts nproc_each). Larger jobs wait and smaller ones may start first.
 }
 """
 
@@ -321,6 +327,23 @@ def merge_datasets(params, workdir, xds_files, cells, space_group):
         return ret
 
     elif params.program == "aimless":
+        # Exclude datasets not connected by common reflections before running pointless/aimless
+        excluded_files = []
+        if len(xds_files) > 1:
+            try:
+                sg = space_group
+                if sg is None: sg = multi_merging.xscale.xds_ascii_info.symm(xds_files[0]).space_group()
+                keep_idxes, drop_idxes = multi_merging.xscale.select_mergeable(xds_files, sg, params.anomalous,
+                                                                               d_min=params.d_min, d_max=params.d_max)
+                excluded_files = [xds_files[i] for i in drop_idxes]
+                xds_files = [xds_files[i] for i in keep_idxes]
+            except:
+                print("Error in checking common reflections. Proceeding with all files.", file=out)
+                print(traceback.format_exc(), file=out)
+
+            if excluded_files:
+                print("%d files are not connected by common reflections and excluded." % len(excluded_files), file=out)
+
         worker = Pointless()
         print("\nRunning pointless", file=out)
         runinfo = worker.run_copy(hklout="pointless.mtz", wdir=workdir,
@@ -345,6 +368,8 @@ def merge_datasets(params, workdir, xds_files, cells, space_group):
                                                      batchjobs=None) # FIXME batchjobs
         unused_files, reasons = cycles.run_cycles(xds_files)
         used_files = set(xds_files).difference(set(unused_files))
+        unused_files = excluded_files + list(unused_files)
+        for f in excluded_files: reasons[f] = "no_common_refls"
 
         print(file=out)
         print(" SUMMARY ", file=out)
@@ -425,7 +450,7 @@ def run(params):
     elif params.batch.engine == "slurm":
         batchjobs = batchjob.Slurm(pe_name=params.batch.sge_pe_name)
     elif params.batch.engine == "sh":
-        batchjobs = batchjob.ExecLocal(max_parallel=params.batch.sh_max_jobs)
+        batchjobs = batchjob.ExecLocal(max_parallel=params.batch.sh_max_jobs, max_cores=params.batch.sh_max_cores)
     else:
         raise "Unknown batch engine: %s" % params.batch.engine
 
@@ -459,7 +484,7 @@ def run(params):
     laues = {} # for check
     for xac in xds_ascii_files:
         try:
-            symm = XDS_ASCII(xac, read_data=False).symm
+            symm = multi_merging.xscale.xds_ascii_info.symm(xac) # cached for XscaleCycles
         except:
             print("Error in reading %s" % xac, file=out)
             print(traceback.format_exc(), file=out)
@@ -607,7 +632,8 @@ def run(params):
         os.mkdir(ccc_wdir)
         cc_clusters = cc_clustering.CCClustering(ccc_wdir, xds_ascii_files,
                                                  d_min=params.cc_clustering.d_min if params.cc_clustering.d_min is not None else params.d_min,
-                                                 min_ios=params.cc_clustering.min_ios)
+                                                 min_ios=params.cc_clustering.min_ios,
+                                                 use_cache=params.cc_clustering.use_cache)
         print("\nRunning CC-based clustering", file=out)
 
         cc_clusters.do_clustering(nproc=params.cc_clustering.nproc,
@@ -760,11 +786,65 @@ pickle.dump(ret, open("result.pkl","wb")); \
             try: html_report.add_merge_result(workdir, clh, lcv, alcv, xds_files, results[-1][2], results[-1][3])
             except: print(traceback.format_exc(), file=out)
     else:
-        for workdir, xds_files, LCV, aLCV, clh in data_for_merge:
-            print("Merging %s..." % os.path.relpath(workdir, params.workdir), file=out)
+        # Independent clusters are merged concurrently, each using batch.nproc_each cores out of nproc
+        nconc = min(len(data_for_merge), params.nproc // max(1, params.batch.nproc_each))
+        if params.batch.engine == "sh":
+            # each merge runs its own ExecLocal; share sh_max_jobs (and sh_max_cores) among them
+            nconc = min(nconc, params.batch.sh_max_jobs)
+        results_list = None
+        if nconc > 1:
+            print("Merging %d clusters, %d at a time..." % (len(data_for_merge), nconc), file=out)
             out.flush()
-            results = merge_datasets(params, workdir, xds_files, cells, space_group)
-            
+            params.nproc = params.batch.nproc_each
+            if params.batch.engine == "sh":
+                params.batch.sh_max_jobs //= nconc
+                if params.batch.sh_max_cores is not None:
+                    params.batch.sh_max_cores = max(params.batch.nproc_each, params.batch.sh_max_cores // nconc)
+
+            def merge_worker(x):
+                # anything written to stdout/stderr (also by subprocesses) goes to the log in workdir,
+                # which is shown in the parent when finished, not interleaved with other merges
+                i, workdir, xds_files = x[0], x[1][0], x[1][1]
+                if not os.path.exists(workdir): os.makedirs(workdir)
+                sys.stdout.flush()
+                sys.stderr.flush()
+                saved_fds = os.dup(1), os.dup(2)
+                with open(os.path.join(workdir, "merge_stdout.log"), "w") as ofs:
+                    os.dup2(ofs.fileno(), 1)
+                    os.dup2(ofs.fileno(), 2)
+                    try:
+                        return i, merge_datasets(params, workdir, xds_files, cells, space_group)
+                    except:
+                        return i, traceback.format_exc()
+                    finally:
+                        sys.stdout.flush()
+                        sys.stderr.flush()
+                        for fd, saved in zip((1, 2), saved_fds):
+                            os.dup2(saved, fd)
+                            os.close(saved)
+            # merge_worker()
+
+            results_list = [None] * len(data_for_merge)
+            for i, results in util.bounded_imap_unordered(merge_worker, enumerate(data_for_merge), nconc):
+                workdir = data_for_merge[i][0]
+                print("Finished merging %s" % os.path.relpath(workdir, params.workdir), file=out)
+                try: out.write(open(os.path.join(workdir, "merge_stdout.log")).read())
+                except IOError: pass
+                out.flush()
+                results_list[i] = results
+
+        for i, (workdir, xds_files, LCV, aLCV, clh) in enumerate(data_for_merge):
+            if results_list is None:
+                print("Merging %s..." % os.path.relpath(workdir, params.workdir), file=out)
+                out.flush()
+                results = merge_datasets(params, workdir, xds_files, cells, space_group)
+            else:
+                results = results_list[i]
+                if not isinstance(results, list):
+                    print("Error in merging %s" % os.path.relpath(workdir, params.workdir), file=out)
+                    print(results, file=out)
+                    results = []
+
             if len(results) == 0:
                 ofs_summary.write("#%s failed\n" % os.path.relpath(workdir, params.workdir))
 
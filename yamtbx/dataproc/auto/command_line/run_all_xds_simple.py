@@ -18,6 +18,9 @@ import time
 import glob
 import numpy
 import io
+import collections
+import multiprocessing
+import queue
 
 from yamtbx.command_line import kamo_test_installation
 from yamtbx.dataproc.xds import get_xdsinp_keyword, modify_xdsinp, optimal_delphi_by_nproc, make_backup, revert_files, remove_backups
@@ -111,6 +114,11 @@ cell_prior {
 """
 
 re_running_job = re.compile(r"\*\*\*\*\* ([^ ]*) \*\*\*\*\*")
+re_wall_clock_time = re.compile(r"elapsed wall-clock time *([0-9.]+) *sec")
+
+xds_steps = ("XYCORR", "INIT", "COLSPOT", "IDXREF", "DEFPIX", "INTEGRATE", "CORRECT")
+xds_step_times = collections.OrderedDict() # step -> total seconds, accumulated in run_xds()
+xds_step_hook = None # called with wdir before each xds run (used by XdsScheduler to set the number of processors)
 re_running_integrate = re.compile(r"PROCESSING OF IMAGES *([0-9]*) *\.\.\. *([0-9]*)")
 
 def find_mosaicity_for_image(line):
@@ -171,7 +179,26 @@ def calc_merging_stats(xac_file, cut_resolution=True):
     return d_min, cutoffs, stats
 # calc_merging_stats()
 
+def read_step_times(wdir, jobs, elapsed):
+    """
+    Add wall-clock time of each step in jobs to xds_step_times, read from the last lines of <STEP>.LP.
+    If not available, elapsed time of the whole run is used for a single step.
+    """
+    for job in jobs:
+        t = None
+        lp = os.path.join(wdir, "%s.LP" % job)
+        if os.path.isfile(lp):
+            r = re_wall_clock_time.findall(open(lp).read()[-1000:])
+            if r: t = float(r[-1])
+        if t is None and len(jobs) == 1: t = elapsed
+        if t is not None: xds_step_times[job] = xds_step_times.get(job, 0.) + t
+# read_step_times()
+
 def run_xds(wdir, comm="xds_par", show_progress=True):
+    if xds_step_hook is not None: xds_step_hook(wdir)
+    jobs = dict(get_xdsinp_keyword(os.path.join(wdir, "XDS.INP"))).get("JOB", "").split()
+    time_started = time.time()
+
     env = None
 
     if "SGE_O_PATH" in os.environ:
@@ -204,6 +231,8 @@ def run_xds(wdir, comm="xds_par", show_progress=True):
     else:
         p = subprocess.Popen(comm, cwd=wdir, stdout=log_raw, stderr=log_raw, env=env, universal_newlines=True)
         p.wait()
+
+    read_step_times(wdir, jobs, time.time()-time_started)
 # run_xds()
 
 def run_xdsstat(wdir):
@@ -728,6 +757,145 @@ def run_xds_sequence(root, params):
     return ret
 # run_xds_sequence()
 
+def estimate_xds_cost(root):
+    """relative cost of processing in root: number of frames x number of pixels"""
+    try:
+        xdsinp_dict = dict(get_xdsinp_keyword(os.path.join(root, "XDS.INP")))
+        first, last = list(map(int, xdsinp_dict["DATA_RANGE"].split()))
+        nx, ny = int(xdsinp_dict.get("NX", 1000)), int(xdsinp_dict.get("NY", 1000))
+        return max(1, last-first+1) * nx * ny
+    except:
+        print("Can't estimate cost of %s" % root)
+        return 1000 * 1000 * 100
+# estimate_xds_cost()
+
+class CoreBudget(object):
+    """
+    Processors shared by xds jobs in forked processes.
+    A job takes processors in proportion to its cost among all unfinished jobs,
+    and gives them back before each xds run, so shares are rebalanced as jobs finish.
+    Processors held by each job are kept in shared memory, so that those of a killed job can be given back.
+    """
+    def __init__(self, ncores, total_cost, njobs):
+        self.ncores = ncores
+        self._lock = multiprocessing.Lock()
+        self._free = multiprocessing.RawValue("i", ncores)
+        self._active_cost = multiprocessing.RawValue("d", total_cost)
+        self._held = multiprocessing.RawArray("i", njobs) # -1 if finished
+    # __init__()
+
+    def free(self): return self._free.value
+
+    def take(self, cost, job):
+        """returns new number of processors of job, giving back the ones it holds"""
+        with self._lock:
+            avail = self._free.value + max(0, self._held[job])
+            share = int(round(self.ncores * cost / self._active_cost.value)) if self._active_cost.value > 0 else avail
+            share = max(1, min(share, avail))
+            self._free.value = avail - share
+            self._held[job] = share
+            return share
+    # take()
+
+    def release(self, job, finished_cost=0):
+        """give back all processors of finished job. does nothing if already released"""
+        with self._lock:
+            if self._held[job] < 0: return
+            self._free.value += self._held[job]
+            self._held[job] = -1
+            self._active_cost.value -= finished_cost
+    # release()
+# class CoreBudget
+
+class XdsScheduler(object):
+    """
+    Runs xds jobs in forked processes, largest first, as long as processors are free.
+    The number of processors of each xds run is given by CoreBudget.
+    Wall-clock time of each step is written in xds_run_summary.dat
+    """
+    def __init__(self, params, ncores):
+        self.params = params
+        self.ncores = ncores
+    # __init__()
+
+    def run_job(self, root, budget, job, cost, nproc, result_queue):
+        global xds_step_hook
+        nproc_hist = [nproc]
+
+        def set_nproc(wdir):
+            nproc_hist.append(budget.take(cost, job))
+            modify_xdsinp(os.path.join(wdir, "XDS.INP"), inp_params=[("MAXIMUM_NUMBER_OF_PROCESSORS", str(nproc_hist[-1]))])
+        # set_nproc()
+
+        time_started = time.time()
+        xds_step_times.clear()
+        xds_step_hook = set_nproc
+        self.params.nproc = nproc # for delphi
+        try:
+            run_xds_sequence(root, self.params)
+        except:
+            print(traceback.format_exc())
+        finally:
+            budget.release(job, cost)
+            result_queue.put((root, dict(wall=time.time()-time_started, nproc=(min(nproc_hist), max(nproc_hist)),
+                                  steps=dict(xds_step_times))))
+    # run_job()
+
+    def run(self, xds_dirs):
+        costs = dict([(x, estimate_xds_cost(x)) for x in xds_dirs])
+        pending = sorted(xds_dirs, key=lambda x: costs[x], reverse=True)
+        job_ids = dict([(x, i) for i, x in enumerate(xds_dirs)])
+        budget = CoreBudget(self.ncores, sum(costs.values()), len(xds_dirs))
+        result_queue = multiprocessing.Queue()
+        running = {}
+        results = collections.OrderedDict()
+
+        while pending or running:
+            while pending and budget.free() > 0:
+                root = pending.pop(0)
+                nproc = budget.take(costs[root], job_ids[root])
+                running[root] = multiprocessing.Process(target=self.run_job, args=(root, budget, job_ids[root], costs[root],
+                                                                                   nproc, result_queue))
+                running[root].start()
+
+            try:
+                root, info = result_queue.get(timeout=10)
+            except queue.Empty:
+                # process killed without reporting
+                for root in [x for x in running if not running[x].is_alive()]:
+                    print("Error: xds job for %s died (exitcode= %s)" % (root, running[root].exitcode))
+                    running.pop(root).join()
+                    budget.release(job_ids[root], costs[root])
+                    results[root] = None
+                continue
+
+            running.pop(root).join()
+            results[root] = info
+
+        write_xds_run_summary(self.params.topdir, results, costs)
+        return results
+    # run()
+# class XdsScheduler
+
+def write_xds_run_summary(topdir, results, costs):
+    """
+    results: {root: dict(wall=, nproc=(min, max), steps={step: sec}) or None if failed}
+    nproc can be (None, None) if not specified.
+    """
+    fmt_int = lambda x: "%d" % x if x is not None else "NA"
+    ofs = open(os.path.join(topdir, "xds_run_summary.dat"), "w")
+    ofs.write("dir cost nproc.min nproc.max wall %s\n" % " ".join(xds_steps))
+    for root in results:
+        info = results[root]
+        if info is None:
+            ofs.write("%s %.3e NA NA NA %s\n" % (os.path.relpath(root, topdir), costs[root], " ".join(["NA"]*len(xds_steps))))
+            continue
+        steps = " ".join(["%.1f" % info["steps"][x] if x in info["steps"] else "NA" for x in xds_steps])
+        ofs.write("%s %.3e %s %s %.1f %s\n" % (os.path.relpath(root, topdir), costs[root],
+                                              fmt_int(info["nproc"][0]), fmt_int(info["nproc"][1]), info["wall"], steps))
+    ofs.close()
+# write_xds_run_summary()
+
 class xds_runmanager(object):
     def __init__(self, params):
         self.params = params
@@ -762,6 +930,12 @@ def run(params):
     if params.multiproc:
         npar = util.get_number_of_processors() if params.nproc is None else params.nproc
 
+        if params.parmethod == "multiprocessing":
+            # Processors of each xds run are decided by XdsScheduler
+            print("Running xds jobs using %d processors in total" % npar)
+            XdsScheduler(params, npar).run([os.path.abspath(x) for x in xds_dirs])
+            return
+
         # Override nproc
         if len(xds_dirs) < npar: params.nproc  = npar // len(xds_dirs)
         else: params.nproc = 1
@@ -783,8 +957,17 @@ def run(params):
                          processes=npar)
         """
     else:
-        for root in xds_dirs:
-            run_xds_sequence(root, params)
+        results = collections.OrderedDict()
+        try:
+            for root in xds_dirs:
+                time_started = time.time()
+                xds_step_times.clear()
+                results[root] = None # if failed
+                run_xds_sequence(root, params)
+                results[root] = dict(wall=time.time()-time_started, nproc=(params.nproc, params.nproc),
+                                     steps=dict(xds_step_times))
+        finally:
+            write_xds_run_summary(params.topdir, results, dict([(x, estimate_xds_cost(x)) for x in results]))
                 
 # run()
 
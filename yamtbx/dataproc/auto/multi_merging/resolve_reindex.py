@@ -9,6 +9,7 @@ from __future__ import print_function
 from __future__ import unicode_literals
 from yamtbx.dataproc.xds.xds_ascii import XDS_ASCII
 from yamtbx.util.xtal import format_unit_cell
+from yamtbx.dataproc.auto.pairwise_cc import PairwiseCC
 from cctbx import crystal
 from cctbx.crystal import reindex
 from cctbx.array_family import flex
@@ -20,7 +21,6 @@ from cctbx.merging import brehm_diederichs
 
 import os
 import copy
-import multiprocessing
 import time
 import numpy
 import json
@@ -36,7 +36,7 @@ def calc_cc(a1, a2):
 # calc_cc()
 
 class ReindexResolver:
-    def __init__(self, xac_files=None, stream_files=None, space_group=None, d_min=3, min_ios=3, nproc=1, max_delta=5, log_out=null_out()):
+    def __init__(self, xac_files=None, stream_files=None, space_group=None, d_min=3, min_ios=3, nproc=1, max_delta=5, log_out=null_out(), use_cache=False):
         adopt_init_args(self, locals())
         assert xac_files or stream_files
         assert not (xac_files and stream_files)
@@ -75,7 +75,7 @@ class ReindexResolver:
         bad_files, good_files = [], []
         for i, f in enumerate(self.xac_files):
             print("%4d %s" % (i, f), file=self.log_out)
-            xac = XDS_ASCII(f, i_only=True)
+            xac = XDS_ASCII(f, i_only=True, use_cache=self.use_cache)
             self.log_out.write("     d_range: %6.2f - %5.2f" % xac.i_obs().resolution_range())
             self.log_out.write(" n_ref=%6d" % xac.i_obs().size())
             xac.remove_rejected()
@@ -239,24 +239,34 @@ class ReindexResolver:
     # modify_xds_ascii_files()
 
     def modify_stream_files(self, output):
-        from yamtbx.dataproc.crystfel.stream import stream_iterator, stream_header
+        from yamtbx.dataproc.crystfel.stream import StreamIndex, stream_header
 
         self.log_out.write("Writing reindexed stream..\n")
         assert len(self.stream_valid_idxes) == len(self.best_operators)
-        ofs = open(output, "w")
-        ofs.write(stream_header())
+        valid_idxes = set(self.stream_valid_idxes)
+        ofs = open(output, "wb")
+        ofs.write(stream_header().encode())
         best_ops = copy.copy(self.best_operators)
         idx = 0
         for f in self.stream_files:
-            for chunk in stream_iterator(f):
-                if idx in self.stream_valid_idxes:
+            sidx = StreamIndex(f, use_cache=self.use_cache, log_out=self.log_out)
+            fin = sidx.open()
+            raw_copy_ok = sidx.format_version(fin) == "2.3" # same as make_lines()
+            for n in sidx.indexed():
+                meta = sidx.metadata(n)
+                if idx in valid_idxes:
                     op = best_ops.pop(0)
-                    print(" %4d %s %s %s" % (idx, chunk.filename, chunk.event, op.as_hkl()))
-                    chunk.change_basis(op)
-                    ofs.write(chunk.make_lines())
+                    print(" %4d %s %s %s" % (idx, meta["filename"], meta["event"], op.as_hkl()))
+                    if raw_copy_ok and op.is_identity_op(): # copy as it is
+                        ofs.write(sidx.read_raw(n, fin))
+                    else:
+                        chunk = sidx.read_chunk(n, fin=fin)
+                        chunk.change_basis(op)
+                        ofs.write(chunk.make_lines().encode())
                 else:
-                    print(" %4d %s %s skipped" % (idx, chunk.filename, chunk.event))
+                    print(" %4d %s %s skipped" % (idx, meta["filename"], meta["event"]))
                 idx += 1
+            sidx.close()
 
         assert not best_ops
         ofs.close()
@@ -282,27 +292,6 @@ class ReindexResolver:
     # debug_write_mtz()
 # class ReindexResolver
 
-def kabsch_selective_breeding_worker(args):
-    ref, i, tmp, new_ops = args
-    global kabsch_selective_breeding_worker_dict
-    nproc = kabsch_selective_breeding_worker_dict["nproc"]
-    arrays = kabsch_selective_breeding_worker_dict["arrays"]
-    reindexed_arrays = kabsch_selective_breeding_worker_dict["reindexed_arrays"]
-    reidx_ops = kabsch_selective_breeding_worker_dict["reidx_ops"]
-
-    if ref==i: return None
-    
-    if nproc > 1:
-        tmp2 = reindexed_arrays[new_ops[ref]][ref]
-    else:                                
-        if reidx_ops[new_ops[ref]].is_identity_op(): tmp2 = arrays[ref]
-        else: tmp2 = arrays[ref].customized_copy(indices=reidx_ops[new_ops[ref]].apply(arrays[ref].indices())).map_to_asu()
-
-    cc = calc_cc(tmp, tmp2)
-    if cc==cc: return cc
-    return None
-# work_local()
-
 class KabschSelectiveBreeding(ReindexResolver):
     """
     Reference: W. Kabsch "Processing of X-ray snapshots from crystals in random orientations" Acta Cryst. (2014). D70, 2204-2216
@@ -310,8 +299,8 @@ class KabschSelectiveBreeding(ReindexResolver):
     If I understand correctly...
     """
 
-    def __init__(self, xac_files=None, stream_files=None, space_group=None, d_min=3, min_ios=3, nproc=1, max_delta=5, from_p1=False, log_out=null_out()):
-        ReindexResolver.__init__(self, xac_files, stream_files, space_group, d_min, min_ios, nproc, max_delta, log_out)
+    def __init__(self, xac_files=None, stream_files=None, space_group=None, d_min=3, min_ios=3, nproc=1, max_delta=5, from_p1=False, log_out=null_out(), use_cache=False):
+        ReindexResolver.__init__(self, xac_files, stream_files, space_group, d_min, min_ios, nproc, max_delta, log_out, use_cache)
         self._final_cc_means = [] # list of [(op_index, cc_mean), ...]
         self._reidx_ops = []
         if xac_files:
@@ -336,71 +325,70 @@ class KabschSelectiveBreeding(ReindexResolver):
         reidx_ops.sort(key=lambda x: not x.is_identity_op()) # identity op to first
         self._reidx_ops = reidx_ops
 
-        if self.nproc > 1:
-            # consumes much memory.. (but no much benefits)
-            reindexed_arrays = [arrays]
-            for op in reidx_ops[1:]:
-                reindexed_arrays.append([x.customized_copy(indices=op.apply(x.indices())).map_to_asu() for x in arrays])
+        # CCs between (dataset, operator) pairs: ccmat[i,j,k,m] = CC(op_j(array_i), op_m(array_k)).
+        # The full matrix is never kept; only the sums over k of the current assignments are, and
+        # ccmat[:,:,i,m] is calculated when dataset i changes the operator (ccmat is symmetric).
+        N, nops = len(arrays), len(reidx_ops)
+        reindexed_arrays = []
+        for a in arrays:
+            for op in reidx_ops:
+                if op.is_identity_op(): reindexed_arrays.append(a)
+                else: reindexed_arrays.append(a.customized_copy(indices=op.apply(a.indices())).map_to_asu())
+
+        pcc = PairwiseCC.from_miller_arrays(reindexed_arrays)
+        del reindexed_arrays
+
+        def cc_rows(i0, i1):
+            """ccmat[r//nops, r%nops, :, :] for rows r=i0..i1-1, as (rows, N, nops) with 0 for invalid, and validity"""
+            cc = pcc.calc_block(i0, i1)[0].reshape(i1-i0, N, nops)
+            rows = numpy.arange(i0, i1)
+            cc[rows-i0, rows//nops, :] = float("nan") # exclude itself
+            valid = ~numpy.isnan(cc)
+            cc[~valid] = 0
+            return cc, valid
+        # cc_rows()
+
+        def initial_sums(x):
+            cc, valid = cc_rows(*x)
+            return cc[:,:,0].sum(axis=1), valid[:,:,0].sum(axis=1)
+        # initial_sums()
+
+        print("Calculating CCs for all pairs of %d datasets x %d operators.." % (N, nops), file=self.log_out)
+        bsize = max(1, min(5000000 // (N*nops), -(-N*nops // self.nproc)))
+        blocks = [(i, min(i+bsize, N*nops)) for i in range(0, N*nops, bsize)]
+        if self.nproc > 1 and len(blocks) > 1:
+            sums = easy_mp.pool_map(fixed_func=initial_sums, args=blocks, processes=self.nproc)
         else:
-            reindexed_arrays = None
+            sums = [initial_sums(x) for x in blocks]
+        print("", file=self.log_out)
 
         old_ops = [0 for x in range(len(arrays))]
         new_ops = [0 for x in range(len(arrays))]
 
-        global kabsch_selective_breeding_worker_dict
-        kabsch_selective_breeding_worker_dict = dict(nproc=self.nproc, arrays=arrays,
-                                                     reindexed_arrays=reindexed_arrays,
-                                                     reidx_ops=reidx_ops) # constants during cycles
-        pool = multiprocessing.Pool(self.nproc)
+        # Running sums and counts of valid CCs against the current assignments of other datasets
+        # cc_sums[i,j] = sum_k ccmat[i,j,k,new_ops[k]]
+        cc_sums = numpy.concatenate([x[0] for x in sums]).reshape(N, nops)
+        cc_counts = numpy.concatenate([x[1] for x in sums]).reshape(N, nops)
+        del sums
+
         for ncycle in range(max_cycle):
             #new_ops = copy.copy(old_ops) # doesn't matter
             self._final_cc_means = []
 
             for i in range(len(arrays)):
-                cc_means = []
-                a = arrays[i]
-                #ttt=time.time()
-                for j, op in enumerate(reidx_ops):
-                    cc_list = []
-                    if self.nproc > 1:
-                        tmp = reindexed_arrays[j][i]
-                    else:
-                        if op.is_identity_op(): tmp = a
-                        else: tmp = a.customized_copy(indices=op.apply(a.indices())).map_to_asu()
-                    
-                    """
-                    def work_local(ref): # XXX This function is very slow when nproc>1...
-                        if ref==i: return None
-
-                        if self.nproc > 1:
-                            tmp2 = reindexed_arrays[new_ops[ref]][ref]
-                        else:                                
-                            if reidx_ops[new_ops[ref]].is_identity_op(): tmp2 = arrays[ref]
-                            else: tmp2 = arrays[ref].customized_copy(indices=reidx_ops[new_ops[ref]].apply(arrays[ref].indices())).map_to_asu()
-
-                        cc = calc_cc(tmp, tmp2)
-                        if cc==cc: return cc
-                        return None
-                    # work_local()
-
-                    cc_list = easy_mp.pool_map(fixed_func=work_local,
-                                               args=range(len(arrays)),
-                                               processes=self.nproc)
-                    """
-                    cc_list = pool.map(kabsch_selective_breeding_worker,
-                                       ((k, i, tmp, new_ops) for k in range(len(arrays))))
-                    cc_list = [x for x in cc_list if x is not None]
-
-                    if len(cc_list) > 0:
-                        cc_means.append((j, sum(cc_list)/len(cc_list)))
-                        #print  >>self.log_out, "DEBUG:", i, j, cc_list, cc_means[-1]
+                cc_means = [(j, float(cc_sums[i,j]/cc_counts[i,j])) for j in range(nops) if cc_counts[i,j] > 0]
 
                 if cc_means:
                     max_el = max(cc_means, key=lambda x:x[1])
                     print("%3d %s" % (i, " ".join(["%s%d:% .4f" % ("*" if x[0]==max_el[0] else " ", x[0], x[1]) for x in cc_means])), file=self.log_out)
                     self._final_cc_means.append(cc_means)
-                    #print "%.3f sec" % (time.time()-ttt)
-                    new_ops[i] = max_el[0]
+                    if max_el[0] != new_ops[i]:
+                        # only sums related to dataset i need to be updated
+                        cc_new, valid_new = cc_rows(i*nops+max_el[0], i*nops+max_el[0]+1)
+                        cc_old, valid_old = cc_rows(i*nops+new_ops[i], i*nops+new_ops[i]+1)
+                        cc_sums += cc_new[0] - cc_old[0]
+                        cc_counts += valid_new[0].astype(int) - valid_old[0]
+                        new_ops[i] = max_el[0]
                 else:
                     print("%3d %s Error! cannot calculate CC" % (i, " ".join([" %d:    nan" % x for x in range(len(reidx_ops))])), file=self.log_out)
                     # XXX append something to self._final_cc_means?
@@ -423,8 +411,8 @@ class KabschSelectiveBreeding(ReindexResolver):
 # class KabschSelectiveBreeding
 
 class ReferenceBased(ReindexResolver):
-    def __init__(self, xac_files=None, stream_files=None, space_group=None, ref_array=None, d_min=3, min_ios=3,  nproc=1, max_delta=5, log_out=null_out()):
-        ReindexResolver.__init__(self, xac_files, stream_files, space_group, d_min, min_ios, nproc, max_delta, log_out)
+    def __init__(self, xac_files=None, stream_files=None, space_group=None, ref_array=None, d_min=3, min_ios=3,  nproc=1, max_delta=5, log_out=null_out(), use_cache=False):
+        ReindexResolver.__init__(self, xac_files, stream_files, space_group, d_min, min_ios, nproc, max_delta, log_out, use_cache)
         assert ref_array
         if xac_files:
             self.read_xac_files()
@@ -475,8 +463,8 @@ class ReferenceBased(ReindexResolver):
 # class ReferenceBased
 
 class BrehmDiederichs(ReindexResolver):
-    def __init__(self, xac_files=None, stream_files=None, space_group=None, d_min=3, min_ios=3, nproc=1, max_delta=5, log_out=null_out()):
-        ReindexResolver.__init__(self, xac_files, stream_files, space_group, d_min, min_ios, nproc, max_delta, log_out)
+    def __init__(self, xac_files=None, stream_files=None, space_group=None, d_min=3, min_ios=3, nproc=1, max_delta=5, log_out=null_out(), use_cache=False):
+        ReindexResolver.__init__(self, xac_files, stream_files, space_group, d_min, min_ios, nproc, max_delta, log_out, use_cache)
         if xac_files:
             self.read_xac_files()
         else:
@@ -14,9 +14,14 @@ from yamtbx.dataproc.xds.command_line import xds2mtz
 from yamtbx.dataproc.xds import modify_xdsinp, check_xds_version
 from yamtbx.dataproc.pointless import Pointless
 from yamtbx.dataproc import blend_lcv
+from yamtbx.dataproc.auto import pairwise_cc
 from yamtbx.dataproc.auto.resolution_cutoff import estimate_resolution_based_on_cc_half, initial_estimate_byfit_cchalf
 from yamtbx import util
 from yamtbx.util import batchjob
+from cctbx import crystal
+from cctbx import miller
+from cctbx import sgtbx
+from cctbx.array_family import flex
 
 import collections
 import shutil
@@ -36,11 +41,97 @@ def make_bin_str(d_min, d_max, nbins=9):
     return "RESOLUTION_SHELLS= %s\n" % rshells
 # make_bin_str()
 
+class XdsAsciiInfo(object):
+    """
+    Symmetry, oscillation range and frame range of XDS_ASCII files.
+    Each file is read only once as long as its size and mtime are unchanged.
+    Data lines are read only when the frame range is requested.
+    """
+    def __init__(self):
+        self._cache = {} # {filename: [stamp, XDS_ASCII (header only), frame_range or None, {asu keys}]}
+    # __init__()
+
+    def _get(self, filename):
+        st = os.stat(filename)
+        stamp = (st.st_size, st.st_mtime)
+        c = self._cache.get(filename)
+        if c is None or c[0] != stamp:
+            c = self._cache[filename] = [stamp, XDS_ASCII(filename, read_data=False), None, {}]
+        return c
+    # _get()
+
+    def asu_keys(self, filename, space_group, anomalous_flag=False, min_ios=None, d_min=None, d_max=None):
+        """
+        Unique Miller index keys (pairwise_cc.miller_index_keys()) of reflections mapped to ASU.
+        Only reflections with I/sigma >= min_ios within d_max..d_min are included (rejected ones are never).
+        """
+        c = self._get(filename)
+        key = (space_group.type().number(), bool(anomalous_flag), min_ios, d_min, d_max)
+        if key not in c[3]:
+            data = c[1].read_data_columns(["indices", "iobs", "sigma_iobs"])
+            sel = data["sigma_iobs"] > 0
+            if min_ios is not None:
+                sel &= data["iobs"] >= min_ios * data["sigma_iobs"]
+            symm = crystal.symmetry(unit_cell=c[1].symm.unit_cell(), space_group=space_group)
+            ms = miller.set(symm, flex.miller_index(data["indices"][sel].tolist()), bool(anomalous_flag)).map_to_asu()
+            if (d_min, d_max).count(None) < 2:
+                ms = ms.resolution_filter(d_max=d_max if d_max is not None else 0, d_min=d_min if d_min is not None else 0)
+            c[3][key] = numpy.unique(pairwise_cc.miller_index_keys(ms.indices()))
+        return c[3][key]
+    # asu_keys()
+
+    def symm(self, filename): return self._get(filename)[1].symm
+    def osc_range(self, filename): return self._get(filename)[1].osc_range
+
+    def frame_range(self, filename):
+        """(min, max) frame numbers. (inf, -inf) if no reflections."""
+        c = self._get(filename)
+        if c[2] is None: c[2] = c[1].get_frame_range()
+        return c[2]
+    # frame_range()
+
+    def has_reflections(self, filename): return self.frame_range(filename)[1] > -float("inf")
+# class XdsAsciiInfo
+
+xds_ascii_info = XdsAsciiInfo() # shared by all XscaleCycles in the process
+
+def common_reflection_graph(keys_list, min_common_refs=10):
+    """
+    Graph of datasets (nodes 0..N-1) connected when they share more than min_common_refs reflections,
+    the same criterion as xscalelp.construct_data_graph() but known before running XSCALE.
+    """
+    ncommon = pairwise_cc.common_reflection_counts(keys_list)
+    G = nx.Graph()
+    G.add_nodes_from(range(len(keys_list)))
+    i, j = numpy.nonzero(numpy.triu(ncommon > min_common_refs, 1))
+    G.add_edges_from(zip(i.tolist(), j.tolist()))
+    return G
+# common_reflection_graph()
+
+def select_mergeable(xds_ascii_files, space_group, anomalous_flag=False, min_ios=None, d_min=None, d_max=None,
+                     required_idx=None, min_common_refs=10, file_info=None):
+    """
+    Pick the connected component of the common reflection graph, which contains required_idx if given,
+    otherwise the largest one. Returns (keep_idxes, drop_idxes).
+    """
+    if file_info is None: file_info = xds_ascii_info
+    keys_list = [file_info.asu_keys(f, space_group, anomalous_flag, min_ios, d_min, d_max) for f in xds_ascii_files]
+    G = common_reflection_graph(keys_list, min_common_refs)
+    comps = sorted(nx.connected_components(G), key=lambda x: len(x))
+    keep = comps[-1]
+    if required_idx is not None:
+        keep = [x for x in comps if required_idx in x][0]
+    keep = sorted(keep)
+    return keep, [x for x in range(len(xds_ascii_files)) if x not in keep]
+# select_mergeable()
+
 class XscaleCycles(object):
     def __init__(self, workdir, anomalous_flag, d_min, d_max,
                  reject_method, reject_params, xscale_params, res_params,
-                 reference_file, space_group, ref_mtz, out, batch_params, nproc=1):
+                 reference_file, space_group, ref_mtz, out, batch_params, nproc=1,
+                 file_info=None):
         self.reference_file = None
+        self.file_info = file_info if file_info is not None else xds_ascii_info
         self._counter = 0
         self.workdir_org = workdir
         self.anomalous_flag = anomalous_flag
@@ -56,7 +147,8 @@ class XscaleCycles(object):
         self.nproc = nproc
         self.nproc_each = batch_params.nproc_each
         if batch_params.engine == "sge": self.batchjobs = batchjob.SGE(pe_name=batch_params.sge_pe_name)
-        elif batch_params.engine == "sh": self.batchjobs = batchjob.ExecLocal(max_parallel=batch_params.sh_max_jobs)
+        elif batch_params.engine == "sh": self.batchjobs = batchjob.ExecLocal(max_parallel=batch_params.sh_max_jobs,
+                                                                                   max_cores=getattr(batch_params, "sh_max_cores", None))
         self.all_data_root = None # the root directory for all data
         self.altfile = {} # Modified files
         self.cell_info_at_cycles = {}
@@ -119,16 +211,12 @@ class XscaleCycles(object):
         cells = []
         sg = None
         for f in files:
+            f = self.altfile.get(f, f)
             if not os.path.isfile(f):
                 continue
-            for l in open(f):
-                if l.startswith("!SPACE_GROUP_NUMBER="):
-                    sg = l[l.index("=")+1:].strip()
-                if l.startswith("!UNIT_CELL_CONSTANTS="):
-                    cell = list(map(float, l[l.index("=")+1:].split()))
-                    assert len(cell) == 6
-                    cells.append(cell)
-                    break
+            symm = self.file_info.symm(f)
+            sg = symm.space_group_info().type().number()
+            cells.append(symm.unit_cell().parameters())
 
         if self.space_group is not None:
             sg = self.space_group.type().number()
@@ -278,11 +366,69 @@ class XscaleCycles(object):
     
     def current_working_dir(self): return self.workdir
 
+    def check_inputs(self, xds_ascii_files):
+        """
+        Find files that would make XSCALE stop with an error (unreadable or no reflections),
+        so that they are excluded before running XSCALE.
+        Returns dict of index -> reason.
+        """
+        bad = {}
+        for i, f in enumerate(xds_ascii_files):
+            f = self.altfile.get(f, f)
+            try:
+                if not self.file_info.has_reflections(f): bad[i] = "no_refls"
+            except:
+                print("Error in reading %s" % f, file=self.out)
+                print(traceback.format_exc(), file=self.out)
+                bad[i] = "unreadable"
+        return bad
+    # check_inputs()
+
     def run_cycle(self, xds_ascii_files, reference_idx=None):
+        bad = self.check_inputs(xds_ascii_files)
+        remove_idxes = self.check_remove_list(list(bad.keys()))
+        if remove_idxes:
+            print("DEBUG:: %d files are excluded before running xscale." % len(remove_idxes), file=self.out)
+            for i in sorted(remove_idxes):
+                print(" %.3d %s (%s)" % (i, xds_ascii_files[i], bad[i]), file=self.out)
+                self.removed_files.append(xds_ascii_files[i])
+                self.removed_reason[xds_ascii_files[i]] = bad[i]
+            if reference_idx in remove_idxes: reference_idx = None
+            elif reference_idx is not None:
+                reference_idx -= len([x for x in remove_idxes if x < reference_idx])
+            xds_ascii_files = [f for i, f in enumerate(xds_ascii_files) if i not in remove_idxes]
+
         if len(xds_ascii_files) == 0:
             print("Error: no files given.", file=self.out)
             return
 
+        # Datasets not connected by common reflections would make xscale stop
+        if len(xds_ascii_files) > 1:
+            try:
+                files = [self.altfile.get(f, f) for f in xds_ascii_files]
+                sg = self.space_group
+                if sg is None: sg = self.file_info.symm(files[0]).space_group()
+                keep_idxes, drop_idxes = select_mergeable(files, sg, self.anomalous_flag,
+                                                          min_ios=self.xscale_params.min_i_over_sigma,
+                                                          d_min=self.d_min, d_max=self.d_max,
+                                                          required_idx=0 if self.reference_file else None,
+                                                          file_info=self.file_info)
+            except:
+                print("Error in checking common reflections. Proceeding with all files.", file=self.out)
+                print(traceback.format_exc(), file=self.out)
+                drop_idxes = []
+
+            if drop_idxes:
+                print("DEBUG:: %d files are not connected by common reflections and excluded." % len(drop_idxes), file=self.out)
+                for i in drop_idxes:
+                    print(" %.3d %s" % (i, xds_ascii_files[i]), file=self.out)
+                    self.removed_files.append(xds_ascii_files[i])
+                    self.removed_reason[xds_ascii_files[i]] = "no_common_refls"
+                if reference_idx in drop_idxes: reference_idx = None
+                elif reference_idx is not None:
+                    reference_idx -= len([x for x in drop_idxes if x < reference_idx])
+                xds_ascii_files = [xds_ascii_files[i] for i in keep_idxes]
+
         xscale_inp = os.path.join(self.workdir, "XSCALE.INP")
         xscale_lp = os.path.join(self.workdir, "XSCALE.LP")
 
@@ -311,9 +457,8 @@ class XscaleCycles(object):
             if len(self.xscale_params.corrections) != 3:
                 inp_out.write("  CORRECTIONS= %s\n" % " ".join(self.xscale_params.corrections))
             if (self.xscale_params.frames_per_batch, self.xscale_params.degrees_per_batch).count(None) < 2:
-                xactmp = XDS_ASCII(f, read_data=False)
-                frame_range = xactmp.get_frame_range()
-                osc_range = xactmp.osc_range
+                frame_range = self.file_info.frame_range(f)
+                osc_range = self.file_info.osc_range(f)
                 nframes = frame_range[1] - frame_range[0] + 1
                 if self.xscale_params.frames_per_batch is not None:
                     nbatch = int(numpy.ceil(nframes / self.xscale_params.frames_per_batch))
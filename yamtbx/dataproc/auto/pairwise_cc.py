@@ -0,0 +1,175 @@
+"""
+Pairwise correlation coefficients between many datasets, all at once.
+
+All datasets are mapped onto one global index of Miller indices (the union of
+indices of all datasets), and intensities are stored in a sparse
+dataset x reflection matrix. CCs on common reflections and the numbers of common
+reflections for all pairs are then calculated by sparse matrix products, block by block.
+
+(c) RIKEN 2026. All rights reserved.
+Author: Keitaro Yamashita
+
+This software is released under the new BSD License; see LICENSE.
+"""
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from libtbx import easy_mp
+import numpy
+import scipy.sparse
+
+_hkl_offset = 1 << 20
+
+def miller_index_keys(indices):
+    """
+    Encode Miller indices (flex.miller_index or numpy array of shape (n,3)) as int64 keys.
+    """
+    if not isinstance(indices, numpy.ndarray):
+        indices = indices.as_vec3_double().as_numpy_array()
+    hkl = numpy.asarray(indices, dtype=numpy.int64).reshape(-1, 3) + _hkl_offset
+    return (hkl[:,0] << 42) | (hkl[:,1] << 21) | hkl[:,2]
+# miller_index_keys()
+
+def keys_as_miller_indices(keys):
+    keys = numpy.asarray(keys, dtype=numpy.int64)
+    mask = (1 << 21) - 1
+    return numpy.column_stack(((keys >> 42) & mask, (keys >> 21) & mask, keys & mask)) - _hkl_offset
+# keys_as_miller_indices()
+
+class GlobalIndex(object):
+    """
+    Union of Miller indices of all datasets. Indices should be already in the same ASU.
+    self.columns[i] is the column numbers of dataset i in the global index.
+    """
+    def __init__(self, keys_list):
+        self.keys = numpy.unique(numpy.concatenate(keys_list)) if keys_list else numpy.zeros(0, dtype=numpy.int64)
+        self.columns = [numpy.searchsorted(self.keys, k) for k in keys_list]
+    # __init__()
+
+    def size(self): return self.keys.size
+
+    def incidence_matrix(self, dtype=numpy.float64):
+        """sparse (dataset x reflection) matrix of ones where reflection exists"""
+        return self.value_matrix([numpy.ones(c.size, dtype=dtype) for c in self.columns])
+    # incidence_matrix()
+
+    def value_matrix(self, values_list):
+        assert len(values_list) == len(self.columns)
+        rows = numpy.concatenate([numpy.full(c.size, i, dtype=numpy.int64) for i, c in enumerate(self.columns)]) if self.columns else numpy.zeros(0, dtype=numpy.int64)
+        cols = numpy.concatenate(self.columns) if self.columns else numpy.zeros(0, dtype=numpy.int64)
+        vals = numpy.concatenate(values_list) if values_list else numpy.zeros(0)
+        return scipy.sparse.csr_matrix((vals, (rows, cols)), shape=(len(self.columns), self.size()))
+    # value_matrix()
+# class GlobalIndex
+
+def common_reflection_counts(keys_list, max_block_elements=5000000):
+    """
+    Numbers of common reflections for all pairs of datasets, as (N, N) int matrix.
+    keys_list: list of unique Miller index keys (see miller_index_keys()) of each dataset
+    """
+    B = GlobalIndex(keys_list).incidence_matrix(dtype=numpy.int32)
+    BT = B.T.tocsc()
+    N = B.shape[0]
+    bsize = max(1, max_block_elements // max(N, 1))
+    ret = numpy.empty((N, N), dtype=numpy.int32)
+    for i in range(0, N, bsize):
+        ret[i:i+bsize] = B[i:i+bsize].dot(BT).toarray()
+    return ret
+# common_reflection_counts()
+
+class PairwiseCC(object):
+    """
+    keys_list: list of Miller index keys (see miller_index_keys()) of each dataset
+    data_list: list of intensities (numpy arrays) of each dataset
+
+    Each dataset must not have duplicated indices (merged data).
+    """
+    def __init__(self, keys_list, data_list):
+        assert len(keys_list) == len(data_list)
+        self.gindex = GlobalIndex(keys_list)
+
+        # CC is invariant against shift and scale of each dataset.
+        # Standardization here just reduces numerical errors in the sums below.
+        std_list = []
+        for d in data_list:
+            d = numpy.asarray(d, dtype=numpy.float64)
+            if d.size > 0:
+                sd = d.std()
+                d = (d - d.mean()) / (sd if sd > 0 else 1.)
+            std_list.append(d)
+
+        self.X = self.gindex.value_matrix(std_list)
+        self.X2 = self.X.multiply(self.X).tocsr()
+        self.B = self.gindex.incidence_matrix()
+        self.XT, self.X2T, self.BT = self.X.T.tocsc(), self.X2.T.tocsc(), self.B.T.tocsc()
+    # __init__()
+
+    @classmethod
+    def from_miller_arrays(cls, arrays):
+        return cls([miller_index_keys(a.indices()) for a in arrays],
+                   [a.data().as_numpy_array() for a in arrays])
+    # from_miller_arrays()
+
+    def n_datasets(self): return self.X.shape[0]
+
+    def calc_block(self, i0, i1):
+        """
+        CC and number of common reflections between datasets i0..i1-1 and all datasets.
+        Returns (cc, nref) of shape (i1-i0, N). cc is NaN if not defined.
+        """
+        Xb, X2b, Bb = self.X[i0:i1], self.X2[i0:i1], self.B[i0:i1]
+
+        n = Bb.dot(self.BT).toarray()
+        sxy = Xb.dot(self.XT).toarray()
+        sx = Xb.dot(self.BT).toarray()
+        sy = Bb.dot(self.XT).toarray()
+        sxx = X2b.dot(self.BT).toarray()
+        syy = Bb.dot(self.X2T).toarray()
+
+        cov = n * sxy - sx * sy
+        vx = n * sxx - sx**2
+        vy = n * syy - sy**2
+        del sxy, sxx, syy
+
+        # relative tolerance for constant values (the values are standardized)
+        tol = 1.e-10 * n**2
+        ok = (n > 1) & (vx > tol) & (vy > tol)
+        cc = numpy.full(n.shape, float("nan"))
+        cc[ok] = cov[ok] / numpy.sqrt(vx[ok] * vy[ok])
+
+        return cc, n.astype(numpy.int64)
+    # calc_block()
+
+    def calc_all(self, nproc=1, max_block_elements=5000000, dtype=numpy.float64, with_nref=True):
+        """
+        Returns (cc, nref) matrices of shape (N, N), or only cc if with_nref=False.
+        Blocks of rows are calculated in parallel when nproc > 1.
+        dtype=numpy.float32 can be used to save memory when N is large.
+        """
+        N = self.n_datasets()
+        bsize = max(1, min(max_block_elements // max(N, 1), -(-N // max(nproc, 1))))
+        blocks = [(i, min(i+bsize, N)) for i in range(0, N, bsize)]
+
+        def work(x):
+            cc, n = self.calc_block(*x)
+            return cc.astype(dtype), (n if with_nref else None)
+        # work()
+
+        if nproc > 1 and len(blocks) > 1:
+            results = easy_mp.pool_map(fixed_func=work,
+                                       args=blocks,
+                                       processes=nproc)
+        else:
+            results = [work(x) for x in blocks]
+
+        cc = numpy.empty((N, N), dtype=dtype)
+        nref = numpy.empty((N, N), dtype=numpy.int64) if with_nref else None
+        for (i0, i1), (c, n) in zip(blocks, results):
+            cc[i0:i1] = c
+            if with_nref: nref[i0:i1] = n
+
+        if with_nref: return cc, nref
+        return cc
+    # calc_all()
+# class PairwiseCC
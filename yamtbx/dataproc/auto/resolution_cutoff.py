@@ -12,6 +12,7 @@ from libtbx import slots_getstate_setstate
 from iotbx import merging_statistics
 from libtbx.utils import null_out
 from libtbx import adopt_init_args
+from yamtbx.dataproc.auto.pairwise_cc import miller_index_keys
 import numpy
 
 def fun_ed_aimless(s, d0, r):
@@ -64,24 +65,107 @@ def fit_curve_for_cchalf(s2_list, cc_list, log_out, verbose=True):
     return lsq.x
 # fit_curve_for_cchalf()
 
-def initial_estimate_byfit_cchalf(i_obs, cc_half_min, anomalous_flag, log_out):
+class CCHalfShells(object):
+    """
+    CC1/2 in any resolution shell without re-merging.
+
+    Observations (sigma > 0) are grouped by unique reflection and randomly split into two halves
+    only once. Unique reflections observed at least twice are sorted by d*^2, and cumulative sums
+    of the (1/sigma^2 weighted) half-set means are kept, so that CC1/2 of a shell is calculated
+    from differences of the sums.
+    """
+    def __init__(self, keys, d_star_sq, data, sigmas=None, seed=0):
+        keys = numpy.asarray(keys)
+        d_star_sq = numpy.asarray(d_star_sq, dtype=numpy.float64)
+        data = numpy.asarray(data, dtype=numpy.float64)
+        sigmas = numpy.ones(data.size) if sigmas is None else numpy.asarray(sigmas, dtype=numpy.float64)
+
+        # binning uses the range of all data (as setup_binner() does)
+        self.d_star_sq_min = d_star_sq.min() if d_star_sq.size > 0 else 0.
+        self.d_star_sq_max = d_star_sq.max() if d_star_sq.size > 0 else 0.
+
+        sel = sigmas > 0
+        keys, d_star_sq, data, weights = keys[sel], d_star_sq[sel], data[sel], 1./sigmas[sel]**2
+        uniq, inv = numpy.unique(keys, return_inverse=True)
+        nuniq = uniq.size
+        counts = numpy.bincount(inv, minlength=nuniq)
+
+        # random rank of observations in each reflection. first half (floor(n/2)) goes to the first set
+        order = numpy.lexsort((numpy.random.RandomState(seed).random_sample(inv.size), inv))
+        starts = numpy.cumsum(counts) - counts
+        rank = numpy.empty(inv.size, dtype=numpy.int64)
+        rank[order] = numpy.arange(inv.size) - starts[inv[order]]
+        first = rank < (counts // 2)[inv]
+
+        def half_mean(s):
+            sw = numpy.bincount(inv[s], weights=weights[s], minlength=nuniq)
+            swx = numpy.bincount(inv[s], weights=(weights*data)[s], minlength=nuniq)
+            return swx / numpy.where(sw > 0, sw, 1.)
+        # half_mean()
+
+        x, y = half_mean(first), half_mean(~first)
+        s2 = numpy.bincount(inv, weights=d_star_sq, minlength=nuniq) / numpy.maximum(counts, 1)
+
+        use = counts >= 2
+        x, y, s2 = x[use], y[use], s2[use]
+        perm = numpy.argsort(s2, kind="mergesort")
+        x, y, self.s2 = x[perm], y[perm], s2[perm]
+
+        # CC is invariant against the same shift and scale of x and y. This reduces cancellation errors.
+        if x.size > 0:
+            mean = (x.mean() + y.mean()) / 2.
+            sd = numpy.sqrt((x.var() + y.var()) / 2.)
+            x, y = (x - mean) / (sd if sd > 0 else 1.), (y - mean) / (sd if sd > 0 else 1.)
+
+        sums = numpy.vstack((numpy.ones(x.size), x, y, x*x, y*y, x*y))
+        self._cumsum = numpy.hstack((numpy.zeros((6, 1)), numpy.cumsum(sums, axis=1)))
+    # __init__()
+
+    @classmethod
+    def from_miller_array(cls, i_obs, anomalous=False, seed=0):
+        """i_obs: unmerged intensity array"""
+        asu = i_obs.customized_copy(anomalous_flag=anomalous).map_to_asu()
+        sigmas = asu.sigmas().as_numpy_array() if asu.sigmas() is not None else None
+        return cls(miller_index_keys(asu.indices()), asu.d_star_sq().data().as_numpy_array(),
+                   asu.data().as_numpy_array(), sigmas, seed)
+    # from_miller_array()
+
+    def cc_in_range(self, d_star_sq_lo, d_star_sq_hi):
+        """CC1/2 of reflections d_star_sq_lo <= d*^2 <= d_star_sq_hi. NaN if not defined."""
+        i0 = numpy.searchsorted(self.s2, d_star_sq_lo, "left")
+        i1 = numpy.searchsorted(self.s2, d_star_sq_hi, "right")
+        n, sx, sy, sxx, syy, sxy = self._cumsum[:, i1] - self._cumsum[:, i0]
+        if n < 2: return float("nan")
+        vx, vy = n*sxx - sx**2, n*syy - sy**2
+        if vx <= 1.e-10*n**2 or vy <= 1.e-10*n**2: return float("nan")
+        return (n*sxy - sx*sy) / numpy.sqrt(vx*vy)
+    # cc_in_range()
+
+    def bin_ranges(self, n_bins, d_min=None):
+        """d*^2 limits of bins of equal reciprocal volume, as setup_binner(d_min=d_min, n_bins=n_bins)"""
+        s3_lo = self.d_star_sq_min**1.5
+        s3_hi = (1./d_min**2 if d_min else self.d_star_sq_max)**1.5
+        limits = numpy.linspace(s3_lo, s3_hi, n_bins+1)**(2./3.)
+        return list(zip(limits[:-1], limits[1:]))
+    # bin_ranges()
+
+    def cc_outer_shell(self, d_min, n_bins):
+        return self.cc_in_range(*self.bin_ranges(n_bins, d_min)[-1])
+    # cc_outer_shell()
+# class CCHalfShells
+
+def initial_estimate_byfit_cchalf(i_obs, cc_half_min, anomalous_flag, log_out, shells=None):
+    """shells: CCHalfShells of i_obs (with the same anomalous_flag) if already available"""
     # Up to 200 bins. If few reflections, 50 reflections per bin. At least 9 shells.
     n_bins = max(min(int(i_obs.size()/50. + .5), 200), 9)
     log_out.write("Using %d bins for initial estimate\n" % n_bins)
 
-    i_obs.setup_binner(n_bins=n_bins)
-    bins = []
+    if shells is None: shells = CCHalfShells.from_miller_array(i_obs, anomalous_flag)
 
     s_list, cc_list = [], []
-    for bin in i_obs.binner().range_used():
-      unmerged = i_obs.select(i_obs.binner().selection(bin))
-      try:
-        bin_stats = merging_statistics.merging_stats(unmerged,
-                                                     anomalous=anomalous_flag)
-        s_list.append(1./bin_stats.d_min**2)
-        cc_list.append(bin_stats.cc_one_half)
-      except RuntimeError: # complains that no reflections left after sigma-filtering.
-        continue
+    for s2_lo, s2_hi in shells.bin_ranges(n_bins):
+      s_list.append(s2_hi)
+      cc_list.append(shells.cc_in_range(s2_lo, s2_hi))
 
     d0, r = fit_curve_for_cchalf(s_list, cc_list, log_out)
     shells_and_fit = (s_list, cc_list, (d0, r))
@@ -96,7 +180,9 @@ class estimate_resolution_based_on_cc_half(object):
     adopt_init_args(self, locals())
     log_out.write("estimate_resolution_based_on_cc_half: cc_half_min=%.4f, cc_half_tol=%.4f n_bins=%d\n" % (cc_half_min, cc_half_tol, n_bins))
     self.d_min_data = i_obs.d_min()
+    self.d_max_data = i_obs.d_max_min()[0] if i_obs.size() > 0 else None
     self.shells_and_fit = ()
+    self.shells = CCHalfShells.from_miller_array(i_obs, anomalous=False) if i_obs.size() > 0 else None
     self.d_min, self.cc_at_d_min = self.estimate_resolution()
   # __init__()
 
@@ -127,9 +213,7 @@ class estimate_resolution_based_on_cc_half(object):
   # show_plot()
 
   def cc_outer_shell(self, d_min):
-    binner = self.i_obs.setup_binner(d_min=d_min, n_bins=self.n_bins)
-    bin_stats = merging_statistics.merging_stats(self.i_obs.select(binner.selection(binner.range_used()[-1])), anomalous=False)
-    return bin_stats.cc_one_half
+    return self.shells.cc_outer_shell(d_min, self.n_bins)
   # cc_outer_shell()
 
   def estimate_resolution(self):
@@ -137,10 +221,14 @@ class estimate_resolution_based_on_cc_half(object):
       self.log_out.write("No reflections.\n")
       return None, None
 
-    d_min, self.shells_and_fit = initial_estimate_byfit_cchalf(self.i_obs, self.cc_half_min, self.anomalous_flag, self.log_out)
+    d_min, self.shells_and_fit = initial_estimate_byfit_cchalf(self.i_obs, self.cc_half_min, self.anomalous_flag, self.log_out,
+                                                               shells=None if self.anomalous_flag else self.shells)
     d_min = float("%.2f"%d_min)
-    
-    if d_min < self.d_min_data:
+
+    if d_min != d_min:
+      self.log_out.write("Warning: Initial estimate failed. Starting from the limit of data (%.4f A)\n" % self.d_min_data)
+      d_min = self.d_min_data
+    elif d_min < self.d_min_data:
       self.log_out.write("Warning: Initial estimate is higher than the limit of data (%.4f A < %.4f A)\n" %(d_min, self.d_min_data))
       d_min = self.d_min_data
 
@@ -150,25 +238,29 @@ class estimate_resolution_based_on_cc_half(object):
     if cc >= self.cc_half_min and abs(cc - self.cc_half_min) < self.cc_half_tol:
       return d_min, cc
 
+    # Bracket the cutoff with doubling steps. lower_bound: CC1/2 < cc_half_min, upper_bound: CC1/2 >= cc_half_min
+    step = .01
     if cc > self.cc_half_min + self.cc_half_tol:
-      upper_bound = d_min
-      lower_bound = d_min
-
-      for i in range(1,300):
-        if d_min-.01*i <= self.d_min_data: break
-        lower_bound = d_min-.01*i
+      upper_bound = lower_bound = d_min
+      while lower_bound > self.d_min_data:
+        lower_bound = max(d_min - step, self.d_min_data)
         cc = self.cc_outer_shell(lower_bound)
-        self.log_out.write("  CC1/2= %.4f at %.4f A\n" %(cc, d_min-.01*i))
-        if cc < self.cc_half_min:
-          break
+        self.log_out.write("  CC1/2= %.4f at %.4f A\n" %(cc, lower_bound))
+        if cc < self.cc_half_min: break
+        upper_bound = lower_bound
+        step *= 2
+      else:
+        self.log_out.write("  CC1/2 >= %.4f up to the limit of data\n" % self.cc_half_min)
+        return lower_bound, cc
     else:
-      lower_bound = d_min
-      for i in range(1,300):
-        upper_bound = d_min+.01*i
+      upper_bound = lower_bound = d_min
+      while upper_bound < self.d_max_data:
+        upper_bound = min(d_min + step, self.d_max_data)
         cc = self.cc_outer_shell(upper_bound)
-        self.log_out.write("  CC1/2= %.4f at %.4f A\n" %(cc, d_min+.1*i))
-        if cc >= self.cc_half_min:
-          break
+        self.log_out.write("  CC1/2= %.4f at %.4f A\n" %(cc, upper_bound))
+        if cc >= self.cc_half_min: break
+        lower_bound = upper_bound
+        step *= 2
 
     self.log_out.write("  Lower, Upper bound: %.4f, %.4f\n" %(lower_bound, upper_bound))
 
@@ -16,6 +16,54 @@ from collections import OrderedDict
 from yamtbx.dataproc.dataset import template_to_filenames, re_pref_num_ext
 from functools import reduce
 
+class LogFileTail(object):
+    """
+    Reads lines appended to a log file since the last call.
+    Only complete lines (ending with newline) are returned; an incomplete last line is read when completed.
+    If the file was truncated or replaced (different inode or content before the last position),
+    it is read again from the beginning.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.reset()
+    # __init__()
+
+    def reset(self):
+        self.offset = 0
+        self.inode = None
+        self.last_bytes = b"" # to check if the file is not rewritten
+    # reset()
+
+    def read_new_lines(self):
+        """
+        Returns (lines, restarted). restarted=True means the file was read again from the beginning,
+        and the caller should discard what was parsed so far.
+        """
+        restarted = False
+        with open(self.filename, "rb") as f:
+            st = os.fstat(f.fileno())
+            if self.offset > 0:
+                ok = st.st_ino == self.inode and st.st_size >= self.offset
+                if ok:
+                    f.seek(self.offset - len(self.last_bytes))
+                    ok = f.read(len(self.last_bytes)) == self.last_bytes
+                if not ok:
+                    self.reset()
+                    restarted = True
+
+            f.seek(self.offset)
+            data = f.read()
+
+        self.inode = st.st_ino
+        data = data[:data.rfind(b"\n")+1]
+        if data:
+            self.offset += len(data)
+            self.last_bytes = data[-64:]
+
+        return data.decode("utf-8", "replace").splitlines(True), restarted
+    # read_new_lines()
+# class LogFileTail
+
 class ScanInfo(object):
     def __init__(self):
         self.vpoints, self.vstep = 0, 0
@@ -61,6 +109,28 @@ class ScanInfo(object):
 
 # class ScanInfo
 
+re_scanstart = re.compile(r"Diffraction scan \(([0-9A-Za-z/:\[\] ]+)\)")
+re_nums = re.compile(r"([0-9]+) +([\-0-9\.]+|dummy) +([\-0-9\.]+|dummy) +([\-0-9\.]+|dummy)")
+re_point_step = re.compile(r"point: *([0-9]+) *step: *([0-9\.]+)")
+re_osc = re.compile(r"Oscillation start: ([-0-9\.]+) \[deg\], step: ([-0-9\.]+) \[deg\]")
+re_att = re.compile(r"Attenuator: +([^ ]+) +([0-9]+)um")
+re_att2 = re.compile(r"Attenuator transmission: +([^ ]+) +\(([^ ]+) attenuator: ([0-9]+)\[um\]\)")
+re_exp = re.compile(r"Exp\. time: ([\.0-9]+) ")
+re_beam = re.compile(r"hor\. beam size: +([\.0-9]+)\[um\], ver\. beamsize: +([\.0-9]+)\[um\]") # old bss, wrong (need to swap h/v)
+re_beam2 = re.compile(r"horizontal size: +([\.0-9]+)\[um\], vertical size: +([\.0-9]+)\[um\]") # new bss (2015-Apr), correct
+re_fixed_spindle = re.compile(r"Fixed spindle angle: ([-0-9\.]+) \[deg\]")
+re_frame_rate = re.compile(r"Frame rate: ([-0-9\.]+) \[frame/s\]")
+
+def image_name_aliases(filename):
+    """
+    Other names of the image used in SHIKA results. Results from EIGER stream are always named .img,
+    and newer BSS writes 7-digit numbers in diffscan.log while the results have 6 digits.
+    """
+    return (os.path.splitext(filename)[0] + ".img",
+            re.sub(r"(.*)_0([0-9]{6})\..*$", r"\1_\2.img", filename), # too dirty fix!! for new bss which writes 7-digits filename..
+            )
+# image_name_aliases()
+
 class BssDiffscanLog(object):
     def __init__(self, scanlog):
         self.scanlog = scanlog
@@ -70,148 +140,238 @@ class BssDiffscanLog(object):
     # __init__()
 
     def parse(self):
-        re_scanstart = re.compile(r"Diffraction scan \(([0-9A-Za-z/:\[\] ]+)\)")
-        re_nums = re.compile(r"([0-9]+) +([\-0-9\.]+|dummy) +([\-0-9\.]+|dummy) +([\-0-9\.]+|dummy)")
-        re_point_step = re.compile(r"point: *([0-9]+) *step: *([0-9\.]+)")
-        re_osc = re.compile(r"Oscillation start: ([-0-9\.]+) \[deg\], step: ([-0-9\.]+) \[deg\]")
-        re_att = re.compile(r"Attenuator: +([^ ]+) +([0-9]+)um")
-        re_att2 = re.compile(r"Attenuator transmission: +([^ ]+) +\(([^ ]+) attenuator: ([0-9]+)\[um\]\)")
-        re_exp = re.compile(r"Exp\. time: ([\.0-9]+) ")
-        re_beam = re.compile(r"hor\. beam size: +([\.0-9]+)\[um\], ver\. beamsize: +([\.0-9]+)\[um\]") # old bss, wrong (need to swap h/v)
-        re_beam2 = re.compile(r"horizontal size: +([\.0-9]+)\[um\], vertical size: +([\.0-9]+)\[um\]") # new bss (2015-Apr), correct
-        re_fixed_spindle = re.compile(r"Fixed spindle angle: ([-0-9\.]+) \[deg\]")
-        re_frame_rate = re.compile(r"Frame rate: ([-0-9\.]+) \[frame/s\]")
+        self.clear()
+        self._tail = LogFileTail(self.scanlog)
+        self.update()
+    # parse()
 
+    def clear(self):
         self.scans = []
         self.filename_gonio_gc = OrderedDict()
+        self._file_index = {} # {basename: (scan, gonio, grid_coord)}; later scans have priority
+        self._alias_index = {} # same as above but with image_name_aliases()
+        self._template_index = {} # {filename_template: scan}
+        self._template_nq = set() # lengths of ?s in templates
+        self._unusual_templates = {} # templates where ?s are not the last digits
+        self._scan_order = {} # {id(scan): position in scans}
+    # clear()
+
+    def update(self):
+        """
+        Parse only lines appended since the last call. Returns True if anything was read.
+        Everything is parsed again if the file was truncated or replaced.
+        Note that scans removed by remove_overwritten_scans() are not restored unless the file is parsed again.
+        """
+        lines, restarted = self._tail.read_new_lines()
+        if restarted: self.clear()
+
+        for l in lines:
+            self.parse_line(l)
 
-        for l in open(self.scanlog):
-            r_scanstart = re_scanstart.search(l)
-            if r_scanstart:
-                datestr = re.sub(r"\[[A-Za-z]+\] ", "", r_scanstart.group(1))
-                if datestr.count(":") == 3: datestr = datestr[:datestr.rindex(":")] # from bss jan29-2015, millisec time is recorded; but we discard it here.
-                date = datetime.datetime.strptime(datestr, "%Y/%m/%d %H:%M:%S")
-                self.scans.append(ScanInfo())
-                self.scans[-1].date = date
-                continue
-
-            r_osc = re_osc.search(l)
-            if r_osc:
-                self.scans[-1].osc_start = float(r_osc.group(1))
-                self.scans[-1].osc_step = float(r_osc.group(2))
-                continue
-
-            r_exp = re_exp.search(l)
-            if r_exp:
-                self.scans[-1].exp_time = float(r_exp.group(1))
-                continue
-
-            r_beam = re_beam.search(l)
-            if r_beam:
-                self.scans[-1].beam_hsize = float(r_beam.group(2))
-                self.scans[-1].beam_vsize = float(r_beam.group(1))
-                continue
-
-            r_beam2 = re_beam2.search(l)
-            if r_beam2:
-                self.scans[-1].beam_hsize = float(r_beam2.group(1))
-                self.scans[-1].beam_vsize = float(r_beam2.group(2))
-                continue
-
-            r_fspindle = re_fixed_spindle.search(l)
-            if r_fspindle:
-                self.scans[-1].fixed_spindle = float(r_fspindle.group(1))
-                continue
-
-            r_frate = re_frame_rate.search(l)
-            if r_frate:
-                self.scans[-1].frame_rate = float(r_frate.group(1))
-                continue
-
-            if "No dummy image generated in each scan" in l:
-                # this scan does not have dummy images.
-                self.scans[-1].has_extra_images = False
-                self.scans[-1].need_treatment_on_image_numbers = False
-                continue
-
-            if "Dummy images generated in each scan!" in l:
-                # this scan actually has dummy images but diffscan.log has "dummy" lines
-                self.scans[-1].has_extra_images = True
-                self.scans[-1].need_treatment_on_image_numbers = False
-                continue
-
-            if "Scan direction:" in l:
-                self.scans[-1].scan_direction = l[l.index(":")+1:].strip()
-                continue                
-
-            if "Scan path:" in l:
-                self.scans[-1].scan_path = l[l.index(":")+1:].strip()
-                continue
-
-            if "Wavelength: " in l:
-                self.scans[-1].wavelength = float(l.strip().split()[1])
-                continue
-
-            if "Attenuator" in l:
-                r_att = re_att.search(l)
-                r_att2 = re_att2.search(l)
-                if r_att:
-                    self.scans[-1].attenuator = (r_att.group(1), int(r_att.group(2)))
-                elif r_att2:
-                    self.scans[-1].attenuator = (r_att2.group(2), int(r_att2.group(3))) # (1) is transmisttance
-                continue
-
-            if "Cameralength: " in l:
-                self.scans[-1].distance = float(l.strip().split()[1])
-                continue
-
-            if "FILE_NAME = " in l:
-                self.scans[-1].filename_template =  os.path.basename(l[l.index("FILE_NAME = ")+12:].strip())
-
-                # VERY DIRTY FIX!
-                # Explanation: if diffscan.log contains ".h5", we assume it's Eiger hdf5 and hit-finding is done by streaming mode.
-                if self.scans[-1].filename_template.endswith(".h5"):
-                    self.scans[-1].filename_template = self.scans[-1].filename_template[:-3] + ".img"
-                continue
-
-            if "Vertical   scan" in l:
-                vpoint, vstep = re_point_step.search(l.strip()).groups()
-                self.scans[-1].vpoints, self.scans[-1].vstep = int(vpoint), float(vstep)
-                continue
-
-            if "Horizontal scan" in l:
-                hpoint, hstep = re_point_step.search(l.strip()).groups()
-                self.scans[-1].hpoints, self.scans[-1].hstep = int(hpoint), float(hstep)
-                continue
-
-            r = re_nums.search(l)
+        return restarted or len(lines) > 0
+    # update()
+
+    def parse_line(self, l):
+        # most lines are image lines; skip the other patterns for them
+        if l.lstrip()[:1].isdigit():
+            r = re_nums.match(l.lstrip())
             if r:
-                if "dummy" in r.groups():
-                    assert not self.scans[-1].need_treatment_on_image_numbers
-                    continue
-                else:
-                    gonio = tuple([float(x) for x in r.groups()[1:]])
-
-                num = int(r.group(1))
-                if self.scans[-1].need_treatment_on_image_numbers and self.scans[-1].is_shutterless() and self.scans[-1].hpoints > 1:
-                    # This if section is not needed *if* BSS no longer creates such non-sense files.
-                    # this should be an option.
-                    num += int(math.ceil(float(num)/self.scans[-1].hpoints)) - 1
-
-                filename = template_to_filenames(self.scans[-1].filename_template, num, num)[0]
-
-                grid_coord = self.get_grid_coord_internal(self.scans[-1].vpoints, self.scans[-1].vstep,
-                                                          self.scans[-1].hpoints, self.scans[-1].hstep,
-                                                          num, self.scans[-1].is_shutterless() and self.scans[-1].has_extra_images,
-                                                          self.scans[-1].scan_direction, self.scans[-1].scan_path)
-
-                # XXX Need to check if the filename is already registered (file is overwritten!!)
-                self.scans[-1].filename_coords.append((filename, (gonio, grid_coord)))
-                self.scans[-1].filename_idxes.append((filename, num))
-                if len(l.split())==5: # for SACLA
-                    self.scans[-1].filename_tags.append((filename, int(l.split()[-1])))
-                self.filename_gonio_gc[os.path.basename(filename)] = (gonio, grid_coord)
-    # parse()
+                self.parse_image_line(l, r)
+                return
+
+        r_scanstart = re_scanstart.search(l)
+        if r_scanstart:
+            datestr = re.sub(r"\[[A-Za-z]+\] ", "", r_scanstart.group(1))
+            if datestr.count(":") == 3: datestr = datestr[:datestr.rindex(":")] # from bss jan29-2015, millisec time is recorded; but we discard it here.
+            date = datetime.datetime.strptime(datestr, "%Y/%m/%d %H:%M:%S")
+            self.scans.append(ScanInfo())
+            self.scans[-1].date = date
+            self._scan_order[id(self.scans[-1])] = len(self.scans) - 1
+            return
+
+        r_osc = re_osc.search(l)
+        if r_osc:
+            self.scans[-1].osc_start = float(r_osc.group(1))
+            self.scans[-1].osc_step = float(r_osc.group(2))
+            return
+
+        r_exp = re_exp.search(l)
+        if r_exp:
+            self.scans[-1].exp_time = float(r_exp.group(1))
+            return
+
+        r_beam = re_beam.search(l)
+        if r_beam:
+            self.scans[-1].beam_hsize = float(r_beam.group(2))
+            self.scans[-1].beam_vsize = float(r_beam.group(1))
+            return
+
+        r_beam2 = re_beam2.search(l)
+        if r_beam2:
+            self.scans[-1].beam_hsize = float(r_beam2.group(1))
+            self.scans[-1].beam_vsize = float(r_beam2.group(2))
+            return
+
+        r_fspindle = re_fixed_spindle.search(l)
+        if r_fspindle:
+            self.scans[-1].fixed_spindle = float(r_fspindle.group(1))
+            return
+
+        r_frate = re_frame_rate.search(l)
+        if r_frate:
+            self.scans[-1].frame_rate = float(r_frate.group(1))
+            return
+
+        if "No dummy image generated in each scan" in l:
+            # this scan does not have dummy images.
+            self.scans[-1].has_extra_images = False
+            self.scans[-1].need_treatment_on_image_numbers = False
+            return
+
+        if "Dummy images generated in each scan!" in l:
+            # this scan actually has dummy images but diffscan.log has "dummy" lines
+            self.scans[-1].has_extra_images = True
+            self.scans[-1].need_treatment_on_image_numbers = False
+            return
+
+        if "Scan direction:" in l:
+            self.scans[-1].scan_direction = l[l.index(":")+1:].strip()
+            return                
+
+        if "Scan path:" in l:
+            self.scans[-1].scan_path = l[l.index(":")+1:].strip()
+            return
+
+        if "Wavelength: " in l:
+            self.scans[-1].wavelength = float(l.strip().split()[1])
+            return
+
+        if "Attenuator" in l:
+            r_att = re_att.search(l)
+            r_att2 = re_att2.search(l)
+            if r_att:
+                self.scans[-1].attenuator = (r_att.group(1), int(r_att.group(2)))
+            elif r_att2:
+                self.scans[-1].attenuator = (r_att2.group(2), int(r_att2.group(3))) # (1) is transmisttance
+            return
+
+        if "Cameralength: " in l:
+            self.scans[-1].distance = float(l.strip().split()[1])
+            return
+
+        if "FILE_NAME = " in l:
+            self.scans[-1].filename_template =  os.path.basename(l[l.index("FILE_NAME = ")+12:].strip())
+
+            # VERY DIRTY FIX!
+            # Explanation: if diffscan.log contains ".h5", we assume it's Eiger hdf5 and hit-finding is done by streaming mode.
+            if self.scans[-1].filename_template.endswith(".h5"):
+                self.scans[-1].filename_template = self.scans[-1].filename_template[:-3] + ".img"
+
+            self.add_template_to_index(self.scans[-1])
+            return
+
+        if "Vertical   scan" in l:
+            vpoint, vstep = re_point_step.search(l.strip()).groups()
+            self.scans[-1].vpoints, self.scans[-1].vstep = int(vpoint), float(vstep)
+            return
+
+        if "Horizontal scan" in l:
+            hpoint, hstep = re_point_step.search(l.strip()).groups()
+            self.scans[-1].hpoints, self.scans[-1].hstep = int(hpoint), float(hstep)
+            return
+
+        r = re_nums.search(l)
+        if r: self.parse_image_line(l, r)
+    # parse_line()
+
+    def parse_image_line(self, l, r):
+        if "dummy" in r.groups():
+            assert not self.scans[-1].need_treatment_on_image_numbers
+            return
+        else:
+            gonio = tuple([float(x) for x in r.groups()[1:]])
+
+        num = int(r.group(1))
+        if self.scans[-1].need_treatment_on_image_numbers and self.scans[-1].is_shutterless() and self.scans[-1].hpoints > 1:
+            # This if section is not needed *if* BSS no longer creates such non-sense files.
+            # this should be an option.
+            num += int(math.ceil(float(num)/self.scans[-1].hpoints)) - 1
+
+        filename = template_to_filenames(self.scans[-1].filename_template, num, num)[0]
+
+        grid_coord = self.get_grid_coord_internal(self.scans[-1].vpoints, self.scans[-1].vstep,
+                                                  self.scans[-1].hpoints, self.scans[-1].hstep,
+                                                  num, self.scans[-1].is_shutterless() and self.scans[-1].has_extra_images,
+                                                  self.scans[-1].scan_direction, self.scans[-1].scan_path)
+
+        # XXX Need to check if the filename is already registered (file is overwritten!!)
+        self.scans[-1].filename_coords.append((filename, (gonio, grid_coord)))
+        self.scans[-1].filename_idxes.append((filename, num))
+        if len(l.split())==5: # for SACLA
+            self.scans[-1].filename_tags.append((filename, int(l.split()[-1])))
+        self.filename_gonio_gc[os.path.basename(filename)] = (gonio, grid_coord)
+        self.add_to_index(self.scans[-1], filename, gonio, grid_coord)
+    # parse_image_line()
+
+    def add_to_index(self, scan, filename, gonio, grid_coord):
+        bf = os.path.basename(filename)
+        self._file_index[bf] = (scan, gonio, grid_coord)
+        for f in image_name_aliases(bf): self._alias_index[f] = (scan, gonio, grid_coord)
+    # add_to_index()
+
+    def add_template_to_index(self, scan):
+        tmpl = scan.filename_template
+        if re.search(r"\?+[^0-9?]*$", tmpl):
+            self._template_index[tmpl] = scan
+            self._template_nq.add(tmpl.count("?"))
+        else: # cannot be looked up by get_scan()
+            self._unusual_templates[tmpl] = scan
+    # add_template_to_index()
+
+    def rebuild_index(self):
+        self._file_index, self._alias_index, self._template_index, self._unusual_templates = {}, {}, {}, {}
+        self._scan_order = dict([(id(scan), i) for i, scan in enumerate(self.scans)])
+        for scan in self.scans:
+            if scan.filename_template: self.add_template_to_index(scan)
+            for f, (gonio, gc) in scan.filename_coords:
+                self.add_to_index(scan, f, gonio, gc)
+    # rebuild_index()
+
+    def lookup(self, filename, use_aliases=False):
+        """
+        Returns (scan, gonio, grid_coord) of the file in the latest scan, or None if not found.
+        If use_aliases=True, the name in SHIKA results (see image_name_aliases()) can be given.
+        """
+        bf = os.path.basename(filename)
+        ret = self._file_index.get(bf)
+        if ret is None and use_aliases: ret = self._alias_index.get(bf)
+        return ret
+    # lookup()
+
+    def get_scan(self, filename):
+        """
+        Returns the latest scan which includes the file, or whose template matches the file name
+        (e.g. dummy images not listed in the log). None if not found.
+        """
+        ret = self.lookup(filename)
+        found = ret[0] if ret is not None else None
+        later = lambda scan: found is None or self._scan_order[id(scan)] > self._scan_order[id(found)]
+
+        # a later scan may have the same template but not list the file (yet)
+        bf = os.path.basename(filename)
+        r = re.search(r"^(.*?)([0-9]+)([^0-9]*)$", bf)
+        if r:
+            pre, num, suf = r.groups()
+            for nq in self._template_nq:
+                if nq > len(num): continue
+                tmpl = pre + num[:len(num)-nq] + "?"*nq + suf
+                scan = self._template_index.get(tmpl)
+                if scan is not None and later(scan): found = scan
+
+        for scan in self._unusual_templates.values():
+            if later(scan) and scan.match_file_with_template(bf): found = scan
+        return found
+    # get_scan()
 
     def __getitem__(self, filename):
         for scan in reversed(self.scans):
@@ -315,6 +475,8 @@ class BssDiffscanLog(object):
         rem_idxes = reduce(lambda x,y:x+y, rem_idxes) 
         for i in sorted(rem_idxes, reverse=True):
             del self.scans[i]
+
+        self.rebuild_index()
     # remove_overwritten_scan()
 # class BssDiffscanLog
 
@@ -582,6 +744,8 @@ class JobInfo(object):
 class BssJobLog(object):
     def __init__(self, joblog=None, remove_overwritten=False):
         self.jobs = []
+        self.remove_overwritten = remove_overwritten
+        self._tail = None
         if joblog is not None:
             self.parse(joblog)
 
@@ -590,32 +754,49 @@ class BssJobLog(object):
     # __init__()
 
     def parse(self, joblog):
+        self._tail = LogFileTail(joblog)
+        self.parse_lines(self._tail.read_new_lines()[0])
+    # parse()
 
-        for l in open(joblog):
+    def parse_lines(self, lines):
+        joblog = self._tail.filename
+        for l in lines:
             if l.startswith(" JOB_ID#   ="):
                 self.jobs.append(JobInfo(joblog))
             if len(self.jobs) > 0:
                 self.jobs[-1].parse_line(l)
-    # parse()
+    # parse_lines()
+
+    def update(self):
+        """
+        Parse only lines appended since the last call. Returns True if anything was read.
+        Everything is parsed again if the file was truncated or replaced.
+        """
+        lines, restarted = self._tail.read_new_lines()
+        if restarted: self.jobs = []
+        if not lines and not restarted: return False
+
+        self.parse_lines(lines)
+        self.annotate_overwritten_images(remove=self.remove_overwritten)
+        return True
+    # update()
 
     def annotate_overwritten_images(self, remove=False):
         del_indices = {} # {i: [j,...]}
         # Assume all files in the same directory and the common prefix is in single file. Is it true??
         # Assume files in the same job are never overwritten. Only check inter-job files.
 
-        filenames = [] # (i, j, filename)
+        last_found = {} # {filename: (i, j)} last appearance in previous jobs
         for i, job in enumerate(self.jobs):
             this_job_filenames = []
             for j, img in enumerate(job.images):
-                fltr = [x for x in filenames if x[2]==img.filename]
-                #assert len(fltr) in (0,1)
-                if len(fltr) > 0:
-                    #del_indices.append((fltr[-1][0],fltr[-1][1]))
-                    del_indices.setdefault(fltr[-1][0], []).append(fltr[-1][1])
-                    self.jobs[fltr[-1][0]].images[fltr[-1][1]].overwritten = True
-
-                this_job_filenames.append((i,j,img.filename))
-            filenames.extend(this_job_filenames)
+                if img.filename in last_found:
+                    i0, j0 = last_found[img.filename]
+                    del_indices.setdefault(i0, []).append(j0)
+                    self.jobs[i0].images[j0].overwritten = True
+
+                this_job_filenames.append((img.filename, (i,j)))
+            last_found.update(this_job_filenames)
 
         ow_flag = False
         if remove:
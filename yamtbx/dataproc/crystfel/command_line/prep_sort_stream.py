@@ -38,6 +38,9 @@ hklref_label = None
  .type = str
 d_min = None
  .type = float
+nproc = 1
+ .type = int
+ .help = number of processes to parse the stream and calculate statistics
 
 stats = *reslimit *ioversigma *resnatsnr1 *pr *wilsonb *abdist ccref
  .type = choice(multi=True)
@@ -122,7 +125,6 @@ def run(params):
     if params.pklout is None: params.pklout = os.path.basename(params.streamin)+".pkl"
     if params.datout is None: params.datout = os.path.basename(params.streamin)+".dat"
 
-    ifs = open(params.streamin)
     ofs_dat = open(params.datout, "w")
 
     ref_data = None
@@ -141,10 +143,6 @@ def run(params):
     ofs_dat.write("#ref_cell= %s space_group= %s n_residues= %s\n" % (params.ref_cell, params.space_group, params.n_residues))
     ofs_dat.write("file event indexed_by reslimit ioversigma resnatsnr1 pr wilsonb abdist ccref a b c al be ga\n")
 
-    tell_p, tell_c = 0, 0
-    read_flag = False
-    chunk = None
-
     chunk_ranges = []
     stats = dict(reslimit=[],
                  ioversigma=[],
@@ -155,45 +153,27 @@ def run(params):
                  ccref=[],
                  )
 
-    while True:
-        l = ifs.readline()
-        if l == "": break
-        tell_p, tell_c = tell_c, ifs.tell()
-
-        if "----- Begin chunk -----" in l:
-            if read_flag: del chunk_ranges[-1] # in case chunk is not properly closed
-            read_flag = True
-            chunk = crystfel.stream.Chunk()
-            chunk_ranges.append([tell_p+1,0])
-        elif read_flag and "----- End chunk -----" in l:
-            read_flag = False
-            if chunk.indexed_by is not None:
-                chunk_ranges[-1][1] = tell_c
-                sys.stdout.write("%.6d processed\r" % len(chunk_ranges))
-                set_chunk_stats(chunk, stats, params.stats,
-                                n_residues=params.n_residues,
-                                ref_cell=params.ref_cell,
-                                space_group=params.space_group,
-                                d_min=params.d_min,
-                                ref_data=ref_data)
-                ofs_dat.write("%s %s %s %.3f %.3f %.3f %.3e %.3f %.3f %.5f "%(chunk.filename, chunk.event, chunk.indexed_by, chunk.res_lim, 
-                                                                              stats["ioversigma"][-1], stats["resnatsnr1"][-1], stats["pr"][-1], stats["wilsonb"][-1], stats["abdist"][-1],
-                                                                              stats["ccref"][-1]))
-                ofs_dat.write("%.3f %.3f %.3f %.2f %.2f %.2f\n" % chunk.cell)
-                #ofs_dat.flush()
-            else:
-                del chunk_ranges[-1]
-
-        elif read_flag:
-            try: chunk.parse_line(l)
-            except:
-                print("\nError in reading line: '%s'" % l)
-                read_flag = False
-                
-    if read_flag: #  Unfinished chunk
-        print("\nWarning: unclosed chunk.")
-        del chunk_ranges[-1]
-    
+    def calc_stats(start, end, chunk):
+        # in worker process. returns only values needed here instead of whole chunk.
+        tmp = dict([(k, []) for k in stats])
+        set_chunk_stats(chunk, tmp, params.stats,
+                        n_residues=params.n_residues,
+                        ref_cell=params.ref_cell,
+                        space_group=params.space_group,
+                        d_min=params.d_min,
+                        ref_data=ref_data)
+        return start, end, chunk.filename, chunk.event, chunk.indexed_by, chunk.res_lim, chunk.cell, dict([(k, tmp[k][0]) for k in tmp])
+    # calc_stats()
+
+    for start, end, filename, event, indexed_by, res_lim, cell, chunk_stats in crystfel.stream.parallel_stream_map(params.streamin, calc_stats, nproc=params.nproc, skip_broken=True):
+        chunk_ranges.append([start+1, end]) # sort_stream.py reads from start-1
+        for k in chunk_stats: stats[k].append(chunk_stats[k])
+        sys.stdout.write("%.6d processed\r" % len(chunk_ranges))
+        ofs_dat.write("%s %s %s %.3f %.3f %.3f %.3e %.3f %.3f %.5f "%(filename, event, indexed_by, res_lim,
+                                                                      stats["ioversigma"][-1], stats["resnatsnr1"][-1], stats["pr"][-1], stats["wilsonb"][-1], stats["abdist"][-1],
+                                                                      stats["ccref"][-1]))
+        ofs_dat.write("%.3f %.3f %.3f %.2f %.2f %.2f\n" % cell)
+
     stats["chunk_ranges"] = chunk_ranges
     pickle.dump(stats, open(params.pklout,"wb"), -1)
 
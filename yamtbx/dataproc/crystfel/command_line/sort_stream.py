@@ -4,6 +4,10 @@ import pickle
 import os
 
 def run(streamin, pklin, key, stop_after=None, streamout=None):
+    """
+    pklin: output of prep_sort_stream.py. If None, chunks are sorted by metadata in the chunk index
+           (StreamIndex.fields; e.g. res_lim, profile_radius, n_refl), and only indexed chunks are written.
+    """
     if streamout is None:
         streamout = os.path.splitext(os.path.basename(streamin))[0] + "_sort_%s.stream" % key
 
@@ -11,6 +15,17 @@ def run(streamin, pklin, key, stop_after=None, streamout=None):
     rev_order = key[-1] == "-"
     key = key[:-1]
 
+    if pklin is None:
+        from yamtbx.dataproc.crystfel.stream import StreamIndex
+        sidx = StreamIndex(streamin)
+        sorted_indices = sorted(sidx.indexed(),
+                                key=lambda x: sidx.columns[key][x],
+                                reverse=rev_order)
+        if stop_after is not None: sorted_indices = sorted_indices[:stop_after]
+        with open(streamout, "wb") as ofs: sidx.write_chunks(sorted_indices, ofs)
+        sidx.close()
+        return
+
     stats = pickle.load(open(pklin, "rb"))
     sorted_indices = sorted(list(range(len(stats["chunk_ranges"]))),
                             key=lambda x: stats[key][x],
@@ -31,5 +46,7 @@ def run(streamin, pklin, key, stop_after=None, streamout=None):
 
 if __name__ == "__main__":
     import sys
-    run(sys.argv[1], sys.argv[2], sys.argv[3], stop_after=int(sys.argv[4]) if len(sys.argv)>4 else None)
-    
+    # sort_stream.py streamin [pklin] key [stop_after]
+    args = sys.argv[1:]
+    pklin = args.pop(1) if args[1].endswith(".pkl") else None
+    run(args[0], pklin, args[1], stop_after=int(args[2]) if len(args)>2 else None)
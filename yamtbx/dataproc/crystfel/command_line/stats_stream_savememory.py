@@ -21,9 +21,7 @@ from cctbx.array_family import flex
 import time
 import random
 import sys
-import re
 import os
-import bz2
 
 master_params_str = """
 dmin = 2.1
@@ -47,6 +45,9 @@ halve_method = *alternate random
  .type = choice(multi=False)
 random_seed = 1234
  .type = int
+nproc = 1
+ .type = int
+ .help = number of processes to parse the stream
 
 #frame_scaling = False
 # .type = bool
@@ -103,29 +104,9 @@ def merge_obs(indices, iobs, sel, symm, anomalous_flag, d_min, d_max):
     return array.merge_equivalents(algorithm="crystfel") # if sigmas is None, merge_equivalents_real() is used which simply averages.
 # merge_obs()
 
-def read_stream(stream, start_at=0):
-    if stream.endswith(".bz2"):
-        fin = bz2.BZ2File(stream)
-    else:
-        fin = open(stream)
-    line = fin.readline()
-    format_ver = re.search(r"CrystFEL stream format ([0-9\.]+)", line).group(1)
-    print("# format version:", format_ver)
-    assert float(format_ver) >= 2.2 # TODO support other version
-    chunk = None
-    count = 0
-    read_flag = False
-    for l in fin:
-        if "----- Begin chunk -----" in l:
-            read_flag = True
-            chunk = crystfel.stream.Chunk()
-        elif "----- End chunk -----" in l:
-            read_flag = False
-            if chunk.indexed_by is not None:
-                if start_at <= count: yield chunk
-                count += 1
-        elif read_flag:
-            chunk.parse_line(l)
+def read_stream(stream, start_at=0, nproc=1):
+    return crystfel.stream.stream_iterator(stream, start_at=start_at, nproc=nproc)
+# read_stream()
 
 def show_split_stats(stream, nindexed, symm, params, anoref=None, ref=None, out_prefix="out", start_at=0):
     random.seed(params.random_seed)
@@ -147,7 +128,7 @@ def show_split_stats(stream, nindexed, symm, params, anoref=None, ref=None, out_
 
     print("   nframes     red  Rsplit    Rano   CC1/2   CCano  snr  Rano/Rsplit CCanoref CCref", file=out)
 
-    chunks = read_stream(stream, start_at)
+    chunks = read_stream(stream, start_at, params.nproc)
 
     for i in range(params.nsplit):
         e = (i+1)*nstep
@@ -175,21 +156,21 @@ def show_split_stats(stream, nindexed, symm, params, anoref=None, ref=None, out_
             slc1 = [slc[r] for r in perm[:nhalf]]
             slc2 = [slc[r] for r in perm[nhalf:]]
         else:
-            raise "Not-supported:", params.halve_method
+            raise Exception("Not-supported: %s" % params.halve_method)
 
         i1, o1, s1 = [], [], []
         for x in slc1:
-            i1.extend(x.indices)
-            o1.extend(x.iobs)
+            i1.extend(map(tuple, x.indices.tolist()))
+            o1.extend(x.iobs.tolist())
             if params.adu_cutoff is not None:
-                s1.extend((a <= params.adu_cutoff for a in x.peak))
+                s1.extend((x.peak <= params.adu_cutoff).tolist())
 
         i2, o2, s2 = [], [], []
         for x in slc2:
-            i2.extend(x.indices)
-            o2.extend(x.iobs)
+            i2.extend(map(tuple, x.indices.tolist()))
+            o2.extend(x.iobs.tolist())
             if params.adu_cutoff is not None:
-                s2.extend((a <= params.adu_cutoff for a in x.peak))
+                s2.extend((x.peak <= params.adu_cutoff).tolist())
 
         # Concatenate and sort
         indices1 = indices1.concatenate(flex.miller_index(i1))
@@ -273,8 +254,8 @@ def run(streamin, symm_source, params):
     nindexed = 0
     t = time.time()
 
-    for l in bz2.BZ2File(streamin) if streamin.endswith(".bz2") else open(streamin):
-        if l.startswith("indexed_by =") and l[l.index("=")+1:].strip() != "none":
+    for l in crystfel.stream.open_stream(streamin):
+        if l.startswith(b"indexed_by =") and l[l.index(b"=")+1:].strip() != b"none":
             nindexed += 1
         if params.stop_after is not None and params.stop_after <= (nindexed-params.start_at):
             break
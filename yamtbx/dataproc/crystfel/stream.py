@@ -53,61 +53,86 @@ from __future__ import unicode_literals
 
 import re
 
-from libtbx import adopt_init_args
 from cctbx import miller
 from cctbx import crystal
 from cctbx import uctbx
+from cctbx import sgtbx
 from cctbx.array_family import flex
 
 import pickle
 import sys
+import os
+import bz2
+import io
+import shutil
 import numpy
 #import msgpack
 
 re_abcstar = re.compile(r"([-\+][0-9\.]+ )([-\+][0-9\.]+ )([-\+][0-9\.]+ )")
 
-class Chunk(object):
-    def __init__(self, read_reflections=True):        
-        filename, event, serial = None, None, None
-        indexed_by = None
-        photon_e, beam_div, beam_bw = None, None, None
-        avg_clen = None
-        n_peaks = 0
-        n_sat_peaks = 0
-        cell = None # 
-        astar, bstar, cstar = None, None, None
-        latt_type, centering, unique_axis = None, None, None
-        profile_radius = None
-        res_lim = None
-        det_shift = None, None
-        n_refl = 0
-        n_sat_refl = 0
-        n_imp_refl = 0
-        indices = []
-        iobs = []
-        sigma = []
-        peak = []
-        background, fs, ss, panel = [], [], [], []
-        adopt_init_args(self, locals())
+def parse_reflection_lines(lines):
+    """
+    Parse reflection lines (h k l I sigma(I) peak background fs/px ss/px [panel]) at once.
+    Returns (indices (n,3) int32, float columns (n,6), panel (n,) str)
+    """
+    ncol = len(lines[0].split()) if lines else 10
+    tokens = " ".join(lines).split()
+    if ncol in (9, 10) and len(tokens) == ncol*len(lines):
+        arr = numpy.array(tokens, dtype=str).reshape(-1, ncol)
+    else: # irregular number of columns
+        arr = numpy.array([(sp+[""])[:10] for sp in (l.split() for l in lines)], dtype=str).reshape(-1, 10)
 
+    panel = arr[:,9] if arr.shape[1] > 9 else numpy.full(arr.shape[0], "", dtype=str)
+    return arr[:,:3].astype(numpy.int32), arr[:,3:9].astype(numpy.float64), panel
+# parse_reflection_lines()
+
+class Chunk(object):
+    meta_fields = ("filename", "event", "serial", "indexed_by", "photon_e", "beam_div", "beam_bw",
+                   "avg_clen", "n_peaks", "n_sat_peaks", "cell", "astar", "bstar", "cstar",
+                   "latt_type", "centering", "unique_axis", "profile_radius", "res_lim", "det_shift",
+                   "n_refl", "n_sat_refl", "n_imp_refl")
+    refl_fields = ("indices", "iobs", "sigma", "peak", "background", "fs", "ss", "panel")
+    __slots__ = meta_fields + refl_fields + ("read_reflections", "parsing", "_hkl_lines")
+
+    def __init__(self, read_reflections=True):
+        # no __dict__ because of __slots__, so adopt_init_args() cannot be used
+        for k in self.meta_fields: setattr(self, k, None)
+        self.n_peaks, self.n_sat_peaks = 0, 0
+        self.det_shift = None, None
+        self.n_refl, self.n_sat_refl, self.n_imp_refl = 0, 0, 0
+        self.read_reflections = read_reflections
+
+        # reflections are kept as numpy arrays
+        self.set_reflections(numpy.zeros((0,3), dtype=numpy.int32), numpy.zeros((0,6)), numpy.zeros(0, dtype=str))
         self.parsing = None
+        self._hkl_lines = []
     # __init__()
 
+    def set_reflections(self, indices, values, panel):
+        """values: (n,6) array of I, sigma(I), peak, background, fs/px, ss/px"""
+        self.indices = indices
+        self.iobs, self.sigma, self.peak, self.background, self.fs, self.ss = [values[:,i] for i in range(6)]
+        self.panel = panel
+    # set_reflections()
+
+    def flush_reflection_lines(self):
+        # parse reflection lines read so far and append to the arrays
+        if not self._hkl_lines: return
+        indices, values, panel = parse_reflection_lines(self._hkl_lines)
+        self._hkl_lines = []
+        if self.indices.shape[0] > 0: # multiple crystals
+            values = numpy.concatenate((numpy.column_stack((self.iobs, self.sigma, self.peak, self.background, self.fs, self.ss)), values))
+            indices = numpy.concatenate((self.indices, indices))
+            panel = numpy.concatenate((self.panel, panel))
+        self.set_reflections(indices, values, panel)
+    # flush_reflection_lines()
+
     def parse_line(self, l):
         if l.startswith("End of reflections"):
             self.parsing = None
+            self.flush_reflection_lines()
         elif self.parsing == "hkls":
-            if not self.read_reflections: return
-            sp = l.split()
-            self.indices.append(tuple(map(int, sp[:3])))
-            self.iobs.append(float(sp[3]))
-            self.sigma.append(float(sp[4]))
-            self.peak.append(float(sp[5]))
-            self.background.append(float(sp[6]))
-            self.fs.append(float(sp[7]))
-            self.ss.append(float(sp[8]))
-            if len(sp) > 9:
-                self.panel.append(sp[9])
+            if self.read_reflections: self._hkl_lines.append(l)
         elif l.startswith("   h    k    l"):
             self.parsing = "hkls"
         elif l.startswith("Image filename:"):
@@ -209,7 +234,7 @@ class Chunk(object):
         
         self.cell = uctbx.unit_cell(self.cell).change_basis(op).parameters()
         # XXX need to change self.latt_type, self.centering, self.unique_axis ??
-        self.indices = list(op.apply(flex.miller_index(self.indices)))
+        self.indices = op.apply(self.miller_indices()).as_vec3_double().as_numpy_array().astype(numpy.int32)
         # modify astar/bstar/cstar
         ub = self.ub_matrix()
         r = numpy.array(op.c_inv().r().as_double()).reshape(3,3)
@@ -219,18 +244,22 @@ class Chunk(object):
         self.cstar = ubt[:,2].tolist()
     # change_basis()
 
+    def miller_indices(self):
+        return flex.miller_index([tuple(x) for x in self.indices.tolist()])
+    # miller_indices()
+
     def miller_set(self, space_group, anomalous_flag):
         return miller.set(crystal_symmetry=crystal.symmetry(unit_cell=self.cell,
                                                             space_group=space_group,
                                                             assert_is_compatible_unit_cell=False),
-                          indices=flex.miller_index(self.indices),
+                          indices=self.miller_indices(),
                           anomalous_flag=anomalous_flag)
     # miller_set()
 
     def data_array(self, space_group, anomalous_flag):
         return miller.array(self.miller_set(space_group, anomalous_flag),
-                            data=flex.double(self.iobs),
-                            sigmas=flex.double(self.sigma))
+                            data=flex.double(numpy.ascontiguousarray(self.iobs)),
+                            sigmas=flex.double(numpy.ascontiguousarray(self.sigma)))
     # data_array()
 
     def make_lines(self, ver="2.3"):
@@ -299,14 +328,94 @@ class Chunk(object):
         self.unique_axis = q if q else "*" # XXX should return c for P4 etc??
 # class Chunk
 
+_chunk_str_fields = ("filename", "event", "serial", "indexed_by", "latt_type", "centering", "unique_axis")
+_chunk_float_fields = ("photon_e", "beam_div", "beam_bw", "avg_clen", "profile_radius", "res_lim")
+_chunk_int_fields = ("n_peaks", "n_sat_peaks", "n_refl", "n_sat_refl", "n_imp_refl")
+_chunk_vec_fields = (("cell", 6), ("astar", 3), ("bstar", 3), ("cstar", 3), ("det_shift", 2))
+
+def chunks_as_columns(chunks):
+    """
+    Convert list of Chunk to dict of numpy arrays (one array per attribute), which can be saved by numpy.savez.
+    None is stored as empty string or NaN. Reflections of chunk i are in rows refl_offsets[i]:refl_offsets[i+1].
+    """
+    ret = {}
+    for k in _chunk_str_fields:
+        ret[k] = numpy.array(["" if getattr(c, k) is None else getattr(c, k) for c in chunks], dtype=str)
+    for k in _chunk_float_fields:
+        ret[k] = numpy.array([numpy.nan if getattr(c, k) is None else getattr(c, k) for c in chunks], dtype=numpy.float64)
+    for k in _chunk_int_fields:
+        ret[k] = numpy.array([getattr(c, k) for c in chunks], dtype=numpy.int64)
+    for k, n in _chunk_vec_fields:
+        ret[k] = numpy.array([[numpy.nan]*n if getattr(c, k) is None else [numpy.nan if x is None else x for x in getattr(c, k)] for c in chunks],
+                             dtype=numpy.float64).reshape(-1, n)
+
+    ret["refl_offsets"] = numpy.cumsum([0]+[c.indices.shape[0] for c in chunks]).astype(numpy.int64)
+    ret["indices"] = numpy.concatenate([c.indices for c in chunks]) if chunks else numpy.zeros((0,3), dtype=numpy.int32)
+    for k in Chunk.refl_fields[1:]:
+        ret[k] = numpy.concatenate([getattr(c, k) for c in chunks]) if chunks else numpy.zeros(0)
+    return ret
+# chunks_as_columns()
+
+def chunks_from_columns(cols):
+    """inverse of chunks_as_columns(). reflection arrays of chunks are views of cols."""
+    chunks = []
+    offsets = cols["refl_offsets"]
+    values = numpy.column_stack([cols[k] for k in Chunk.refl_fields[1:-1]])
+    for i in range(len(offsets)-1):
+        c = Chunk()
+        for k in _chunk_str_fields:
+            v = str(cols[k][i])
+            setattr(c, k, v if v != "" else None)
+        for k in _chunk_float_fields:
+            v = float(cols[k][i])
+            setattr(c, k, None if numpy.isnan(v) else v)
+        for k in _chunk_int_fields:
+            setattr(c, k, int(cols[k][i]))
+        for k, n in _chunk_vec_fields:
+            v = [None if numpy.isnan(x) else x for x in cols[k][i].tolist()]
+            if k == "det_shift": c.det_shift = tuple(v)
+            elif k == "cell": c.cell = None if None in v else tuple(v)
+            else: setattr(c, k, None if None in v else v)
+
+        s = slice(offsets[i], offsets[i+1])
+        c.set_reflections(cols["indices"][s], values[s], cols["panel"][s])
+        chunks.append(c)
+    return chunks
+# chunks_from_columns()
+
 class Streamfile(object):
-    def __init__(self, strin=None):
+    def __init__(self, strin=None, nproc=1, use_cache=False):
         self.chunks = []
         if strin is not None:
-            self.read_file(strin)
+            self.read_file(strin, nproc, use_cache)
     # __init__()
 
-    def read_file(self, strin):
+    def read_file(self, strin, nproc=1, use_cache=False):
+        """
+        If use_cache, chunks are saved in strin+".npz" (see dump_npz()) and loaded from there next time
+        unless the stream file is modified.
+        """
+        if use_cache:
+            npzin = strin + ".npz"
+            st = os.stat(strin)
+            if os.path.isfile(npzin):
+                try:
+                    if self.load_npz(npzin, stamp=(st.st_size, st.st_mtime)): return
+                except Exception as e:
+                    print("Failed to read cache %s: %s" % (npzin, e), file=sys.stderr)
+
+            self.read_file(strin, nproc)
+            try:
+                self.dump_npz(npzin, stamp=(st.st_size, st.st_mtime))
+            except (IOError, OSError) as e:
+                print("Failed to write cache %s: %s" % (npzin, e), file=sys.stderr)
+            return
+
+        if nproc > 1:
+            assert check_format_version(strin) == "2.2" # TODO support other version
+            self.chunks = list(parallel_stream_map(strin, nproc=nproc, indexed_only=False))
+            return
+
         fin = open(strin)
         line = fin.readline()
         format_ver = re.search(r"CrystFEL stream format ([0-9\.]+)", line).group(1)
@@ -336,6 +445,29 @@ class Streamfile(object):
         self.chunks = pickle.load(open(pklin, "rb"))
     # load_pickle()
 
+    def dump_npz(self, npzout, stamp=None):
+        """save chunks in columnar format. stamp: (size, mtime) of the stream file to check if cache is valid"""
+        cols = chunks_as_columns(self.chunks)
+        if stamp is not None: cols["stamp"] = numpy.array(stamp, dtype=numpy.float64)
+        tmpout = "%s.%d.tmp.npz" % (npzout, os.getpid())
+        try:
+            numpy.savez(tmpout, **cols)
+            os.rename(tmpout, npzout)
+        except:
+            if os.path.exists(tmpout): os.remove(tmpout)
+            raise
+    # dump_npz()
+
+    def load_npz(self, npzin, stamp=None):
+        """returns False (and does not load) if stamp is given and different from that saved"""
+        npz = numpy.load(npzin, allow_pickle=False)
+        cols = dict([(k, npz[k]) for k in npz.files])
+        if stamp is not None and ("stamp" not in cols or tuple(cols["stamp"]) != tuple(stamp)):
+            return False
+        self.chunks = chunks_from_columns(cols)
+        return True
+    # load_npz()
+
     """
     def dump_msgpack(self, msgout):
         open(msgout, "wb").write(msgpack.packb(self.chunks))
@@ -347,30 +479,322 @@ class Streamfile(object):
     """
 # class Streamfile
 
-def stream_iterator(stream, start_at=0, read_reflections=True):
+def open_stream(stream):
+    """open stream file in binary mode"""
     if stream.endswith(".bz2"):
-        fin = bz2.BZ2File(stream)
+        return bz2.BZ2File(stream)
     else:
-        fin = open(stream)
+        return open(stream, "rb")
+# open_stream()
+
+class StreamIndex(object):
+    """
+    Byte offsets and metadata of all chunks in a stream file, read without parsing reflections.
+    If use_cache=True, saved in stream+".idx" (pickle) and reused as long as size and mtime of the stream are unchanged.
+    Chunk number n is the order in the file, including not-indexed chunks.
+    bz2 file is decompressed once into a temporary file on first random access (see open()); call close() to remove it.
+    """
+    version = 1
+    fields = ("start", "end", "filename", "event", "serial", "indexed_by", "cell",
+              "res_lim", "profile_radius", "n_refl")
+
+    def __init__(self, stream, use_cache=False, log_out=sys.stdout):
+        self.stream = stream
+        self.log_out = log_out
+        self.columns = None
+        self.preamble_end = 0
+        self.tmpdir = None
+
+        if not use_cache or not self.load():
+            self.build()
+            if use_cache: self.save()
+    # __init__()
+
+    def index_file_name(self): return self.stream + ".idx"
+
+    def stamp(self):
+        st = os.stat(self.stream)
+        return st.st_size, st.st_mtime
+    # stamp()
+
+    def load(self):
+        idxin = self.index_file_name()
+        if not os.path.isfile(idxin): return False
+        try:
+            tmp = pickle.load(open(idxin, "rb"))
+        except Exception as e:
+            print("Failed to read index %s: %s" % (idxin, e), file=self.log_out)
+            return False
+
+        if tmp.get("version") != self.version or tmp.get("stamp") != self.stamp(): return False
+        self.columns, self.preamble_end = tmp["columns"], tmp["preamble_end"]
+        return True
+    # load()
+
+    def save(self):
+        idxout = self.index_file_name()
+        if not os.access(os.path.dirname(os.path.abspath(idxout)), os.W_OK): return
+        tmpout = "%s.%d.tmp" % (idxout, os.getpid())
+        try:
+            pickle.dump(dict(version=self.version, stamp=self.stamp(),
+                             columns=self.columns, preamble_end=self.preamble_end),
+                        open(tmpout, "wb"), -1)
+            os.rename(tmpout, idxout)
+        except (IOError, OSError) as e:
+            print("Failed to write index %s: %s" % (idxout, e), file=self.log_out)
+    # save()
+
+    def build(self):
+        print("# building chunk index of %s" % self.stream, file=self.log_out)
+        self.columns = dict([(k, []) for k in self.fields])
+        self.preamble_end = None
+        fin = open_stream(self.stream)
+        pos = 0
+        chunk, start, n_refl = None, None, 0
+        section = None # None, "peaks", or "hkls"
 
-    line = fin.readline()
+        for l in fin:
+            if section == "hkls":
+                if l.startswith(b"End of reflections"): section = None
+                else: n_refl += 1
+            elif section == "peaks":
+                if l.startswith(b"End of peak list"): section = None
+            elif b"----- Begin chunk -----" in l:
+                if self.preamble_end is None: self.preamble_end = pos
+                chunk, start, n_refl = Chunk(read_reflections=False), pos, 0
+            elif b"----- End chunk -----" in l:
+                if chunk is not None:
+                    for k, v in (("start", start), ("end", pos+len(l)), ("filename", chunk.filename),
+                                 ("event", chunk.event), ("serial", chunk.serial), ("indexed_by", chunk.indexed_by),
+                                 ("cell", chunk.cell), ("res_lim", chunk.res_lim),
+                                 ("profile_radius", chunk.profile_radius), ("n_refl", n_refl)):
+                        self.columns[k].append(v)
+                chunk = None
+            elif chunk is not None:
+                if l.startswith(b"   h    k    l"): section = "hkls"
+                elif l.startswith(b"Peaks from peak search"): section = "peaks"
+                else: chunk.parse_line(l.decode())
+
+            pos += len(l)
+
+        if self.preamble_end is None: self.preamble_end = pos
+    # build()
+
+    def size(self): return len(self.columns["start"])
+
+    def open(self):
+        """
+        Returns the stream file opened in binary mode for read_raw() etc.
+        Seeking backwards in bz2 file means decompressing from the beginning, so bz2 file is decompressed
+        into a temporary file at the first call.
+        """
+        if not self.stream.endswith(".bz2"): return open(self.stream, "rb")
+
+        if self.tmpdir is None:
+            from yamtbx.util import get_temp_local_dir
+            size = max(self.columns["end"]) if self.columns["end"] else 0
+            self.tmpdir = get_temp_local_dir("stream_", min_bytes=size+self.preamble_end,
+                                             additional_tmpd=os.path.dirname(os.path.abspath(self.stream)))
+            if self.tmpdir is None:
+                print("Warning: no space to decompress %s. reading chunks will be slow." % self.stream, file=self.log_out)
+                return open_stream(self.stream)
+
+            print("# decompressing %s to %s" % (self.stream, self.tmpdir), file=self.log_out)
+            with open(os.path.join(self.tmpdir, "plain.stream"), "wb") as ofs:
+                shutil.copyfileobj(open_stream(self.stream), ofs, 16*1024**2)
+
+        return open(os.path.join(self.tmpdir, "plain.stream"), "rb")
+    # open()
+
+    def close(self):
+        """remove the temporary file made by open()"""
+        if self.tmpdir is not None:
+            shutil.rmtree(self.tmpdir, ignore_errors=True)
+            self.tmpdir = None
+    # close()
+
+    def __del__(self): self.close()
+
+    def metadata(self, n):
+        return dict([(k, self.columns[k][n]) for k in self.fields])
+    # metadata()
+
+    def indexed(self):
+        """chunk numbers of indexed chunks"""
+        return [i for i, x in enumerate(self.columns["indexed_by"]) if x is not None]
+    # indexed()
+
+    def select(self, func):
+        """chunk numbers of which metadata (dict) satisfies func"""
+        return [i for i in range(self.size()) if func(self.metadata(i))]
+    # select()
+
+    def read_raw(self, n, fin=None):
+        if fin is None: fin = self.open()
+        s, e = self.columns["start"][n], self.columns["end"][n]
+        fin.seek(s)
+        return fin.read(e-s)
+    # read_raw()
+
+    def read_preamble(self, fin=None):
+        if fin is None: fin = self.open()
+        fin.seek(0)
+        return fin.read(self.preamble_end)
+    # read_preamble()
+
+    def format_version(self, fin=None):
+        r = re.search(r"CrystFEL stream format ([0-9\.]+)", self.read_preamble(fin).decode())
+        return r.group(1) if r else None
+    # format_version()
+
+    def read_chunk(self, n, read_reflections=True, fin=None):
+        chunk = Chunk(read_reflections=read_reflections)
+        for l in self.read_raw(n, fin).decode().splitlines():
+            if "----- Begin chunk -----" in l or "----- End chunk -----" in l: continue
+            chunk.parse_line(l)
+        return chunk
+    # read_chunk()
+
+    def write_chunks(self, numbers, ofs, write_preamble=True):
+        """write chunks as they are (byte-range copy). ofs must be opened in binary mode."""
+        fin = self.open()
+        if write_preamble: ofs.write(self.read_preamble(fin))
+        for n in numbers: ofs.write(self.read_raw(n, fin))
+    # write_chunks()
+# class StreamIndex
+
+def iter_chunks_in_lines(lines, pos=0, read_reflections=True, indexed_only=True, skip_broken=False):
+    """
+    lines: iterable of lines (bytes) starting at byte offset pos.
+    Yields (start, end, chunk) of properly closed chunks; start and end are byte offsets.
+    If skip_broken, chunks having unparsable lines are skipped instead of raising the error.
+    """
+    chunk, start = None, None
+    for l in lines:
+        if b"----- Begin chunk -----" in l:
+            chunk, start = Chunk(read_reflections=read_reflections), pos
+        elif b"----- End chunk -----" in l:
+            if chunk is not None and not (indexed_only and chunk.indexed_by is None):
+                yield start, pos+len(l), chunk
+            chunk = None
+        elif chunk is not None:
+            try:
+                chunk.parse_line(l.decode())
+            except Exception:
+                if not skip_broken: raise
+                print("Error in reading line: '%s'" % l.decode().rstrip(), file=sys.stderr)
+                chunk = None
+        pos += len(l)
+# iter_chunks_in_lines()
+
+def next_chunk_start(fin, pos):
+    """byte offset of the first "Begin chunk" line at or after pos. fin must be opened in binary mode."""
+    if pos > 0:
+        fin.seek(pos-1)
+        pos += len(fin.readline()) - 1 # to the beginning of next line
+    else:
+        fin.seek(0)
+
+    for l in iter(fin.readline, b""):
+        if b"----- Begin chunk -----" in l: return pos
+        pos += len(l)
+    return pos
+# next_chunk_start()
+
+def chunk_aligned_ranges(stream, nshards):
+    """Split uncompressed stream file into at most nshards byte ranges [start, end) at chunk boundaries"""
+    size = os.path.getsize(stream)
+    fin = open(stream, "rb")
+    starts = []
+    for i in range(nshards):
+        p = next_chunk_start(fin, size*i//nshards)
+        if p < size and (not starts or p > starts[-1]): starts.append(p)
+    return list(zip(starts, starts[1:]+[size]))
+# chunk_aligned_ranges()
+
+def decompressed_blocks(stream, block_bytes):
+    """
+    bz2 file cannot be split by offsets of the compressed file. Instead, the decompressed text is cut
+    into blocks of about block_bytes at chunk boundaries. Yields (offset in decompressed text, bytes).
+    """
+    fin = open_stream(stream)
+    buf, bufsize, start, pos = [], 0, 0, 0
+    for l in fin:
+        if bufsize >= block_bytes and b"----- Begin chunk -----" in l:
+            yield start, b"".join(buf)
+            buf, bufsize, start = [], 0, pos
+        buf.append(l)
+        bufsize += len(l)
+        pos += len(l)
+    if buf: yield start, b"".join(buf)
+# decompressed_blocks()
+
+def check_format_version(stream, log_out=sys.stdout):
+    line = open_stream(stream).readline().decode()
     format_ver = re.search(r"CrystFEL stream format ([0-9\.]+)", line).group(1)
-    print("# format version:", format_ver)
+    print("# format version:", format_ver, file=log_out)
     assert float(format_ver) >= 2.2 # TODO support other version
-    chunk = None
-    count = 0
-    read_flag = False
-    for l in fin:
-        if "----- Begin chunk -----" in l:
-            read_flag = True
-            chunk = Chunk(read_reflections=read_reflections)
-        elif "----- End chunk -----" in l:
-            read_flag = False
-            if chunk.indexed_by is not None:
-                if start_at <= count: yield chunk
-                count += 1
-        elif read_flag:
-            chunk.parse_line(l)
+    return format_ver
+# check_format_version()
+
+def parallel_stream_map(stream, func=None, nproc=1, read_reflections=True, indexed_only=True, skip_broken=False,
+                        block_bytes=64*1024**2):
+    """
+    Parse chunks in byte ranges of the stream file by nproc processes.
+    Yields func(start, end, chunk) (or chunk itself if func is None) for each chunk in the order of the file,
+    where start and end are byte offsets of the chunk (in decompressed text for bz2 file).
+    func is called in worker processes; returning only needed values (e.g. statistics or numpy arrays)
+    rather than Chunk objects saves communication between processes.
+    """
+    from yamtbx.util import bounded_imap
+
+    if stream.endswith(".bz2"):
+        units = ((i, x, None) for i, x in enumerate(decompressed_blocks(stream, block_bytes)))
+    else:
+        nshards = max(nproc*8, os.path.getsize(stream)//block_bytes)
+        units = ((i, None, x) for i, x in enumerate(chunk_aligned_ranges(stream, nshards)))
+
+    def work(unit):
+        seq, block, brange = unit
+        if block is None:
+            fin = open(stream, "rb")
+            fin.seek(brange[0])
+            block = brange[0], fin.read(brange[1]-brange[0])
+
+        ret = []
+        for s, e, chunk in iter_chunks_in_lines(io.BytesIO(block[1]), block[0], read_reflections, indexed_only, skip_broken):
+            ret.append(chunk if func is None else func(s, e, chunk))
+        return seq, ret
+    # work()
+
+    if nproc > 1:
+        # in order, with a limited lookahead (a slow range holds back only a few finished ranges)
+        for seq, ret in bounded_imap(work, units, nproc):
+            for r in ret: yield r
+    else:
+        for unit in units:
+            for r in work(unit)[1]: yield r
+# parallel_stream_map()
+
+def stream_iterator(stream, start_at=0, read_reflections=True, index=None, nproc=1):
+    """
+    Yields indexed chunks. If index (StreamIndex) is given, jumps directly to start_at-th indexed chunk.
+    If nproc > 1, chunks are parsed in parallel (see parallel_stream_map()).
+    """
+    if index is not None:
+        fin = index.open()
+        for n in index.indexed()[start_at:]:
+            yield index.read_chunk(n, read_reflections, fin)
+        return
+
+    check_format_version(stream)
+    if nproc > 1:
+        chunks = parallel_stream_map(stream, nproc=nproc, read_reflections=read_reflections)
+    else:
+        chunks = (x[2] for x in iter_chunks_in_lines(open_stream(stream), read_reflections=read_reflections))
+
+    for i, chunk in enumerate(chunks):
+        if start_at <= i: yield chunk
 # stream_iterator()
 
 def stream_header(ver="2.3"):
@@ -19,101 +19,303 @@ import json
 import struct
 import numpy
 import os
+import threading
+import collections
 from yamtbx.dataproc import software_binning
 
-def read_stream_data(frames, bss_job_mode=4):
-    import lz4
-    import bitshuffle
-    if len(frames) != 5:
-        return None, None
-
-    header = json.loads(frames[0].bytes)
-    for i in (1,3,4): header.update(json.loads(frames[i].bytes))
-
-    if header.get("bss_job_mode", 4) != bss_job_mode:
-        return None, None
-
-    dtype = header["type"]
-    shape = header["shape"][::-1]
-
-    if dtype in ("int32","uint32"): byte = 4
-    elif dtype in ("int16","uint16"): byte = 2
-    else: raise RuntimeError("Unknown dtype (%s)"%dtype)
-
-    size = byte*shape[0]*shape[1]
-
-    if header["encoding"] == "lz4<":
-        data = lz4.loads(struct.pack('<I', size) + frames[2].bytes)
-        data = numpy.fromstring(data, dtype=dtype).reshape(shape)
-        assert data.size * data.dtype.itemsize == size
-    elif header["encoding"] == "bs32-lz4<":
-        data = frames[2].bytes
-        blob = numpy.fromstring(data[12:],dtype=numpy.uint8)
-        # blocksize is big endian uint32 starting at byte 8, divided by element size
-        blocksize = numpy.ndarray(shape=(),dtype=">u4", buffer=data[8:12])/4
-        data = bitshuffle.decompress_lz4(blob, shape, numpy.dtype(dtype), blocksize)
-        data = data.reshape(shape)
-    elif header["encoding"] == "bs16-lz4<":
-        data = frames[2].bytes
-        blob = numpy.fromstring(data[12:],dtype=numpy.uint8)
-        data = bitshuffle.decompress_lz4(blob, shape, numpy.dtype(dtype))
-        data = data.reshape(shape)
-    else:
-        RuntimeError("Unknown encoding (%s)"%header["encoding"])
+class StreamFrameDecoder(object):
+    """
+    Decodes images from EIGER stream (zmq frames received with copy=False) into int32 arrays.
+    Compressed data are read from zmq buffers without copy, and the result can be written into
+    a given array (e.g. in shared memory) so that nothing is allocated per frame except for decompression.
+    Pixels of the maximum value (bad pixels) are set to -1.
+    """
+    def __init__(self):
+        self._bad = None # reused buffer for bad pixel selection
+    # __init__()
+
+    @staticmethod
+    def read_header(frames, bss_job_mode=4):
+        """returns header dict or None if frames are not of image"""
+        if len(frames) != 5: return None
+        header = json.loads(frames[0].bytes)
+        for i in (1,3,4): header.update(json.loads(frames[i].bytes))
+        if header.get("bss_job_mode", 4) != bss_job_mode: return None
+        return header
+    # read_header()
+
+    @staticmethod
+    def frame_shape(header):
+        return tuple(header["shape"][::-1])
+
+    @staticmethod
+    def decompress(header, buf):
+        """returns decompressed array of original dtype. buf: bytes-like of compressed data"""
+        import lz4
+        import bitshuffle
+        dtype = numpy.dtype(str(header["type"]))
+        shape = StreamFrameDecoder.frame_shape(header)
+        if dtype.itemsize not in (2, 4): raise RuntimeError("Unknown dtype (%s)"%dtype)
+        size = dtype.itemsize*shape[0]*shape[1]
+
+        if header["encoding"] == "lz4<":
+            try:
+                import lz4.block
+                data = lz4.block.decompress(buf, uncompressed_size=size)
+            except ImportError: # old lz4
+                data = lz4.loads(struct.pack('<I', size) + bytes(buf))
+            data = numpy.frombuffer(data, dtype=dtype).reshape(shape)
+            assert data.size * data.dtype.itemsize == size
+        elif header["encoding"] == "bs32-lz4<":
+            blob = numpy.frombuffer(buf, dtype=numpy.uint8, offset=12)
+            # blocksize is big endian uint32 starting at byte 8, divided by element size
+            blocksize = struct.unpack(">I", bytes(buf[8:12]))[0]//4
+            data = bitshuffle.decompress_lz4(blob, shape, dtype, blocksize)
+            data = data.reshape(shape)
+        elif header["encoding"] == "bs16-lz4<":
+            blob = numpy.frombuffer(buf, dtype=numpy.uint8, offset=12)
+            data = bitshuffle.decompress_lz4(blob, shape, dtype)
+            data = data.reshape(shape)
+        else:
+            raise RuntimeError("Unknown encoding (%s)"%header["encoding"])
 
-    bad_sel = data==2**(byte*8)-1
-    data = data.astype(numpy.int32)
-    data[bad_sel] = -1
-    return header, data
+        return data
+    # decompress()
+
+    def decode(self, frames, bss_job_mode=4, out=None, header=None):
+        """
+        out: int32 array of the image shape to write into. If None, new array is allocated.
+        header: result of read_header() if already read.
+        Returns (header, data) or (None, None) if frames are not of image.
+        """
+        if header is None: header = self.read_header(frames, bss_job_mode)
+        if header is None: return None, None
+        return header, self.decode_raw(header, frames[2].buffer, out)
+    # decode()
+
+    def decode_raw(self, header, buf, out=None):
+        """
+        Decodes compressed image data (bytes-like; e.g. the third zmq frame copied into shared memory).
+        Returns int32 array (out if given).
+        """
+        raw = self.decompress(header, buf)
+        if out is None: out = numpy.empty(raw.shape, dtype=numpy.int32)
+        numpy.copyto(out, raw, casting="unsafe")
+
+        if self._bad is None or self._bad.shape != raw.shape:
+            self._bad = numpy.empty(raw.shape, dtype=bool)
+        uraw = raw.view("u%d" % raw.dtype.itemsize)
+        numpy.equal(uraw, numpy.iinfo(uraw.dtype).max, out=self._bad)
+        out[self._bad] = -1
+        return out
+    # decode_raw()
+# class StreamFrameDecoder
+
+def read_stream_data(frames, bss_job_mode=4):
+    return StreamFrameDecoder().decode(frames, bss_job_mode)
 # read_stream_data()
 
-def data_as_int32_masked(data, apply_pixel_mask, h5handle):
+def data_as_int32_masked(data, apply_pixel_mask, h5handle, mask_sel=None):
+    """
+    mask_sel: (mask==1, mask>1) of pixel mask if already decoded (see MasterH5.mask_sel()).
+              If None, pixel mask is read from h5handle.
+    """
     bad_sel = data == 2**(data.dtype.itemsize*8)-1
     data = data.astype(numpy.int32)
     data[bad_sel] = -3 # To see pixels not masked by pixel mask.
-    if apply_pixel_mask and "/entry/instrument/detector/detectorSpecific/pixel_mask" in h5handle:
-        mask = h5handle["/entry/instrument/detector/detectorSpecific/pixel_mask"][:]
-        data[mask==1] = -1
-        data[mask>1] = -2
+    if apply_pixel_mask:
+        if mask_sel is None: mask_sel = decode_pixel_mask(h5handle)
+        if mask_sel is not None:
+            data[mask_sel[0]] = -1
+            data[mask_sel[1]] = -2
 
     return data
 # data_as_int32()
 
+def decode_pixel_mask(h5handle):
+    """returns (mask==1, mask>1) or None if no pixel mask"""
+    if "/entry/instrument/detector/detectorSpecific/pixel_mask" not in h5handle: return None
+    mask = h5handle["/entry/instrument/detector/detectorSpecific/pixel_mask"][:]
+    return mask==1, mask>1
+# decode_pixel_mask()
+
+class FrameCache(object):
+    """
+    LRU cache of decoded frames (numpy arrays) with a limit of total bytes.
+    Cached arrays are set read-only as they are shared by callers.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.frames = collections.OrderedDict()
+    # __init__()
+
+    def get(self, key):
+        data = self.frames.get(key)
+        if data is not None:
+            del self.frames[key]
+            self.frames[key] = data
+        return data
+    # get()
+
+    def put(self, key, data):
+        if data.nbytes > self.max_bytes: return
+        if key in self.frames: self.nbytes -= self.frames.pop(key).nbytes
+        data.flags.writeable = False
+        self.frames[key] = data
+        self.nbytes += data.nbytes
+        self.shrink()
+    # put()
+
+    def shrink(self):
+        while self.nbytes > self.max_bytes:
+            self.nbytes -= self.frames.popitem(last=False)[1].nbytes
+    # shrink()
+
+    def clear(self):
+        self.frames.clear()
+        self.nbytes = 0
+    # clear()
+# class FrameCache
+
+class MasterH5(object):
+    """
+    Opened master h5 file with map of frame number -> (data key, index in dataset) and decoded pixel mask.
+    Use get_master_h5() to get one from the process-wide pool instead of creating directly.
+    """
+    def __init__(self, h5master):
+        self.h5master = h5master
+        self.stamp = file_stamp(h5master)
+        self.h5 = h5py.File(h5master, "r")
+        self.frame_map = {}
+        self.datasets = {}
+        self.pending_keys = sorted(self.h5["/entry/data"].keys())
+        self._mask_sel = None
+        self.update_frame_map()
+    # __init__()
+
+    def update_frame_map(self):
+        # Data files which do not exist yet (during data collection) are checked again next time.
+        pending = []
+        for k in self.pending_keys:
+            ds = self.h5["/entry/data"].get(k)
+            if not ds:
+                pending.append(k)
+                continue
+            image_nr_low = int(ds.attrs["image_nr_low"])
+            image_nr_high = int(ds.attrs["image_nr_high"])
+            self.datasets[k] = ds
+            for nr in range(image_nr_low, image_nr_high+1):
+                self.frame_map.setdefault(nr, (k, nr-image_nr_low))
+        self.pending_keys = pending
+    # update_frame_map()
+
+    def available_frame_numbers(self):
+        if self.pending_keys: self.update_frame_map()
+        return sorted(self.frame_map)
+    # available_frame_numbers()
+
+    def mask_sel(self):
+        if self._mask_sel is None:
+            self._mask_sel = decode_pixel_mask(self.h5) or ()
+        return self._mask_sel if self._mask_sel else None
+    # mask_sel()
+
+    def read_frame(self, frameno):
+        """returns raw frame data (read-only array) or None if not found"""
+        if frameno not in self.frame_map and self.pending_keys: self.update_frame_map()
+        if frameno not in self.frame_map: return None
+
+        key = (self.h5master, self.stamp, frameno)
+        with _pool_lock:
+            data = _frame_cache.get(key)
+        if data is not None: return data
+
+        k, idx = self.frame_map[frameno]
+        ds = self.datasets[k]
+        nchunk = ds.chunks[0] if ds.chunks else 1
+        frame_bytes = ds.dtype.itemsize * int(numpy.prod(ds.shape[1:]))
+        if nchunk > 1 and frame_bytes * nchunk <= _frame_cache.max_bytes:
+            # decompress whole chunk once and keep all frames in it
+            c0 = idx // nchunk * nchunk
+            block = ds[c0:min(c0+nchunk, ds.shape[0])]
+            frames = [block[j].copy() for j in range(block.shape[0])] # not views, so the block can be freed
+            with _pool_lock:
+                for j, f in enumerate(frames):
+                    _frame_cache.put((self.h5master, self.stamp, frameno-idx+c0+j), f)
+            return frames[idx-c0]
+
+        data = ds[idx,]
+        with _pool_lock:
+            _frame_cache.put(key, data)
+        return data
+    # read_frame()
+# class MasterH5
+
+def file_stamp(f):
+    st = os.stat(f)
+    return st.st_size, st.st_mtime
+# file_stamp()
+
+_pool_lock = threading.RLock()
+_pool = collections.OrderedDict()
+_pool_pid = os.getpid()
+_pool_max_handles = 16
+_frame_cache = FrameCache(256*1024**2)
+
+def set_cache_limits(max_handles=None, frame_cache_bytes=None):
+    global _pool_max_handles
+    with _pool_lock:
+        if max_handles is not None: _pool_max_handles = max(1, max_handles)
+        if frame_cache_bytes is not None:
+            _frame_cache.max_bytes = frame_cache_bytes
+            _frame_cache.shrink()
+# set_cache_limits()
+
+def clear_cache():
+    with _pool_lock:
+        _pool.clear()
+        _frame_cache.clear()
+# clear_cache()
+
+def get_master_h5(h5master):
+    """
+    Returns MasterH5 from the process-wide LRU pool. Reopened if the file was modified.
+    Handles dropped from the pool are not closed explicitly, so that datasets returned before stay valid.
+    """
+    global _pool_pid
+    key = os.path.abspath(h5master)
+    with _pool_lock:
+        if _pool_pid != os.getpid(): # forked. h5 handles should not be shared
+            _pool.clear()
+            _frame_cache.clear()
+            _pool_pid = os.getpid()
+
+        m = _pool.pop(key, None)
+        if m is None or m.stamp != file_stamp(key):
+            m = MasterH5(key)
+        _pool[key] = m
+        while len(_pool) > _pool_max_handles:
+            _pool.popitem(last=False)
+        return m
+# get_master_h5()
+
 def data_iter(h5master, apply_pixel_mask=True, return_raw=False):
     h5 = h5py.File(h5master, "r")
+    mask_sel = decode_pixel_mask(h5) if apply_pixel_mask and not return_raw else None
     data = None
 
     for k in sorted(h5["/entry/data"].keys()):
         if not h5["/entry/data"].get(k): continue
         for data in h5["/entry/data"][k]:
             if not return_raw:
-                data = data_as_int32_masked(data, apply_pixel_mask, h5)
+                data = data_as_int32_masked(data, apply_pixel_mask, h5, mask_sel)
             yield data
 # extract_data()
 
 def extract_data(h5master, frameno, apply_pixel_mask=True, return_raw=False):
-    h5 = h5py.File(h5master, "r")
-    data = None
-
-    if 0:
-        i_seen = 0
-        for k in sorted(h5["/entry/data"].keys()):
-            try:
-                for i in range(h5["/entry/data"][k].shape[0]):
-                    i_seen += 1
-                    if i_seen == frameno:
-                        data = h5["/entry/data"][k][i,]
-            except KeyError:
-                break
-    else:
-        for k in sorted(h5["/entry/data"].keys()):
-            if not h5["/entry/data"].get(k): continue
-            image_nr_low = h5["/entry/data"][k].attrs["image_nr_low"]
-            image_nr_high = h5["/entry/data"][k].attrs["image_nr_high"]
-            if image_nr_low <= frameno <= image_nr_high:
-                idx = frameno - image_nr_low
-                data = h5["/entry/data"][k][idx,]
-                break
+    m = get_master_h5(h5master)
+    data = m.read_frame(frameno)
 
     if data is None:
         print("Data not found.")
@@ -122,23 +324,16 @@ def extract_data(h5master, frameno, apply_pixel_mask=True, return_raw=False):
     if return_raw:
         return data
 
-    return data_as_int32_masked(data, apply_pixel_mask, h5)
+    return data_as_int32_masked(data, apply_pixel_mask, m.h5, m.mask_sel())
 # extract_data()
 
 def get_available_frame_numbers(h5master):
-    h5 = h5py.File(h5master, "r")
-    ret = []
-    for k in sorted(h5["/entry/data"].keys()):
-        if not h5["/entry/data"].get(k): continue
-        image_nr_low = int(h5["/entry/data"][k].attrs["image_nr_low"])
-        image_nr_high = int(h5["/entry/data"][k].attrs["image_nr_high"])
-        ret.extend(range(image_nr_low, image_nr_high+1))
-    return ret
+    return get_master_h5(h5master).available_frame_numbers()
 # get_available_frame_numbers()
 
 def extract_data_path(h5master, path, apply_pixel_mask=True, return_raw=False):
-    h5 = h5py.File(h5master, "r")
-    data = h5.get(path)
+    m = get_master_h5(h5master)
+    data = m.h5.get(path)
     if data is None:
         print("Data not found.")
         return data
@@ -147,11 +342,12 @@ def extract_data_path(h5master, path, apply_pixel_mask=True, return_raw=False):
         return data
 
     data = data[:]
-    return data_as_int32_masked(data, apply_pixel_mask, h5)
+    return data_as_int32_masked(data, apply_pixel_mask, m.h5, m.mask_sel())
 # extract_data()
 
 def extract_data_range_sum(h5master, frames):
-    h5 = h5py.File(h5master, "r")
+    m = get_master_h5(h5master)
+    h5 = m.h5
     i_seen = 0
     i_found = 0
     data = None
@@ -176,10 +372,10 @@ def extract_data_range_sum(h5master, frames):
 
     data[data<0] = -3 # To see pixels not masked by pixel mask.
     # Apply pixel mask
-    if "/entry/instrument/detector/detectorSpecific/pixel_mask" in h5:
-        mask = h5["/entry/instrument/detector/detectorSpecific/pixel_mask"][:]
-        data[mask==1] = -1
-        data[mask>1] = -2
+    mask_sel = m.mask_sel()
+    if mask_sel is not None:
+        data[mask_sel[0]] = -1
+        data[mask_sel[1]] = -2
 
     if i_found != len(frames): return None
     return data
@@ -204,7 +400,7 @@ def extract_to_minicbf(h5master, frameno_or_path, cbfout, binning=1):
         raise RuntimeError("Cannot extract frame %s from %s"%(frameno_or_path, h5master))
 
     h = eiger_hdf5_interpreter.Interpreter().getRawHeadDict(h5master)
-    h5 = h5py.File(h5master, "r")
+    h5 = get_master_h5(h5master).h5
 
     if binning>1:
         beamxy = h["BeamX"], h["BeamY"]
@@ -254,6 +450,71 @@ def compress_h5data(h5obj, path, data, chunks, compression="bslz4"):
     return dataset
 # compress_h5data()
 
+def is_frame_chunked_bslz4(ds):
+    """True if each chunk of the dataset is one frame compressed by bitshuffle+lz4"""
+    if ds.chunks is None or ds.chunks[0] != 1 or tuple(ds.chunks[1:]) != tuple(ds.shape[1:]):
+        return False
+    plist = ds.id.get_create_plist()
+    return 32008 in [plist.get_filter(i)[0] for i in range(plist.get_nfilters())] # bitshuffle filter id
+# is_frame_chunked_bslz4()
+
+def read_raw_frames(h5master, frames, nproc=1):
+    """
+    Yields (frameno, item) for requested frames, where item is
+      ("chunk", filter_mask, compressed bytes, frame shape, dtype str) if the frame can be copied without decompression,
+      ("data", numpy array) otherwise, or None if not found.
+    Frames are grouped by data file and each data file is read by one of nproc processes.
+    """
+    m = get_master_h5(h5master)
+    m.update_frame_map()
+    groups = collections.OrderedDict()
+    for f in frames:
+        if f not in m.frame_map:
+            yield f, None
+            continue
+        groups.setdefault(m.frame_map[f][0], []).append(f)
+
+    def work(args):
+        k, frames = args
+        m = get_master_h5(h5master)
+        ds = m.datasets[k]
+        direct = is_frame_chunked_bslz4(ds)
+        ret = []
+        for f in frames:
+            idx = m.frame_map[f][1]
+            if direct:
+                filter_mask, raw = ds.id.read_direct_chunk((idx,)+(0,)*(ds.ndim-1))
+                ret.append((f, ("chunk", filter_mask, raw, ds.shape[1:], ds.dtype.str)))
+            else:
+                ret.append((f, ("data", ds[idx,])))
+        return ret
+    # work()
+
+    if nproc > 1 and len(groups) > 1:
+        from yamtbx.util import bounded_imap_unordered
+        results = bounded_imap_unordered(work, list(groups.items()), min(nproc, len(groups)))
+    else:
+        results = map(work, groups.items())
+
+    for ret in results:
+        for r in ret: yield r
+# read_raw_frames()
+
+def write_raw_frame(h5obj, path, item):
+    """write item from read_raw_frames() as a dataset (one chunk of bslz4 frame)"""
+    if item[0] == "data":
+        return compress_h5data(h5obj, path, item[1], chunks=None, compression="bslz4")
+
+    import bitshuffle.h5
+    _, filter_mask, raw, shape, dtype = item
+    dataset = h5obj.create_dataset(path, shape,
+                                   compression=bitshuffle.h5.H5FILTER,
+                                   compression_opts=(0, bitshuffle.h5.H5_COMPRESS_LZ4),
+                                   chunks=shape, dtype=numpy.dtype(dtype))
+    dataset.id.write_direct_chunk((0,)*len(shape), raw, filter_mask)
+    return dataset
+# write_raw_frame()
+
 def get_data_file_nr_range(data_h5):
     h5 = h5py.File(data_h5, "r")
     data = h5["/entry/data/data"]
@@ -277,7 +538,7 @@ def create_data_file(outfile, data, chunks, nrlow, nrhigh, compression="bslz4"):
 def get_masterh5_related_filenames(masterh5):
     ret = [masterh5]
 
-    h5 = h5py.File(masterh5, "r")
+    h5 = get_master_h5(masterh5).h5
     for k in h5["/entry/data"]:
         ret.append(os.path.join(os.path.dirname(masterh5),
                                 h5["/entry/data"].get(k, getlink=True).filename))
@@ -1,7 +1,7 @@
 from __future__ import print_function
 from __future__ import unicode_literals
 import  sqlite3
-import pickle
+from yamtbx.dataproc.myspotfinder import shikadb
 import datetime
 
 def read_db(dbfile):
@@ -19,9 +19,8 @@ def read_db(dbfile):
     except sqlite3.OperationalError:
          print("TABLE updates does not exist\n")
 
-    print("TABLE spots")
-    c = con.execute("select filename,spots from spots")
-    results = dict([(str(x[0]), pickle.loads(str(x[1]))) for x in c.fetchall()])
+    print("TABLE results")
+    results = shikadb.read_results(con)
     for filename in sorted(results):
         msg = results[filename]
         spots = msg["spots"]
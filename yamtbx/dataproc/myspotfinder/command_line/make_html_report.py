@@ -17,6 +17,7 @@ from PIL import Image
 import iotbx.phil
 from yamtbx.util import rotate_file
 from yamtbx.dataproc.myspotfinder import shikalog
+from yamtbx.dataproc.myspotfinder import shikadb
 from yamtbx.dataproc.myspotfinder.command_line.spot_finder_gui import Stat
 from yamtbx.dataproc.dataset import re_pref_num_ext
 from yamtbx.dataproc import bl_logfiles
@@ -261,8 +262,7 @@ def make_html_report(current_stats, wdir, htmlout, zoo_mode, rotate=False, plot_
     con = sqlite3.connect(dbfile, timeout=10, isolation_level=None)
     con.execute('pragma query_only = ON;')
     print("Reading data from DB for making report html.")
-    c = con.execute("select filename,spots from spots")
-    dbspots = dict([(str(x[0]), pickle.loads(x[1])) for x in c.fetchall()])
+    dbspots = shikadb.read_results(con, filenames=set([os.path.basename(f) for f, stat in result if stat is not None]))
     spot_data = "var spot_data = {"
     for i, (f, stat) in enumerate(result):
         if stat is None: continue
@@ -483,8 +483,7 @@ def load_results(target_dir):
 
     for itrial in range(60):
         try:
-            c = con.execute("select filename,spots from spots")
-            results = dict([(str(x[0]), pickle.loads(x[1])) for x in c.fetchall()])
+            results = shikadb.read_summaries(con) # spots are read only in make_html_report()
             break
         except sqlite3.DatabaseError:
             shikalog.warning("DB failed. retrying (%d)" % itrial)
@@ -503,14 +502,10 @@ def load_results(target_dir):
             imgfs_found = [x for x in possible_imgfs if x in results]
             if not imgfs_found: continue
             imgf = imgfs_found[0]
-            snrlist = [x[2] for x in results[imgf]["spots"]]
-            stat.stats = (len(snrlist), sum(snrlist), numpy.median(snrlist) if snrlist else 0)
-            stat.spots = results[imgf]["spots"]
+            stat.stats = results[imgf]
             stat.gonio = gonio
             stat.grid_coord = gc
             stat.scan_info = scan
-            stat.thumb_posmag = results[imgf]["thumb_posmag"]
-            stat.params = results[imgf]["params"]
             stat.img_file = os.path.join(target_dir, imgf)
             result.append((stat.img_file, stat))
 
@@ -3,19 +3,18 @@ from __future__ import unicode_literals
 from yamtbx.dataproc.myspotfinder.command_line.spot_finder_gui import Stat
 from yamtbx.dataproc import bl_logfiles
 import sqlite3
-import pickle
+from yamtbx.dataproc.myspotfinder import shikadb
 import os
 import numpy
 
 def read_db(scanlog, dbfile):
     con = sqlite3.connect(dbfile, timeout=10)
     try:
-        c = con.execute("select filename,spots from spots")
+        results = shikadb.read_summaries(con)
     except sqlite3.OperationalError:
         print("# DB Error (%s)" % dbfile)
         return None
 
-    results = dict([(str(x[0]), pickle.loads(str(x[1]))) for x in c.fetchall()])
     ret = []
 
     slog = bl_logfiles.BssDiffscanLog(scanlog)
@@ -26,14 +25,10 @@ def read_db(scanlog, dbfile):
             #print imgf, (gonio, gc) 
             stat = Stat()
             if imgf not in results: continue
-            snrlist = [x[2] for x in results[imgf]["spots"]]
-            stat.stats = (len(snrlist), sum(snrlist), numpy.median(snrlist) if snrlist else 0)
-            stat.spots = results[imgf]["spots"]
+            stat.stats = results[imgf] # (n_spots, total, median)
             stat.gonio = gonio
             stat.grid_coord = gc
             stat.scan_info = scan
-            stat.thumb_posmag = results[imgf]["thumb_posmag"]
-            stat.params = results[imgf]["params"]
             stat.img_file = imgf # os.path.join(self.ctrlFrame.current_target_dir, imgf)
             ret.append((scan.get_prefix(), stat.img_file, stat))
     return ret
@@ -16,6 +16,9 @@ import stat
 import time
 import datetime
 import getpass
+import socket
+import tempfile
+import json
 import zmq
 import re
 import queue
@@ -29,14 +32,20 @@ import pickle
 import hashlib
 from PIL import Image
 from multiprocessing import Process
-#import inotify.adapters # use yamtbx.python -mpip install inotify
+try:
+    import inotify.adapters # use yamtbx.python -mpip install inotify
+    import inotify.constants
+except ImportError:
+    inotify = None
 
 from yamtbx.dataproc.myspotfinder import shikalog
 from yamtbx.dataproc.myspotfinder import config_manager
+from yamtbx.dataproc.myspotfinder import shikadb
 from yamtbx.dataproc.myspotfinder import spot_finder_for_grid_scan
 from yamtbx.dataproc import bl_logfiles
 from yamtbx.dataproc import eiger
 from yamtbx import util
+from yamtbx.util.shared_store import SharedArrays
 
 #DEBUG for inotify
 #import logging
@@ -80,6 +89,9 @@ env = *oys ppu
 eiger_host = "192.168.163.204"
  .type = str
  .help = "EIGER hostname or ip-address"
+eiger_stream_buffer_mb = 512
+ .type = float
+ .help = "Shared memory for compressed frames received from EIGER and not yet decoded by workers (MB)"
 
 #incomplete_file_workaround = 0
 # .type = float
@@ -92,9 +104,16 @@ only_check_in_last_hours = 1
  .help = "Only check diffscan.log modified during the last specified hours"
 ramdisk_walk_interval = 2
  .type = float
+ .help = "Interval of checking /ramdisk. When inotify is available, this is for the walk to find files missed by inotify, and at least 30 sec."
+ramdisk_processed_db = None
+ .type = path
+ .help = "sqlite3 file to record processed files in /ramdisk. Default: ~/.shikatmp/ramdisk_processed_HOSTNAME.db"
 thumbnail = true
  .type = bool
  .help = "Create thumbnail jpg files of diffraction images"
+db_wal = None
+ .type = bool
+ .help = "Use WAL journal mode for shika.db. None: only if shika.db is on a local file system (WAL does not work if it is read from other hosts over network file system)."
 """
 
 params = None
@@ -126,7 +145,7 @@ class DiffScanManager(object):
     def update_scanlogs(self):
         for logdir, slog in list(self.scanlog.items()):
             if os.path.isfile(slog.scanlog):
-                slog.parse()
+                slog.update() # only appended lines
             else:
                 shikalog.error("diffraction scan log is not found!: %s" %slog.scanlog)
                 continue
@@ -231,12 +250,9 @@ class DiffScanManager(object):
         if not dirname in self.scanlog:
             shikalog.warning("get_scan_info(): directory is not found: %s" % dirname)
             return None
-        for scan in reversed(self.scanlog[dirname].scans):
-            if scan.match_file_with_template(filename):
-                return scan
-
-        shikalog.warning("get_scan_info(): Not in scans: %s" % dirname)
-        return None
+        scan = self.scanlog[dirname].get_scan(basename)
+        if scan is None: shikalog.warning("get_scan_info(): Not in scans: %s" % dirname)
+        return scan
     # get_scan_info()
 
     def get_gonio_xyz_phi(self, filename):
@@ -245,14 +261,13 @@ class DiffScanManager(object):
 
         if not dirname in self.scanlog:
             return None
-        for scan in reversed(self.scanlog[dirname].scans):
-            for f, c in scan.filename_coords:
-                if basename == f:
-                    if scan.is_shutterless():
-                        return list(c[0]) + [scan.fixed_spindle]
-                    else:
-                        return list(c[0]) + [scan.osc_start]
-        return None
+        found = self.scanlog[dirname].lookup(basename)
+        if found is None: return None
+        scan, gonio, gc = found
+        if scan.is_shutterless():
+            return list(gonio) + [scan.fixed_spindle]
+        else:
+            return list(gonio) + [scan.osc_start]
 
     # get_gonio_xyz_phi()
 
@@ -540,13 +555,76 @@ def walk_nolink(top, topdown=True, onerror=None):
         yield top, dirs, nondirs
 # walk_nolink()
 
+class ProcessedFiles(object):
+    """
+    Set of processed files with mtime, saved in sqlite3 file so that it survives restarts.
+    Replaces .touch files created next to images.
+    """
+    def __init__(self, dbfile):
+        dbdir = os.path.dirname(dbfile)
+        if dbdir and not os.path.exists(dbdir): os.makedirs(dbdir)
+        self.con = sqlite3.connect(dbfile, timeout=30, check_same_thread=False)
+        self.con.execute("create table if not exists processed (path text primary key, mtime real);")
+        self.con.commit()
+        self.files = dict(self.con.execute("select path,mtime from processed").fetchall())
+        self.lock = threading.Lock()
+        self._pending = []
+    # __init__()
+
+    def is_processed(self, path, mtime):
+        t = self.files.get(path)
+        return t is not None and t >= mtime
+    # is_processed()
+
+    def add(self, path, mtime):
+        with self.lock:
+            self.files[path] = mtime
+            self._pending.append((path, mtime))
+    # add()
+
+    def commit(self):
+        with self.lock:
+            if not self._pending: return
+            with self.con:
+                self.con.executemany("insert or replace into processed values (?,?)", self._pending)
+            self._pending = []
+    # commit()
+
+    def retain(self, existing):
+        """
+        forget files removed from ramdisk. existing is a set of files found by walking; files not in it
+        are checked again because they may have been written (and processed) after the walk passed the directory.
+        """
+        with self.lock:
+            removed = [x for x in self.files if x not in existing and not os.path.exists(x)]
+            for x in removed: del self.files[x]
+            if removed:
+                with self.con:
+                    self.con.executemany("delete from processed where path=?", [(x,) for x in removed])
+    # retain()
+# class ProcessedFiles
+
 class WatchRamdiskThread(object):
-    def __init__(self, pushport, interval):
+    """
+    Send new .cbf files in /ramdisk to workers.
+    New files are detected by inotify if available (pip install inotify), and by walking /ramdisk
+    periodically to find files missed by inotify (e.g. written before a watch on new directory was added).
+    Only the file paths are sent; /ramdisk is in memory and workers read the files directly.
+    """
+    def __init__(self, pushport, interval, topdir="/ramdisk", processed_db=None):
         self.interval = interval
+        self.topdir = topdir
         self.thread = None
+        self.inotify_thread = None
         self.zmq_context = zmq.Context()
         self.ventilator_send = self.zmq_context.socket(zmq.PUSH)
         self.ventilator_send.bind("tcp://*:%d"%pushport)
+        self.lock = threading.Lock() # for sending; zmq socket is not thread-safe
+        if processed_db is None:
+            processed_db = os.path.join(os.path.expanduser("~"), ".shikatmp",
+                                        "ramdisk_processed_%s.db" % socket.gethostname())
+        self.processed = ProcessedFiles(processed_db)
+        self.uid = os.getuid()
 
     def start(self, interval=None):
         self.stop()
@@ -560,96 +638,94 @@ class WatchRamdiskThread(object):
         self.thread.daemon = True
         self.thread.start()
 
+        if inotify is not None:
+            self.inotify_thread = threading.Thread(None, self.run_inotify)
+            self.inotify_thread.daemon = True
+            self.inotify_thread.start()
+        else:
+            shikalog.info("inotify is not available. Only walking %s" % self.topdir)
+
     def stop(self):
         if self.is_running():
             #shikalog.info("Stopping WatchRamdiskThread.. Wait.")
             self.keep_going = False
             self.thread.join()
+            if self.inotify_thread is not None: self.inotify_thread.join()
         else:
             pass
             #shikalog.info("WatchRamdiskThread already stopped.")
 
     def is_running(self): return self.thread is not None and self.thread.is_alive()
 
-    def run_inner_inotify(self):
-        #shikalog.debug("in WatchRamdiskThread timer")
-        startt = time.time()
+    def process_if_new(self, imgf, lst=None):
+        """lst: os.lstat() result if already available. returns True if sent"""
+        if lst is None:
+            try: lst = os.lstat(imgf)
+            except OSError: return False # removed
+
+        # don't process if link or other user's file
+        if stat.S_ISLNK(lst.st_mode) or lst.st_uid != self.uid: return False
+        if self.processed.is_processed(imgf, lst.st_mtime): return False
+        if lst.st_size < 1000: return False
+
+        with self.lock: # the same file may be found by inotify and walk at the same time
+            if self.processed.is_processed(imgf, lst.st_mtime): return False
+            try:
+                with open(imgf, "rb") as f:
+                    if b"Comment" not in f.read(1000): return False # header not written yet
+            except IOError:
+                return False
 
-        def is_processed(path, touch):
-            if not os.path.exists(touch): return False
-            mtime_touch = os.path.getmtime(touch)
-            mtime_path = os.path.getmtime(path)
-            return mtime_touch > mtime_path
-
-        itree = inotify.adapters.InotifyTree('/ramdisk',
-                                             mask=inotify.constants.IN_MOVED_TO|inotify.constants.IN_CLOSE_WRITE)
-        for header, type_names, path, filename in itree.event_gen(yield_nones=False):
-            print(type_names, path, filename)
-            if "IN_ISDIR" in type_names: continue
-            #if "IN_MOVED_TO" not in type_names: continue
-            if not filename.endswith(".cbf"): continue
-            imgf = os.path.join(path, filename)
-
-            # Check if already processed
-            touch = imgf+".touch"
-            if is_processed(imgf, touch): continue
-
-            # Send it!
             img_isilon = re.sub(r"^/ramdisk/", "/isilon/users/", imgf)
             header = dict(file_prefix=os.path.basename(img_isilon[:img_isilon.rindex("_")]),
                           frame=int(imgf[imgf.rindex("_")+1:imgf.rindex(".cbf")])-1)
-            shikalog.debug("Sending %s,%s" % (header["file_prefix"], header["frame"]+1))
-            msg = dict(imgfile=img_isilon, header=header,
-                       cbf_data=open(imgf, "rb").read())
-            self.ventilator_send.send_pyobj(msg)
-            util.touch_file(touch) # mark as processed
+            shikalog.debug("Sending %s" % img_isilon)
+            self.ventilator_send.send_json(dict(imgfile=img_isilon, read_from=imgf, header=header))
+            self.processed.add(imgf, lst.st_mtime) # mark as processed
+        return True
+    # process_if_new()
+
+    def run_inotify(self):
+        shikalog.info("WatchRamdiskThread inotify STARTED")
+        while self.keep_going:
+            try:
+                itree = inotify.adapters.InotifyTree(self.topdir,
+                                                     mask=inotify.constants.IN_MOVED_TO|inotify.constants.IN_CLOSE_WRITE)
+                last_commit = time.time()
+                for event in itree.event_gen(yield_nones=True, timeout_s=1):
+                    if not self.keep_going: break
+                    if event is not None:
+                        header, type_names, path, filename = event
+                        if "IN_ISDIR" not in type_names and filename.endswith(".cbf"):
+                            self.process_if_new(os.path.join(path, filename))
+
+                    if time.time() - last_commit > 1:
+                        self.processed.commit()
+                        last_commit = time.time()
+            except:
+                shikalog.error("Error in WatchRamdiskThread inotify\n%s" % (traceback.format_exc()))
+                time.sleep(1)
 
-        shikalog.debug("WatchRamdiskThread.run_inner stopped in %.3f sec" % (time.time()-startt))
-    # run_inner_inotify()
+        self.processed.commit()
+        shikalog.info("WatchRamdiskThread inotify FINISHED")
+    # run_inotify()
 
     def run_inner_walk(self):
-        def need_process(root, path_lst, filename_dict):
-            # filenames is list of (filename, lstat); directory name not included
-            # path_lst is (path, lstat(path)); directory name not included
-            path = os.path.join(root, path_lst[0])
-            lst = path_lst[1]
-            # don't process if link
-            if stat.S_ISLNK(lst.st_mode): return False
-            touch = path_lst[0] + ".touch"
-            # process if .touch not exists
-            mtime_touch = filename_dict.get(touch, None)
-            if mtime_touch is None: return lst.st_size >= 1000 and "Comment" in open(path).read(1000)
-            
-            mtime_path = lst.st_mtime
-            if mtime_touch > mtime_path:
-                return False
-            else:
-                shikalog.debug("Newer than touch (%s; %s <= %s)"%(path, mtime_touch, mtime_path))
-                return lst.st_size >= 1000 and "Comment" in open(path).read(1000)
-        # need_process()
-
-        uid = os.getuid()
         start_time = time.time()
-        n_dir = 0
-        for root, dirnames, filenames in walk_nolink("/ramdisk"):
+        n_dir, n_sent = 0, 0
+        existing = set()
+        for root, dirnames, filenames in walk_nolink(self.topdir):
             n_dir += 1
-            if os.stat(root).st_uid != uid: continue
-            cbf_files = [x for x in filenames if x[0].endswith(".cbf")]
-            filename_dict = dict(filenames)
-            new_files = [x for x in cbf_files if need_process(root, x, filename_dict)]
-            new_files = [os.path.join(root, x[0]) for x in new_files]
-
-            for imgf in new_files:
-                img_isilon = re.sub(r"^/ramdisk/", "/isilon/users/", imgf)
-                header = dict(file_prefix=os.path.basename(img_isilon[:img_isilon.rindex("_")]),
-                              frame=int(imgf[imgf.rindex("_")+1:imgf.rindex(".cbf")])-1)
-                shikalog.debug("Sending %s" % img_isilon)
-                msg = dict(imgfile=img_isilon, header=header,
-                           cbf_data=open(imgf, "rb").read())
-                self.ventilator_send.send_pyobj(msg)
-                util.touch_file(imgf+".touch") # mark as processed
-            
-        shikalog.debug("WatchRamdiskThread.run_inner_walk finished in %.3f sec (%d dirs)" % (time.time()-start_time, n_dir))
+            if os.stat(root).st_uid != self.uid: continue
+            for f, lst in filenames:
+                if not f.endswith(".cbf"): continue
+                imgf = os.path.join(root, f)
+                existing.add(imgf)
+                if self.process_if_new(imgf, lst): n_sent += 1
+
+        self.processed.commit()
+        self.processed.retain(existing)
+        shikalog.debug("WatchRamdiskThread.run_inner_walk finished in %.3f sec (%d dirs, %d sent)" % (time.time()-start_time, n_dir, n_sent))
     # run_inner_walk()
 
     def run(self):
@@ -660,10 +736,11 @@ class WatchRamdiskThread(object):
             except:
                 shikalog.error("Error in WatchRamdiskThread\n%s" % (traceback.format_exc()))
 
-            if self.interval < 1:
-                time.sleep(self.interval)
+            interval = self.interval if inotify is None else max(30, self.interval) # walk is just a fallback
+            if interval < 1:
+                time.sleep(interval)
             else:
-                for i in range(int(self.interval/.5)):
+                for i in range(int(interval/.5)):
                     if self.keep_going:
                         time.sleep(.5)
 
@@ -672,21 +749,162 @@ class WatchRamdiskThread(object):
     # run()
 # class WatchRamdiskThread
 
+class ThumbnailMosaicMaker(object):
+    """
+    Makes thumb_prefix/prefix_000001-000100.jpg (10x10 thumbnails) in a separate thread.
+    Open mosaics are kept in memory (up to max_open). A jpg is written when a mosaic is completed or
+    evicted, and every flush_interval seconds for mosaics updated since then (to show progress).
+    Tiles of incomplete mosaics are saved in ~/.shikatmp as .npz to continue later.
+    """
+    def __init__(self, max_open=32, flush_interval=10):
+        self.thread = threading.Thread(None, self.run)
+        self.thread.daemon = True
+        self.queue = queue.Queue()
+        self.max_open = max_open
+        self.flush_interval = flush_interval
+        self.mosaics = collections.OrderedDict() # (wdir, prefix, idx): dict(canvas, filled, n_expected, dirty)
+        self.tmpdir = os.path.join(os.path.expanduser("~"), ".shikatmp")
+    # __init__()
+
+    def start(self):
+        if not self.thread.is_alive():
+            self.keep_going = True
+            self.thread.start()
+    # start()
+
+    def stop(self):
+        self.keep_going = False
+        self.thread.join()
+    # stop()
+
+    def put(self, wdir, msg):
+        """msg: result message including thumbdata and header"""
+        header = msg["header"]
+        # raster_horizontal_number was raster_horizotal_number until bss_jul04_2017
+        hpoint = int(header.get("raster_horizotal_number", header.get("raster_horizontal_number")))
+        vpoint = int(header["raster_vertical_number"])
+        self.queue.put((wdir, str(msg["file_prefix"]), msg["idx"], hpoint*vpoint, msg["thumbdata"]))
+    # put()
+
+    def file_names(self, key):
+        wdir, prefix, idx = key
+        jpgdir = os.path.join(wdir, "thumb_%s" % prefix)
+        jpgout = os.path.join(jpgdir, "%s_%.6d-%.6d.jpg" % (prefix, idx*100+1, (idx+1)*100))
+        tmpfile = os.path.join(self.tmpdir, "%s_%s_%.3d.npz" % (hashlib.sha256(wdir.encode()).hexdigest(), prefix, idx))
+        return jpgdir, jpgout, tmpfile
+    # file_names()
+
+    def get_mosaic(self, key, thumbw, n_max):
+        if key in self.mosaics:
+            self.mosaics[key] = self.mosaics.pop(key) # most recently used
+            return self.mosaics[key]
+
+        while len(self.mosaics) >= self.max_open:
+            self.flush(*self.mosaics.popitem(last=False), evicted=True)
+
+        idx = key[2]
+        idx_max = (n_max-1)//100
+        m = dict(canvas=None, filled=numpy.zeros(100, dtype=bool), dirty=False,
+                 n_expected=100 if idx < idx_max else n_max - idx_max*100)
+
+        tmpfile = self.file_names(key)[2]
+        if os.path.isfile(tmpfile):
+            shikalog.debug("loading thumbnail data from %s" % tmpfile)
+            try:
+                with numpy.load(tmpfile) as f:
+                    if f["canvas"].shape == (thumbw*10, thumbw*10, 3):
+                        m["canvas"], m["filled"] = f["canvas"], f["filled"]
+            except:
+                shikalog.warning("failed to load %s\n%s" % (tmpfile, traceback.format_exc()))
+
+        if m["canvas"] is None: m["canvas"] = numpy.zeros((thumbw*10, thumbw*10, 3), dtype=numpy.uint8)
+        self.mosaics[key] = m
+        return m
+    # get_mosaic()
+
+    def add(self, wdir, prefix, frame, n_max, thumbdata):
+        thumbw = int(numpy.sqrt(len(thumbdata)//3))
+        assert len(thumbdata) == 3*thumbw*thumbw
+        key = (wdir, prefix, (frame-1)//100)
+        m = self.get_mosaic(key, thumbw, n_max)
+        i = (frame-1)%100
+        x, y = i%10, i//10
+        m["canvas"][y*thumbw:(y+1)*thumbw, x*thumbw:(x+1)*thumbw] = numpy.frombuffer(thumbdata, dtype=numpy.uint8).reshape(thumbw, thumbw, 3)
+        m["filled"][i] = True
+        m["dirty"] = True
+
+        if m["filled"].sum() >= m["n_expected"]:
+            self.flush(key, self.mosaics.pop(key))
+    # add()
+
+    def flush(self, key, m, evicted=False):
+        """write jpg, and save or remove tiles"""
+        jpgdir, jpgout, tmpfile = self.file_names(key)
+        completed = m["filled"].sum() >= m["n_expected"]
+        if m["dirty"]:
+            if not os.path.exists(jpgdir): os.mkdir(jpgdir)
+            jpgtmp = os.path.join(jpgdir, ".tmp-"+os.path.basename(jpgout))
+            shikalog.info("saving thumbnail jpeg as %s" % jpgout)
+            Image.fromarray(m["canvas"]).save(jpgtmp, "JPEG", quality=50, optimize=True)
+            os.rename(jpgtmp, jpgout) # as it may take time
+
+        if completed:
+            if os.path.isfile(tmpfile): os.remove(tmpfile)
+        elif m["dirty"]:
+            shikalog.info("saving thumbnail data to %s" % tmpfile)
+            if not os.path.exists(self.tmpdir): os.mkdir(self.tmpdir)
+            tmp = tmpfile + ".tmp.npz"
+            numpy.savez(tmp, canvas=m["canvas"], filled=m["filled"])
+            os.rename(tmp, tmpfile)
+
+        m["dirty"] = False
+    # flush()
+
+    def flush_all(self):
+        for key in list(self.mosaics):
+            try: self.flush(key, self.mosaics[key])
+            except: shikalog.error("Error in saving thumbnail %s\n%s" % (key, traceback.format_exc()))
+    # flush_all()
+
+    def run(self):
+        last_flush = time.time()
+        while self.keep_going or not self.queue.empty():
+            try:
+                args = self.queue.get(timeout=1)
+                self.add(*args)
+            except queue.Empty:
+                pass
+            except:
+                shikalog.error("Error in making thumbnail\n%s" % traceback.format_exc())
+
+            if time.time() - last_flush > self.flush_interval:
+                self.flush_all()
+                last_flush = time.time()
+
+        self.flush_all()
+    # run()
+# class ThumbnailMosaicMaker
+
 class ResultsManager(object):
     def __init__(self, rqueue, dbdir):
         self.thread = threading.Thread(None, self.run)
         self.thread.daemon = True
         self.interval = 3
+        self.thumbnail_maker = ThumbnailMosaicMaker()
 
         self.dbdir = dbdir
         self.rqueue = rqueue
         self._diffscan_params = {}
+        self._dbs = collections.OrderedDict() # wdir: (connection, params_ids, summary.dat)
+        self.max_open_dbs = 8
+        self.max_db_retries = 10 # when shika.db is locked
     # __init__()
 
     def start(self):
         if not self.is_running():
             self.keep_going = True
             self.running = True
+            self.thumbnail_maker.start()
             self.thread.start()
     # start()
 
@@ -760,9 +978,47 @@ class ResultsManager(object):
     # get_raster_grid_coordinate()
 
 
+    def open_db(self, wdir):
+        """
+        Returns (con, params_ids, summarydat) for wdir. Connections are kept open (up to max_open_dbs)
+        so that the schema is checked only once per database.
+        """
+        if wdir in self._dbs:
+            self._dbs[wdir] = self._dbs.pop(wdir) # most recently used
+            return self._dbs[wdir]
+
+        while len(self._dbs) >= self.max_open_dbs:
+            con = self._dbs.popitem(last=False)[1][0]
+            if con is not None: con.close()
+
+        dbfile = os.path.join(wdir, "shika.db")
+        con = None
+        for _ in range(10):
+            try:
+                wal = params.db_wal if params.db_wal is not None else shikadb.is_local_filesystem(wdir)
+                con = shikadb.connect(dbfile, timeout=30, wal=wal)
+                nconv = shikadb.migrate(con) # also creates tables
+                if nconv: shikalog.info("%d results converted to new format in %s" % (nconv, dbfile))
+                break
+            except sqlite3.OperationalError:
+                shikalog.warning("Connecting to %s failed. Retrying" % dbfile)
+                if con is not None: con.close()
+                con = None
+                time.sleep(1)
+
+        if con is None:
+            shikalog.error("Could not connect to %s." % dbfile)
+
+        summarydat = os.path.join(wdir, "summary.dat")
+        if not os.path.isfile(summarydat) or not os.path.getsize(summarydat):
+            open(summarydat, "w").write("prefix x y kind data filename\n")
+
+        self._dbs[wdir] = (con, {}, summarydat)
+        return self._dbs[wdir]
+    # open_db()
+
     def run(self):
         shikalog.info("ResultsManager loop STARTED")
-        dbfile, summarydat, con, cur = None, None, None, None
 
         rcon = sqlite3.connect(os.path.join(self.dbdir, "%s.db"%getpass.getuser()), timeout=10)
         rcur = rcon.cursor()
@@ -789,56 +1045,13 @@ class ResultsManager(object):
                         messages.setdefault(os.path.normpath(str(msg["work_dir"])), []).append(msg)
 
                 for wdir in messages:
-                    tmp = os.path.join(wdir, "shika.db")
-                    if dbfile != tmp:
-                        dbfile = tmp
-                        con, cur = None, None
-                        for _ in range(10):
-                            try:
-                                con = sqlite3.connect(dbfile, timeout=30)
-                                break
-                            except sqlite3.OperationalError:
-                                shikalog.warning("Connecting to %s failed. Retrying" % dbfile)
-
-                        if con is None:
-                            shikalog.error("Could not connect to %s." % dbfile)
-                        else:
-                            cur = con.cursor()
-
-                        summarydat = os.path.join(wdir, "summary.dat")
-                        if not os.path.isfile(summarydat) or not os.path.getsize(summarydat):
-                            open(summarydat, "w").write("prefix x y kind data filename\n")
-
-                    canvas_data = {}
-                            
+                    con, params_ids, summarydat = self.open_db(wdir)
+                    db_items, summary_lines = [], []
+
                     for msg in messages[wdir]:
                         imgf = os.path.basename(str(msg["imgfile"]))
                         spots_is = [x[2] for x in msg["spots"]]
 
-                        if cur is not None:
-                            # 'status'
-                            c = cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='status';")
-                            if c.fetchone() is None:
-                                cur.execute("""create table status (filename text primary key);""")
-    
-                            cur.execute("insert or replace into status values (?)", (imgf,)) # for backward 
-    
-                            # 'stats'
-                            c = cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='stats';")
-                            if c.fetchone() is None:
-                                cur.execute("""create table stats (imgf text primary key, nspot real, total real, mean real);""")
-    
-                            cur.execute("insert or replace into stats values (?, ?,?,?)", 
-                                        (imgf, len(msg["spots"]),
-                                         sum(spots_is),
-                                         sum(spots_is) / len(msg["spots"]) if len(msg["spots"])>0 else 0
-                                         ))
-    
-                            # 'spots'
-                            c = cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='spots';")
-                            if c.fetchone() is None:
-                                cur.execute("create table spots (filename text primary key, spots blob);")
-
                         # save jpg
                         if not params.thumbnail:
                             pass # don't make thumbnails
@@ -851,91 +1064,41 @@ class ResultsManager(object):
                             open(jpgout, "wb").write(msg["jpgdata"])
                             del msg["jpgdata"]
                         elif "thumbdata" in msg and msg["thumbdata"]:
-                            #assert len(msg["thumbdata"])==600*600*3
-                            thumbw = int(numpy.sqrt(len(msg["thumbdata"])/3))
-                            assert len(msg["thumbdata"]) == 3*thumbw*thumbw
-                            prefix = str(msg["file_prefix"])
-                            idx = (msg["idx"]-1)//100
-                            tmpdir = os.path.join(os.path.expanduser("~"), ".shikatmp")
-                            if not os.path.exists(tmpdir): os.mkdir(tmpdir)
-                            tmpfile = os.path.join(tmpdir, "%s_%s_%.3d.pkl" % (hashlib.sha256(wdir).hexdigest(), prefix, idx))
-
-                            if (prefix, idx) in canvas_data: 
-                                canvas, ninc, _ = canvas_data[(prefix, idx)]
-                            elif os.path.isfile(tmpfile):
-                                shikalog.debug("loading thumbnail data from %s" % tmpfile)
-                                canvas, ninc, _ = pickle.load(open(tmpfile, "rb"))
-                            else:
-                                canvas, ninc = Image.new("RGB", (thumbw*10, thumbw*10), (0, 0, 0)), 0
-                                
-                            thumbimg = Image.frombytes("RGB", (thumbw, thumbw), msg["thumbdata"])
-                            idx2 = (msg["idx"]-1)%100
-                            x, y = idx2%10, idx2//10
-                            canvas.paste(thumbimg, (x*thumbw, y*thumbw))
-                            ninc += 1
-                            #canvas.save(jpgout, "JPEG", quality=90, optimize=True) # IT MAY COST TOO MUCH TIME (SHOULD RUN THIS JUST ONCE?)
-
-                            # calc max frame number
-                            hpoint = int(msg["header"].get("raster_horizotal_number", msg["header"].get("raster_horizontal_number"))) # raster_horizontal_number was raster_horizotal_number until bss_jul04_2017
-                            vpoint = int(msg["header"]["raster_vertical_number"])
-                            n_max = hpoint * vpoint
-                            idx_max = (n_max-1)//100
-                            n_in_last = n_max - idx_max*100
-                            
-                            canvas_data[(prefix, idx)] = (canvas, ninc,
-                                                          ninc == 100 or (idx_max==idx and ninc == n_in_last) # jpeg-completed flag
-                                                          )
-                            
+                            try: self.thumbnail_maker.put(wdir, msg) # mosaic jpg is made in another thread
+                            except: shikalog.error("Error in thumbnail of %s\n%s" % (imgf, traceback.format_exc()))
                             del msg["thumbdata"]
-                            
 
-                        if cur is not None:
-                            cur.execute("insert or replace into spots values (?, ?)",
-                                        (imgf, sqlite3.Binary(pickle.dumps(msg, -1))))
+                        db_items.append((imgf, msg))
 
                         # summary.dat
                         try:
-                            #tmptmp = time.time()
                             gcxy = self.get_raster_grid_coordinate(msg)
-
-                            with open(summarydat, "a") as ofs:
-                                kinds = ("n_spots", "total_integrated_signal","median_integrated_signal")
-                                data = (len(msg["spots"]), sum(spots_is), numpy.median(spots_is))
-                                for k, d in zip(kinds, data):
-                                    ofs.write("%s_ % .4f % .4f %s %s %s\n" % (str(msg["file_prefix"]),
-                                                                              gcxy[0], gcxy[1], k, d, imgf))
-                            #shikalog.info("##DEBUG time: %f" %( time.time()-tmptmp))
+                            kinds = ("n_spots", "total_integrated_signal","median_integrated_signal")
+                            data = (len(msg["spots"]), sum(spots_is), numpy.median(spots_is))
+                            for k, d in zip(kinds, data):
+                                summary_lines.append("%s_ % .4f % .4f %s %s %s\n" % (str(msg["file_prefix"]),
+                                                                                     gcxy[0], gcxy[1], k, d, imgf))
                         except:
                             shikalog.error("Error in summary.dat generation at %s\n%s" % (wdir, traceback.format_exc()))
 
-                            
-                    for prefix, idx in canvas_data:
-                        tmpdir = os.path.join(os.path.expanduser("~"), ".shikatmp")
-                        jpgdir = os.path.join(wdir, "thumb_%s" % prefix)
-                        if not os.path.exists(tmpdir): os.mkdir(tmpdir)
-                        if not os.path.exists(jpgdir): os.mkdir(jpgdir)
-                        tmpfile = os.path.join(tmpdir, "%s_%s_%.3d.pkl" % (hashlib.sha256(wdir).hexdigest(), prefix, idx))                        
-                        jpgout = os.path.join(jpgdir, "%s_%.6d-%.6d.jpg" % (prefix, idx*100+1, (idx+1)*100))
-                        jpgtmp = os.path.join(jpgdir, ".tmp-%s_%.6d-%.6d.jpg" % (prefix, idx*100+1, (idx+1)*100))
-                        
-                        shikalog.info("saving thumbnail jpeg as %s" % jpgout)
-                        
-                        canvas_data[(prefix, idx)][0].save(jpgtmp, "JPEG", quality=50, optimize=True)
-                        os.rename(jpgtmp, jpgout) # as it may take time
-                        
-                        if canvas_data[(prefix, idx)][2]:
-                            if os.path.isfile(tmpfile): os.remove(tmpfile)
-                        else:
-                            shikalog.info("saving thumbnail data to %s" % tmpfile)
-                            pickle.dump(canvas_data[(prefix, idx)], open(tmpfile, "wb"), -1)
-                            
-                    while True:
-                        try: con.commit()
-                        except sqlite3.OperationalError:
-                            shikalog.warning("sqlite3.OperationalError. Retrying.")
-                            time.sleep(1)
-                            continue
-                        break
+                    # all results of this drain in one transaction
+                    for itrial in range(self.max_db_retries if con is not None and db_items else 0):
+                        try:
+                            shikadb.write_results(con, db_items, params_ids)
+                            break
+                        except sqlite3.OperationalError as e:
+                            if "locked" in str(e) and itrial < self.max_db_retries-1: # busy. other errors won't be resolved by retry
+                                shikalog.warning("shika.db is locked. Retrying (%d)" % (itrial+1))
+                                time.sleep(1)
+                                continue
+                            shikalog.error("Failed to write %d results to %s: %s" % (len(db_items), wdir, e))
+                            break
+
+                    if summary_lines:
+                        try:
+                            with open(summarydat, "a") as ofs: ofs.write("".join(summary_lines))
+                        except:
+                            shikalog.error("Error in writing %s\n%s" % (summarydat, traceback.format_exc()))
 
                     rcur.execute("insert or replace into updates values (?,?)", (wdir, time.time()))
                     rcon.commit()
@@ -945,6 +1108,7 @@ class ResultsManager(object):
             
             time.sleep(self.interval)
 
+        self.thumbnail_maker.stop()
         self.running = False
         shikalog.info("ResultsManager loop FINISHED")
     # run()
@@ -957,8 +1121,9 @@ def results_receiver(rqueue, pullport, results_manager):
 
     last_times = []
 
+    params_cache = {}
     while True:
-        msg = receiver.recv_pyobj()
+        msg = result_from_frames(receiver.recv_multipart(), params_cache)
 
         if "bss_job_mode" not in msg:
             last_times.append(time.time())
@@ -971,15 +1136,165 @@ def results_receiver(rqueue, pullport, results_manager):
         #results_manager.start()
 # results_receiver()
 
-def worker(wrk_num, params):
+def result_as_frames(result, params_pkl_cache):
+    """
+    Result message as zmq frames, not pickled as a whole:
+     [b"R1", json of other items, spots (float64), params, thumbdata, jpgdata]
+    params (phil extract) is pickled but cached in params_pkl_cache by identity and work_dir,
+    so it is not pickled for each frame. If some items cannot be encoded in json, pickle is used.
+    """
+    result = dict(result)
+    spots = numpy.asarray(result.pop("spots", []), dtype=numpy.float64)
+    params = result.pop("params", None)
+    blobs = [result.pop(k, None) or b"" for k in ("thumbdata", "jpgdata")]
+    key = (id(params), getattr(params, "work_dir", None))
+    if key not in params_pkl_cache: params_pkl_cache[key] = pickle.dumps(params, -1)
+
+    def to_python(x):
+        if isinstance(x, (numpy.ndarray, numpy.generic)): return x.tolist()
+        raise TypeError("%s is not JSON serializable" % type(x))
+
+    try:
+        result["spots_shape"] = spots.shape
+        meta = json.dumps(result, default=to_python).encode()
+    except TypeError:
+        shikalog.warning("result cannot be encoded in json. sending pickle.")
+        result.update(spots=spots, params=params, thumbdata=blobs[0], jpgdata=blobs[1])
+        del result["spots_shape"]
+        return [pickle.dumps(result, -1)]
+
+    return [b"R1", meta, spots.tobytes(), params_pkl_cache[key]] + blobs
+# result_as_frames()
+
+def result_from_frames(frames, params_cache):
+    """inverse of result_as_frames(). params_cache: {pickled params: params} to unpickle only once"""
+    if len(frames) == 1: return pickle.loads(frames[0])
+    assert frames[0] == b"R1"
+    result = json.loads(frames[1])
+    result["spots"] = numpy.frombuffer(frames[2], dtype=numpy.float64).reshape(result.pop("spots_shape"))
+    if frames[3] not in params_cache:
+        params_cache[frames[3]] = pickle.loads(frames[3])
+    result["params"] = params_cache[frames[3]]
+    for k, b in zip(("thumbdata", "jpgdata"), frames[4:6]):
+        if b: result[k] = b
+    return result
+# result_from_frames()
+
+def eiger_frame_endpoints():
+    """zmq endpoints to dispatch frames from eiger_stream_receiver() to workers, and to release the ring buffer"""
+    tmpdir = tempfile.gettempdir()
+    return tuple(["ipc://%s" % os.path.join(tmpdir, "shika-%s-%d-%s" % (getpass.getuser(), os.getpid(), x))
+                  for x in ("frames", "release")])
+# eiger_frame_endpoints()
+
+class RawFrameRing(object):
+    """
+    Circular buffer of bytes in shared memory for compressed frames of variable sizes.
+    Regions are allocated at the end of the last one (or from the beginning when wrapped), and
+    become reusable when all regions allocated before them are released. Used only by one process.
+    """
+    def __init__(self, nbytes):
+        self.arrays = SharedArrays.create([("raw", numpy.uint8, (nbytes,))])
+        self.nbytes = nbytes
+        self.inuse = collections.OrderedDict() # {offset: [size, released]} in the order of allocation
+        self.tail = 0 # end of the last allocated region
+    # __init__()
+
+    def alloc(self, size):
+        """returns offset or None if no space now"""
+        size = max(1, size)
+        if size > self.nbytes: return None
+        if not self.inuse: self.tail = 0
+        head = next(iter(self.inuse)) if self.inuse else 0
+        if not self.inuse or self.tail > head: # not wrapped
+            if self.nbytes - self.tail >= size: offset = self.tail
+            elif head >= size: offset = 0
+            else: return None
+        elif head - self.tail >= size: offset = self.tail
+        else: return None
+
+        self.inuse[offset] = [size, False]
+        self.tail = offset + size
+        return offset
+    # alloc()
+
+    def release(self, offset):
+        if offset not in self.inuse: return
+        self.inuse[offset][1] = True
+        while self.inuse and next(iter(self.inuse.values()))[1]:
+            self.inuse.popitem(last=False)
+    # release()
+# class RawFrameRing
+
+def eiger_stream_receiver(eiger_host, endpoints, ring_bytes):
+    """
+    Receives EIGER stream, copies compressed images into a ring buffer in shared memory, and
+    sends the header and the position to workers, which decode the images by themselves.
+    Workers send back the position when the data are no longer needed.
+    An image larger than the ring is sent in the message instead.
+    """
+    context = zmq.Context()
+    eiger_receiver = context.socket(zmq.PULL)
+    eiger_receiver.connect("tcp://%s:9999"%eiger_host)
+    dispatcher = context.socket(zmq.PUSH)
+    dispatcher.bind(endpoints[0])
+    releaser = context.socket(zmq.PULL)
+    releaser.bind(endpoints[1])
+
+    ring = RawFrameRing(ring_bytes)
+    shikalog.info("eiger_stream_receiver: %.1f MB ring buffer for compressed frames" % (ring_bytes/1024**2))
+
+    def take_release(block):
+        try:
+            name, offset = releaser.recv_json(0 if block else zmq.NOBLOCK)
+        except zmq.Again:
+            return False
+        if name == ring.arrays.name: ring.release(offset)
+        return True
+    # take_release()
+
+    try:
+        while True:
+            frames = eiger_receiver.recv_multipart(copy=False)
+            header = eiger.StreamFrameDecoder.read_header(frames)
+            if header is None: continue
+
+            buf = frames[2].buffer
+            size = len(buf)
+            if size > ring_bytes:
+                dispatcher.send_multipart([json.dumps(dict(header=header)).encode(), buf], copy=False)
+                continue
+
+            while take_release(block=False): pass
+            offset = ring.alloc(size)
+            while offset is None:
+                take_release(block=True)
+                offset = ring.alloc(size)
+
+            ring.arrays["raw"][offset:offset+size] = numpy.frombuffer(buf, dtype=numpy.uint8)
+            dispatcher.send_multipart([json.dumps(dict(header=header, ring=ring.arrays.descriptor(),
+                                                       offset=offset, size=size)).encode()])
+    finally:
+        ring.arrays.unlink()
+# eiger_stream_receiver()
+
+def worker(wrk_num, params, frame_endpoints=None):
     context = zmq.Context()
  
     # Set up a channel to receive work from the ventilator
     work_receiver = context.socket(zmq.PULL)
     work_receiver.connect("tcp://127.0.0.1:%d"%params.ports[0])
 
+    # frames from eiger_stream_receiver()
     eiger_receiver = context.socket(zmq.PULL)
-    eiger_receiver.connect("tcp://%s:9999"%params.eiger_host)
+    slot_releaser = context.socket(zmq.PUSH)
+    if frame_endpoints is not None:
+        eiger_receiver.connect(frame_endpoints[0])
+        slot_releaser.connect(frame_endpoints[1])
+    rings = {} # {name: SharedArrays}
+    decoder = eiger.StreamFrameDecoder()
+    frame_buf = None # decoded frame, reused
+    params_pkl_cache = {}
  
     # Set up a channel to send result of work to the results reporter
     results_sender = context.socket(zmq.PUSH)
@@ -1030,42 +1345,66 @@ def worker(wrk_num, params):
                 try: os.mkdir(dparams.work_dir)
                 except: pass
 
-            result = spot_finder_for_grid_scan.run(imgfile, dparams)
+            # read_from: actual file (e.g. in /ramdisk) if different from imgfile
+            result = spot_finder_for_grid_scan.run(str(msg.get("read_from", imgfile)), dparams)
             result.update(msg)
             result["work_dir"] = dparams.work_dir
             result["params"] = dparams
-            results_sender.send_pyobj(result)
+            results_sender.send_multipart(result_as_frames(result, params_pkl_cache), copy=False)
 
-        # the message from EIGER
+        # the frame from EIGER
         if socks.get(eiger_receiver) == zmq.POLLIN:
-            frames = eiger_receiver.recv_multipart(copy = False)
-
-            header, data = eiger.read_stream_data(frames)
-            if util.None_in(header, data): continue
-
-            #params_str = config_manager.sp_params_strs[("BL32XU", "EIGER9M", None, None)] + config_manager.get_common_params_str()
-            #master_params = libtbx.phil.parse(spot_finder_for_grid_scan.master_params_str)
-            #working_params = master_params.fetch(sources=[libtbx.phil.parse(params_str)])
-            #working_params.show()
-            dparams = params_dict[("BL32XU", "EIGER9M", None, None)] #working_params.extract()
-            dparams.work_dir = os.path.join(str(header["data_directory"]), "_spotfinder")
-            if os.path.exists(dparams.work_dir): assert os.path.isdir(dparams.work_dir)
-            else:
-                try: os.mkdir(dparams.work_dir)
-                except: pass
-
-            shikalog.info("Got data: %s"%header)
-
-            imgfile = os.path.join(header["data_directory"],
-                                   "%s_%.6d.img"%(str(header["file_prefix"]), header["frame"]+1))
+            parts = eiger_receiver.recv_multipart()
+            msg = json.loads(parts[0])
+            header = msg["header"]
+            result = None
+            try:
+                # the region must be sent back in any case, otherwise the receiver will run out of space
+                try:
+                    if "ring" in msg:
+                        name = msg["ring"]["name"]
+                        if name not in rings:
+                            for r in rings.values(): r.close()
+                            rings = {}
+                            rings[name] = SharedArrays.attach(msg["ring"])
+                        buf = rings[name]["raw"][msg["offset"]:msg["offset"]+msg["size"]] # view of shared memory
+                    else: # too large for the ring
+                        buf = parts[1]
+
+                    shape = decoder.frame_shape(header)
+                    if frame_buf is None or frame_buf.shape != shape: frame_buf = numpy.empty(shape, dtype=numpy.int32)
+                    data = decoder.decode_raw(header, buf, out=frame_buf)
+                finally:
+                    buf = None
+                    if "ring" in msg: slot_releaser.send_json([msg["ring"]["name"], msg["offset"]])
+
+                #params_str = config_manager.sp_params_strs[("BL32XU", "EIGER9M", None, None)] + config_manager.get_common_params_str()
+                #master_params = libtbx.phil.parse(spot_finder_for_grid_scan.master_params_str)
+                #working_params = master_params.fetch(sources=[libtbx.phil.parse(params_str)])
+                #working_params.show()
+                dparams = params_dict[("BL32XU", "EIGER9M", None, None)] #working_params.extract()
+                dparams.work_dir = os.path.join(str(header["data_directory"]), "_spotfinder")
+                if os.path.exists(dparams.work_dir): assert os.path.isdir(dparams.work_dir)
+                else:
+                    try: os.mkdir(dparams.work_dir)
+                    except: pass
+
+                shikalog.info("Got data: %s"%header)
+
+                imgfile = os.path.join(header["data_directory"],
+                                       "%s_%.6d.img"%(str(header["file_prefix"]), header["frame"]+1))
+
+                result = spot_finder_for_grid_scan.run(imgfile, dparams, data_and_header=(data, header))
+            except:
+                shikalog.error("wrker%.2d: error in processing frame\n%s" % (wrk_num, traceback.format_exc()))
 
-            result = spot_finder_for_grid_scan.run(imgfile, dparams, data_and_header=(data, header))
-            result["work_dir"] = dparams.work_dir
-            result["params"] = dparams
-            result["imgfile"] = imgfile
-            result["template"] = "%s_%s.img"%(str(header["file_prefix"]), "?"*6)
-            result["idx"] = header["frame"]+1
-            results_sender.send_pyobj(result)
+            if result is not None:
+                result["work_dir"] = dparams.work_dir
+                result["params"] = dparams
+                result["imgfile"] = imgfile
+                result["template"] = "%s_%s.img"%(str(header["file_prefix"]), "?"*6)
+                result["idx"] = header["frame"]+1
+                results_sender.send_multipart(result_as_frames(result, params_pkl_cache), copy=False)
 
             #os.remove(imgfile)
             
@@ -1075,6 +1414,7 @@ def worker(wrk_num, params):
             msg = control_receiver.recv_pyobj()
             if "params" in msg:
                 params_dict = msg["params"]
+                params_pkl_cache = {}
                 shikalog.info("worker %d: Parameters updated" % wrk_num)
 
     shikalog.info("Worker %d finished." % wrk_num)
@@ -1128,8 +1468,13 @@ def run_from_args(argv):
     #import sys
     #pickle.dump(params, open("/tmp/params.pkl","w"),-1)
     #pp = []
+    frame_endpoints = None
+    if params.mode == "eiger_streaming":
+        frame_endpoints = eiger_frame_endpoints()
+        Process(target=eiger_stream_receiver, args=(params.eiger_host, frame_endpoints, int(params.eiger_stream_buffer_mb*1024**2))).start()
+
     for i in range(params.nproc):
-        Process(target=worker, args=(i,params)).start()
+        Process(target=worker, args=(i,params,frame_endpoints)).start()
         #p = subprocess.Popen(["%s -"%sys.executable], shell=True, stdin=subprocess.PIPE)
         #p.stdin.write("from yamtbx.dataproc.myspotfinder.command_line.spot_finder_backend import worker\nimport pickle\nworker(%d, pickle.load(open('/tmp/params.pkl')))"%i)
         #p.stdin.close()
@@ -1140,7 +1485,8 @@ def run_from_args(argv):
 
     if params.mode == "watch_ramdisk":
         ramdisk_watcher = WatchRamdiskThread(pushport=params.ports[0],
-                                             interval=params.ramdisk_walk_interval)
+                                             interval=params.ramdisk_walk_interval,
+                                             processed_db=params.ramdisk_processed_db)
         ramdisk_watcher.start()
     elif params.mode != "eiger_streaming": 
         queue = queue.Queue()
@@ -50,6 +50,7 @@ from yamtbx.util import get_number_of_processors, rotate_file
 from yamtbx.dataproc.XIO import XIO
 from yamtbx.dataproc.myspotfinder import shikalog
 from yamtbx.dataproc.myspotfinder import config_manager
+from yamtbx.dataproc.myspotfinder import shikadb
 from yamtbx.dataproc.XIO.plugins import eiger_hdf5_interpreter
 
 EventResultsUpdated, EVT_RESULTS_UPDATED = wx.lib.newevent.NewEvent()
@@ -419,8 +420,7 @@ class ReportHTMLMakerThread(object):
         con = sqlite3.connect(dbfile, timeout=10, isolation_level=None)
         con.execute('pragma query_only = ON;')
         print("Reading data from DB for making report html.")
-        c = con.execute("select filename,spots from spots")
-        dbspots = dict([(str(x[0]), pickle.loads(str(x[1]))) for x in c.fetchall()])
+        dbspots = shikadb.read_results(con, filenames=set([os.path.basename(f) for f, stat in result if stat is not None]))
         spot_data = "var spot_data = {"
         for i, (f, stat) in enumerate(result):
             if stat is None: continue
@@ -1161,7 +1161,7 @@ class ControlPanel(wx.Panel):
             wx.PostEvent(self, EventTargetDirChanged(target=updates[-1][0],fpref=None))
 
         if os.path.normpath(updates[-1][0]) == os.path.normpath(self.current_target_dir):
-            self.mainFrame.load_results()
+            self.mainFrame.load_results(incremental=True)
     # on_result_update_timer()
 
     def get_spot_draw_mode(self):
@@ -1234,10 +1234,9 @@ class ControlPanel(wx.Panel):
         dbfile = os.path.join(os.path.dirname(list(self.mainFrame.data.keys())[0]), "_spotfinder", "shika.db")
         if os.path.isfile(dbfile):
             con = sqlite3.connect(dbfile, timeout=10)
-            con.execute("delete from spots")
-            con.execute("delete from stats")
-            con.execute("delete from status")
+            shikadb.clear_results(con.cursor())
             con.commit()
+            self.mainFrame.db_load_state = None # reload everything next time
 
         headers = {}
 
@@ -2732,6 +2731,7 @@ class MainFrame(wx.Frame):
         self.topdir = topdir
 
         self.data = collections.OrderedDict() # Data shown in grid
+        self.db_load_state = None # for incremental load_results()
 
         self.plotFrame = PlotFrame(self)
 
@@ -3015,95 +3015,105 @@ Try restarting KUMA and SHIKA!
                 self.html_maker_thread.start()
     # update_result()
 
-    def load_results(self):
-        current_stats.clear()
-        
+    def load_results(self, incremental=False):
+        """
+        If incremental=True and the directory and exclusion ranges are unchanged since the last call,
+        only results written after the last call are read from shika.db, and diffscan.log is parsed
+        again only if it was modified. Otherwise all results are loaded.
+        """
+        dbfile, scanlog = None, None
+        if self.ctrlFrame.current_target_dir is not None:
+            dbfile = os.path.join(self.ctrlFrame.current_target_dir, "_spotfinder", "shika.db")
+            scanlog = os.path.join(self.ctrlFrame.current_target_dir, "diffscan.log")
 
-        if self.ctrlFrame.current_target_dir is None:
-            return
+        exranges = self.ctrlFrame.get_exclude_resolution_ranges()
+        st = self.db_load_state
+        full_load = not incremental or st is None or st["dbfile"] != dbfile or st["exranges"] != exranges
+        if full_load:
+            current_stats.clear()
+            st = self.db_load_state = dict(dbfile=dbfile, exranges=exranges, last_rowid=0,
+                                           scanlog_mtime=None, slog=None, results={})
 
-        dbfile = os.path.join(self.ctrlFrame.current_target_dir, "_spotfinder", "shika.db")
-        if not os.path.isfile(dbfile): return
+        if dbfile is None or not os.path.isfile(dbfile): return
 
-        scanlog = os.path.join(self.ctrlFrame.current_target_dir, "diffscan.log")
         if not os.path.isfile(scanlog):
             shikalog.error("diffscan.log not found in %s" % self.ctrlFrame.current_target_dir)
             return
 
-        slog = bl_logfiles.BssDiffscanLog(scanlog)
-        slog.remove_overwritten_scans()
-        
-        d = wx.lib.agw.pybusyinfo.PyBusyInfo("Loading saved results..", title="Busy SHIKA")
+        d = wx.lib.agw.pybusyinfo.PyBusyInfo("Loading saved results..", title="Busy SHIKA") if full_load else None
 
         try: wx.SafeYield()
         except: pass
 
         try:
-            shikalog.info("Loading data: %s" % dbfile)
+            shikalog.info("Loading data: %s (%s)" % (dbfile, "all" if full_load else "after rowid %d"%st["last_rowid"]))
             startt = time.time()
             result = []
             con = sqlite3.connect(dbfile, timeout=10, isolation_level=None)
             shikalog.debug("Opening db with query_only = ON")
             con.execute('pragma query_only = ON;')
-            cur = con.cursor()
 
+            results, max_rowid = {}, st["last_rowid"]
             for itrial in range(60):
                 try:
-                    c = cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='status';")
-                    if c.fetchone() is None:
-                        shikalog.error("No 'status' in %s" % dbfile)
-                        return
+                    results, max_rowid = shikadb.read_results_since(con, st["last_rowid"])
                     break
                 except sqlite3.DatabaseError:
                     shikalog.warning("DB failed. retrying (%d)" % itrial)
                     time.sleep(1)
                     continue
+            con.close()
 
-            for itrial in range(60):
-                try:
-                    c = con.execute("select filename,spots from spots")
-                    results = dict([(str(x[0]), pickle.loads(str(x[1]))) for x in c.fetchall()])
-                    break
-                except sqlite3.DatabaseError:
-                    shikalog.warning("DB failed. retrying (%d)" % itrial)
-                    time.sleep(1)
-                    continue
+            if max_rowid < st["last_rowid"]: # results were cleared
+                shikalog.info("Results were cleared in %s. Reloading." % dbfile)
+                d = None
+                return self.load_results()
+
+            st["last_rowid"] = max_rowid
 
-            exranges = self.ctrlFrame.get_exclude_resolution_ranges()
             if exranges:
                 shikalog.info("Applying resolution-range exclusion: %s" % exranges)
                 for r in list(results.values()):
-                    if not r["spots"]: continue
-                    ress = numpy.array([x[3] for x in r["spots"]])
-                    test = numpy.zeros(len(r["spots"])).astype(numpy.bool)
+                    if len(r["spots"]) == 0: continue
+                    ress = r["spots"][:,3]
+                    test = numpy.zeros(len(r["spots"]), dtype=bool)
                     for rr in exranges: test |= ((min(rr) <= ress) & (ress <= max(rr)))
-                    for i in reversed(numpy.where(test)[0]): del r["spots"][i]
-
-            print("DEBUG:: scans=", slog.scans) 
-            for scan in slog.scans:
-                for imgf, (gonio, gc) in scan.filename_coords:
-                    #print imgf, (gonio, gc) 
-                    stat = Stat()
-                    # extension should be always .img in shika.db if generated from EIGER stream
-                    possible_imgfs = (imgf, os.path.splitext(imgf)[0] + ".img",
-                                      re.sub(r"(.*)_0([0-9]{6})\..*$", r"\1_\2.img", imgf), # too dirty fix!! for new bss which writes 7-digits filename..
-                                      )
-                    imgfs_found = [x for x in possible_imgfs if x in results]
-                    if not imgfs_found: continue
-                    imgf = imgfs_found[0]
-                    snrlist = [x[2] for x in results[imgf]["spots"]]
-                    stat.stats = (len(snrlist), sum(snrlist), numpy.median(snrlist) if snrlist else 0)
-                    stat.spots = results[imgf]["spots"]
-                    stat.gonio = gonio
-                    stat.grid_coord = gc
-                    stat.scan_info = scan
-                    stat.thumb_posmag = results[imgf]["thumb_posmag"]
-                    stat.params = results[imgf]["params"]
-                    stat.img_file = os.path.join(self.ctrlFrame.current_target_dir, imgf)
-                    result.append((stat.img_file, stat))
+                    r["spots"] = r["spots"][~test]
+
+            st["results"].update(results)
+
+            mtime = os.path.getmtime(scanlog)
+            if mtime != st["scanlog_mtime"]:
+                if st["slog"] is None:
+                    st["slog"] = bl_logfiles.BssDiffscanLog(scanlog)
+                else:
+                    st["slog"].update() # only appended lines
+                    shikalog.info("%s was modified. Matching all results again." % scanlog)
+                    current_stats.clear()
+                st["slog"].remove_overwritten_scans()
+                st["scanlog_mtime"] = mtime
+                results = st["results"] # all results need to be matched with new scan info
+
+            slog = st["slog"]
+            found = [(imgf, slog.lookup(imgf, use_aliases=True)) for imgf in results]
+            found.sort(key=lambda x: (x[1][0].date, x[0]) if x[1] else ())
+            for imgf, hit in found:
+                if hit is None: continue
+                scan, gonio, gc = hit
+                stat = Stat()
+                snrlist = results[imgf]["spots"][:,2]
+                stat.stats = (len(snrlist), float(snrlist.sum()), float(numpy.median(snrlist)) if len(snrlist) else 0)
+                stat.spots = results[imgf]["spots"]
+                stat.gonio = gonio
+                stat.grid_coord = gc
+                stat.scan_info = scan
+                stat.thumb_posmag = results[imgf]["thumb_posmag"]
+                stat.params = results[imgf]["params"]
+                stat.img_file = os.path.join(self.ctrlFrame.current_target_dir, imgf)
+                result.append((stat.img_file, stat))
 
             delt = time.time() - startt
-            shikalog.info("Data loaded: %s (took %f sec)" % (dbfile, delt))
+            shikalog.info("Data loaded: %s (%d results, took %f sec)" % (dbfile, len(result), delt))
 
             add_results(result)
         finally:
@@ -0,0 +1,260 @@
+"""
+Schema of shika.db
+
+ results: one row per image. summary values (nspot, total, median) are in columns so that they can be read
+          without spots. spots are (y, x, snr, d) of float64 as a numpy blob (spots_as_blob()).
+          params_id refers to params table. Other items of the result message are pickled in extra.
+ params:  pickled spot-finding parameters, stored once for each distinct parameter set.
+ status, stats: kept for backward compatibility (other programs read them).
+
+Old databases had 'spots' table of pickled whole messages. migrate() converts it to results table and keeps
+the old table as 'spots_old' until drop_old_tables() is called.
+
+(c) RIKEN 2026. All rights reserved.
+Author: Keitaro Yamashita
+
+This software is released under the new BSD License; see LICENSE.
+"""
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import re
+import pickle
+import hashlib
+import sqlite3
+import numpy
+
+schema_version = 2
+
+_spot_dtype = numpy.dtype("<f8")
+_re_prefix_num = re.compile(r"^(.*)_([0-9]+)\.[^0-9]+$")
+_not_extra_keys = ("spots", "params", "jpgdata", "thumbdata")
+
+def create_tables(cur):
+    cur.execute("create table if not exists status (filename text primary key);")
+    cur.execute("create table if not exists stats (imgf text primary key, nspot real, total real, mean real);")
+    cur.execute("create table if not exists params (id integer primary key, digest text unique, params blob);")
+    cur.execute("""create table if not exists results (filename text primary key, prefix text, frame integer,
+                                                      nspot integer, total real, median real,
+                                                      params_id integer, spots blob, extra blob);""")
+    cur.execute("create index if not exists results_prefix_frame on results (prefix, frame);")
+    cur.execute("pragma user_version = %d;" % schema_version)
+# create_tables()
+
+def connect(dbfile, timeout=30, wal=True):
+    """
+    Connection for the writer. In WAL mode readers (GUI) do not wait for the writer and vice versa.
+    WAL needs shared memory between processes, so it should not be used if the file is accessed
+    from other hosts over a network file system. The journal mode is stored in the file.
+    """
+    con = sqlite3.connect(dbfile, timeout=timeout)
+    con.execute("pragma journal_mode = %s;" % ("wal" if wal else "delete"))
+    # NORMAL is safe in WAL mode (only the last transactions may be lost on power failure)
+    con.execute("pragma synchronous = %s;" % ("normal" if wal else "full"))
+    return con
+# connect()
+
+_network_fstypes = ("nfs", "nfs4", "cifs", "smb", "smbfs", "smb3", "afs", "lustre", "gpfs", "panfs",
+                    "ceph", "glusterfs", "fuse.glusterfs", "fuse.sshfs", "beegfs", "9p")
+
+def is_local_filesystem(path):
+    """
+    False if path is on a network file system (according to /proc/mounts), where WAL mode should not be used.
+    Returns False also when unknown.
+    """
+    path = os.path.realpath(path)
+    best, fstype = "", None
+    try:
+        for l in open("/proc/mounts"):
+            sp = l.split()
+            if len(sp) < 3: continue
+            mnt = sp[1].replace("\\040", " ")
+            if (path == mnt or path.startswith(mnt.rstrip("/")+"/")) and len(mnt) > len(best):
+                best, fstype = mnt, sp[2]
+    except IOError:
+        return False
+    return fstype is not None and fstype not in _network_fstypes
+# is_local_filesystem()
+
+def table_exists(cur, name):
+    c = cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?;", (name,))
+    return c.fetchone() is not None
+# table_exists()
+
+def spots_as_blob(spots):
+    return sqlite3.Binary(numpy.asarray(spots, dtype=_spot_dtype).reshape(-1, 4).tobytes())
+# spots_as_blob()
+
+def spots_from_blob(blob):
+    """returns (n,4) array of y, x, snr, d"""
+    return numpy.frombuffer(bytes(blob), dtype=_spot_dtype).reshape(-1, 4)
+# spots_from_blob()
+
+def get_params_id(cur, params, params_ids):
+    """params_ids: dict of digest -> id to avoid querying same params again"""
+    pkl = pickle.dumps(params, -1)
+    digest = hashlib.sha1(pkl).hexdigest()
+    if digest not in params_ids:
+        cur.execute("insert or ignore into params (digest, params) values (?,?)", (digest, sqlite3.Binary(pkl)))
+        params_ids[digest] = cur.execute("select id from params where digest=?", (digest,)).fetchone()[0]
+    return params_ids[digest]
+# get_params_id()
+
+def make_result_row(cur, imgf, msg, params_ids):
+    """row for results table from result message of spot finder"""
+    snrs = [x[2] for x in msg["spots"]]
+    prefix, frame = msg.get("file_prefix"), msg.get("idx")
+    r = _re_prefix_num.search(imgf)
+    if prefix is None and r: prefix = r.group(1)
+    if frame is None and r: frame = int(r.group(2))
+
+    params_id = get_params_id(cur, msg["params"], params_ids) if msg.get("params") is not None else None
+    extra = dict([(k, msg[k]) for k in msg if k not in _not_extra_keys])
+    return (imgf, str(prefix) if prefix is not None else None, frame,
+            len(snrs), float(sum(snrs)), float(numpy.median(snrs)) if snrs else 0.,
+            params_id, spots_as_blob(msg["spots"]), sqlite3.Binary(pickle.dumps(extra, -1)))
+# make_result_row()
+
+def insert_results(cur, rows):
+    """rows from make_result_row(). status and stats tables are also updated."""
+    cur.executemany("insert or replace into status values (?)", [(r[0],) for r in rows])
+    cur.executemany("insert or replace into stats values (?,?,?,?)",
+                    [(r[0], r[3], r[4], r[4]/r[3] if r[3]>0 else 0) for r in rows])
+    cur.executemany("insert or replace into results values (?,?,?,?,?,?,?,?,?)", rows)
+# insert_results()
+
+def write_results(con, items, params_ids):
+    """
+    items: list of (filename, message). All rows are written in one transaction.
+    params_ids is cleared on failure, as newly inserted params are rolled back too.
+    """
+    cur = con.cursor()
+    try:
+        with con:
+            insert_results(cur, [make_result_row(cur, f, msg, params_ids) for f, msg in items])
+    except sqlite3.OperationalError:
+        params_ids.clear()
+        raise
+# write_results()
+
+def clear_results(cur):
+    for t in ("spots", "results", "stats", "status"):
+        if table_exists(cur, t): cur.execute("delete from %s" % t)
+# clear_results()
+
+def migrate(con):
+    """
+    Convert old 'spots' table (pickled messages) to results table. The old table is renamed to
+    'spots_old' as a backup (use drop_old_tables() to remove it).
+    Returns the number of converted rows.
+    """
+    cur = con.cursor()
+    create_tables(cur)
+    if not table_exists(cur, "spots"): return 0
+
+    params_ids = {}
+    rows = []
+    for filename, blob in cur.execute("select filename,spots from spots").fetchall():
+        rows.append(make_result_row(cur, str(filename), pickle.loads(bytes(blob)), params_ids))
+    insert_results(cur, rows)
+    if table_exists(cur, "spots_old"):
+        cur.execute("insert into spots_old select * from spots")
+        cur.execute("drop table spots")
+    else:
+        cur.execute("alter table spots rename to spots_old")
+    con.commit()
+    return len(rows)
+# migrate()
+
+def drop_old_tables(con):
+    """remove the backup made by migrate()"""
+    if table_exists(con, "spots_old"):
+        con.execute("drop table spots_old")
+        con.commit()
+# drop_old_tables()
+
+def read_summaries(con):
+    """
+    Returns dict of filename -> (nspot, total, median) without reading spots.
+    Old database (not migrated) is also supported.
+    """
+    if table_exists(con, "results"):
+        c = con.execute("select filename,nspot,total,median from results")
+        return dict([(str(x[0]), tuple(x[1:])) for x in c.fetchall()])
+
+    ret = {}
+    for f, msg in read_results(con).items():
+        snrs = msg["spots"][:,2]
+        ret[f] = (len(snrs), float(snrs.sum()), float(numpy.median(snrs)) if len(snrs) else 0.)
+    return ret
+# read_summaries()
+
+def read_results(con, filenames=None):
+    """
+    Returns dict of filename -> result message (dict). spots are given as (n,4) numpy array.
+    Parameters are unpickled once for each distinct set (the same object is shared).
+    If filenames is given, only those are read.
+    """
+    return read_results_since(con, 0, filenames)[0]
+# read_results()
+
+def _select_by_filenames(con, sql, args, filenames, batch=500):
+    """executes sql (with where clause) as it is, or limited to filenames in batches (sqlite limits the number of variables)"""
+    if filenames is None:
+        for x in con.execute(sql, args): yield x
+        return
+
+    filenames = sorted(filenames)
+    for i in range(0, len(filenames), batch):
+        fb = filenames[i:i+batch]
+        for x in con.execute(sql + " and filename in (%s)" % ",".join("?"*len(fb)), tuple(args)+tuple(fb)):
+            yield x
+# _select_by_filenames()
+
+def read_results_since(con, last_rowid, filenames=None):
+    """
+    Read only rows of rowid > last_rowid, i.e. results written after the last call.
+    'insert or replace' gives a new rowid, so replaced results are also returned.
+    Returns (results, max_rowid). max_rowid is -1 if the table is empty; if it is smaller than
+    last_rowid, the table was cleared and everything should be read again.
+    """
+    ret = {}
+    if not table_exists(con, "results"): # old database
+        if not table_exists(con, "spots"): return ret, -1
+        max_rowid = con.execute("select max(rowid) from spots").fetchone()[0]
+        for f, blob in _select_by_filenames(con, "select filename,spots from spots where rowid>? and rowid<=?",
+                                            (last_rowid, max_rowid), filenames):
+            f = str(f)
+            msg = pickle.loads(bytes(blob))
+            msg["spots"] = numpy.array(msg["spots"], dtype=_spot_dtype).reshape(-1, 4)
+            ret[f] = msg
+        return ret, max_rowid if max_rowid is not None else -1
+
+    max_rowid = con.execute("select max(rowid) from results").fetchone()[0]
+    if max_rowid is None: return ret, -1 # empty, or cleared
+    params = {}
+    for f, params_id, spots, extra in _select_by_filenames(con, "select filename,params_id,spots,extra from results where rowid>? and rowid<=?",
+                                                           (last_rowid, max_rowid), filenames):
+        f = str(f)
+        if params_id is not None and params_id not in params:
+            x = con.execute("select params from params where id=?", (params_id,)).fetchone()
+            params[params_id] = pickle.loads(bytes(x[0])) if x else None
+        msg = pickle.loads(bytes(extra))
+        msg["spots"] = spots_from_blob(spots)
+        msg["params"] = params.get(params_id)
+        ret[f] = msg
+
+    return ret, max_rowid
+# read_results_since()
+
+if __name__ == "__main__":
+    import sys
+    # shikadb.py [--drop-old] shika.db..
+    drop_old = "--drop-old" in sys.argv[1:]
+    for dbfile in [x for x in sys.argv[1:] if x != "--drop-old"]:
+        con = sqlite3.connect(dbfile, timeout=30)
+        print("%s: %d rows converted" % (dbfile, migrate(con)))
+        if drop_old: drop_old_tables(con)
+        con.close()
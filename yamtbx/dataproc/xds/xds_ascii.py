@@ -23,11 +23,20 @@ def is_xds_ascii(filein):
     return "FORMAT=XDS_ASCII" in line
 # is_xds_ascii()
 
+def cache_file_name(filein):
+    return filein + ".npz"
+# cache_file_name()
+
 class XDS_ASCII(object):
 
-    def __init__(self, filein, log_out=None, read_data=True, i_only=False):
+    def __init__(self, filein, log_out=None, read_data=True, i_only=False, use_cache=False):
+        """
+        If use_cache=True, parsed columns are saved in a sidecar file (filein+".npz") and
+        reused next time as long as the size and mtime of filein are unchanged.
+        """
         self._log = null_out() if log_out is None else log_out
         self._filein = filein
+        self.use_cache = use_cache
         self.indices = flex.miller_index()
         self.i_only = i_only
         self.iobs, self.sigma_iobs, self.xd, self.yd, self.zd, self.rlp, self.peak, self.corr = [flex.double() for i in range(8)]
@@ -45,21 +54,12 @@ class XDS_ASCII(object):
 
         colindex = {} # {"H":1, "K":2, "L":3, ...}
         nitemfound = 0
-        flag_data_start = False
-        num_hkl = 0
 
         headers = []
 
         for line in open(self._filein):
-            if flag_data_start:
-                if line.startswith("!END_OF_DATA"):
-                    break
-                num_hkl += 1
-                continue
-
             if line.startswith('!END_OF_HEADER'):
-                flag_data_start = True
-                continue
+                break # no header records after this. we do not need to read data lines here.
 
             if line.startswith("!Generated by dials"):
                 self.by_dials = True
@@ -136,7 +136,7 @@ class XDS_ASCII(object):
         assert nitem == len(colindex)
 
         self._colindex = colindex
-        self._num_hkl = num_hkl
+        self._nitem = nitem
         self.symm = crystal.symmetry(unit_cell=(a, b, c, al, be, ga),
                                      space_group=ispgrp)
 
@@ -145,52 +145,122 @@ class XDS_ASCII(object):
 
     # read_header()
     
-    def read_data(self):
+    def data_columns(self):
+        """names of arrays to be read by read_data()"""
+        ret = ["indices", "iobs", "sigma_iobs"]
+        if not self.i_only:
+            ret.extend(["xd", "yd", "zd"])
+            if "RLP" not in self._colindex: # XSCALE
+                ret.append("iset")
+            else:
+                ret.extend(["rlp", "peak", "corr"])
+        return ret
+    # data_columns()
+
+    def file_stamp(self):
+        st = os.stat(self._filein)
+        return numpy.array([st.st_size, st.st_mtime])
+    # file_stamp()
+
+    def load_cache(self, names):
+        cachein = cache_file_name(self._filein)
+        if not os.path.isfile(cachein): return None
+        
+        try:
+            with numpy.load(cachein) as cache:
+                if not numpy.array_equal(cache["stamp"], self.file_stamp()): return None
+                if not set(names).issubset(cache.files): return None
+                return dict([(n, cache[n]) for n in cache.files if n != "stamp"])
+        except Exception as e:
+            print("Failed to read cache %s: %s" % (cachein, e), file=self._log)
+            return None
+    # load_cache()
+
+    def save_cache(self, data):
+        """
+        Save numpy arrays in data (dict) with the stamp of the file.
+        Columns already saved in the existing (valid) cache are kept.
+        Writes to temporary file first so that concurrent readers never see incomplete file.
+        """
+        cacheout = cache_file_name(self._filein)
+        data = dict(data)
+        old = self.load_cache([])
+        if old:
+            for n in old:
+                if n not in data: data[n] = old[n]
+        
+        tmpout = "%s.%d.tmp.npz" % (cacheout[:-4], os.getpid())
+        try:
+            numpy.savez(tmpout, stamp=self.file_stamp(), **data)
+            os.rename(tmpout, cacheout)
+        except (IOError, OSError) as e:
+            print("Failed to write cache %s: %s" % (cacheout, e), file=self._log)
+            if os.path.exists(tmpout): os.remove(tmpout)
+    # save_cache()
+
+    def read_data_columns(self, names):
+        """
+        Returns dict of numpy arrays. Only requested names (see data_columns()) are included.
+        The whole data block is parsed at once by numpy, and falls back to line-by-line parsing
+        if the number of items does not match.
+        """
         colindex = self._colindex
-        is_xscale = "RLP" not in colindex
-        flag_data_start = False
+        cols = dict(indices=[colindex[x] for x in "HKL"],
+                    iobs=colindex["IOBS"], sigma_iobs=colindex["SIGMA(IOBS)"],
+                    xd=colindex["XD"], yd=colindex["YD"], zd=colindex["ZD"],
+                    rlp=colindex.get("RLP"), peak=colindex.get("PEAK"), corr=colindex.get("CORR"),
+                    iset=colindex.get("ISET"))
+
+        raw = open(self._filein, "rb").read()
+        i_start = raw.index(b"!END_OF_HEADER")
+        i_start = raw.index(b"\n", i_start) + 1
+        i_end = raw.find(b"!END_OF_DATA", i_start)
+        if i_end < 0: i_end = len(raw)
+        block = raw[i_start:i_end]
+        del raw
+
+        nref = block.count(b"\n")
+        table = numpy.fromstring(block, sep=" ") if nref > 0 else numpy.zeros(0)
+        if table.size != nref * self._nitem:
+            print("Unexpected number of items in data lines. Falling back to line-by-line parsing.", file=self._log)
+            table = numpy.array([[float(x) for x in l.split()[:self._nitem]] for l in block.splitlines() if l.strip() and not l.startswith(b"!")])
+        del block
+        table = table.reshape(-1, self._nitem)
+
+        ret = {}
+        for n in names:
+            if n in ("indices", "iset"):
+                ret[n] = numpy.ascontiguousarray(table[:, cols[n]], dtype=numpy.int32)
+            else:
+                ret[n] = numpy.ascontiguousarray(table[:, cols[n]])
 
-        col_H, col_K, col_L = colindex["H"], colindex["K"], colindex["L"]
-        col_i, col_sig, col_xd, col_yd, col_zd = colindex["IOBS"], colindex["SIGMA(IOBS)"], colindex["XD"], colindex["YD"], colindex["ZD"]
-        col_rlp, col_peak, col_corr, col_iset = colindex.get("RLP", None), colindex.get("PEAK", None), colindex.get("CORR", None), colindex.get("ISET", None)
-        self.indices = []
-        self.xd, self.yd, self.zd = [], [], []
-        self.iframe, self.rlp, self.peak, self.corr, self.iset = [], [], [], [], []
-        for line in open(self._filein):
-            if flag_data_start:
-                if line.startswith("!END_OF_DATA"):
-                    break
+        return ret
+    # read_data_columns()
 
-                sp = line.split()
-                h, k, l = int(sp[col_H]), int(sp[col_K]), int(sp[col_L])
-                self.indices.append([h,k,l])
-
-                self.iobs.append(float(sp[col_i]))
-                self.sigma_iobs.append(float(sp[col_sig]))
-                if not self.i_only:
-                    self.xd.append(float(sp[col_xd]))
-                    self.yd.append(float(sp[col_yd]))
-                    self.zd.append(float(sp[col_zd]))
-                    self.iframe.append(int(self.zd[-1])+1)
-                    if not is_xscale:
-                        self.rlp.append(float(sp[col_rlp]))
-                        self.peak.append(float(sp[col_peak]))
-                        self.corr.append(float(sp[col_corr]))
-                    else:
-                        self.iset.append(int(sp[col_iset]))
-                    #res = symm.unit_cell().d((h,k,l))
-
-                    if self.iframe[-1] < 0:
-                        self.iframe[-1] = 0
-                        print('reflection with surprisingly low z-value:', self.zd[-1], file=self._log)
+    def read_data(self):
+        names = self.data_columns()
+        data = None
+        if self.use_cache:
+            data = self.load_cache(names)
+            if data is not None: print("Data read from cache: %s" % cache_file_name(self._filein), file=self._log)
 
-            if line.startswith('!END_OF_HEADER'):
-                flag_data_start = True
+        if data is None:
+            data = self.read_data_columns(names)
+            if self.use_cache: self.save_cache(data)
 
-        self.indices = flex.miller_index(self.indices)
-        self.iobs, self.sigma_iobs, self.xd, self.yd, self.zd, self.rlp, self.peak, self.corr = [flex.double(x) for x in (self.iobs, self.sigma_iobs, self.xd, self.yd, self.zd, self.rlp, self.peak, self.corr)]
-        self.iframe = flex.int(self.iframe)
-        self.iset = flex.int(self.iset) # only for XSCALE
+        self.indices = flex.miller_index(data["indices"].tolist())
+        for n in ("iobs", "sigma_iobs", "xd", "yd", "zd", "rlp", "peak", "corr"):
+            setattr(self, n, flex.double(data[n]) if n in names else flex.double())
+
+        self.iset = flex.int(data["iset"]) if "iset" in names else flex.int() # only for XSCALE
+        self.iframe = flex.int()
+
+        if "zd" in names:
+            iframe = numpy.trunc(data["zd"]).astype(numpy.int32) + 1
+            for z in data["zd"][iframe < 0]:
+                print('reflection with surprisingly low z-value:', z, file=self._log)
+            iframe[iframe < 0] = 0
+            self.iframe = flex.int(iframe)
 
         print("Reading data done.\n", file=self._log)
 
@@ -199,6 +269,15 @@ class XDS_ASCII(object):
     def get_frame_range(self): 
         """quick function only to get frame number range"""
 
+        if self.use_cache:
+            data = self.load_cache(["zd"])
+            if data is not None:
+                iframe = numpy.trunc(data["zd"]).astype(int) + 1
+                iframe_pos = iframe[iframe > 0]
+                min_frame = int(iframe_pos.min()) if iframe_pos.size > 0 else float("inf")
+                max_frame = int(iframe.max()) if iframe.size > 0 else -float("inf")
+                return min_frame, max_frame
+
         flag_data_start = False
         col_zd = self._colindex["ZD"]
         min_frame, max_frame = float("inf"), -float("inf")
@@ -341,3 +341,84 @@ def touch_file(path):
             pass
     else:
         os.utime(path, None)
+# touch_file()
+
+_bounded_imap_func = None # set in each worker process of bounded_imap_unordered()
+def _bounded_imap_init(func):
+    global _bounded_imap_func
+    _bounded_imap_func = func
+# _bounded_imap_init()
+
+def _bounded_imap_call(x): return _bounded_imap_func(x)
+
+def bounded_imap_unordered(func, args, processes, max_pending=None):
+    """
+    Like multiprocessing.Pool.imap_unordered(), but at most max_pending tasks (default: 2*processes)
+    are in flight (submitted but not yet consumed by the caller), so results don't pile up
+    in memory when the consumer is slower than the workers.
+    func can be a lambda or closure because it is passed to workers by fork (like libtbx.easy_mp).
+    Results are yielded in the order of completion. An exception in func is raised here.
+    """
+    import multiprocessing
+    import queue
+
+    if max_pending is None: max_pending = 2 * processes
+    done = queue.Queue() # (True, result) or (False, exception), put by the result handler thread of pool
+    args = iter(args)
+    args_left = True
+    npending = 0
+
+    # func is given by initializer (not pickled with fork), and kept in each worker
+    pool = multiprocessing.get_context("fork").Pool(processes, initializer=_bounded_imap_init, initargs=(func,))
+    try:
+        while True:
+            # tasks are submitted from this thread, so that no thread in the pool waits for the caller
+            while args_left and npending < max_pending:
+                try: x = next(args)
+                except StopIteration:
+                    args_left = False
+                    break
+                pool.apply_async(_bounded_imap_call, (x,),
+                                 callback=lambda r: done.put((True, r)),
+                                 error_callback=lambda e: done.put((False, e)))
+                npending += 1
+
+            if npending == 0: break
+            ok, r = done.get()
+            npending -= 1
+            if not ok: raise r
+            yield r
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+# bounded_imap_unordered()
+
+def bounded_imap(func, args, processes, max_pending=None):
+    """
+    Ordered version of bounded_imap_unordered(). Results are yielded in the order of args, and
+    at most max_pending tasks (default: 2*processes) are submitted ahead of the one being waited for,
+    so a slow task does not make later results pile up in memory.
+    """
+    import multiprocessing
+    import collections
+
+    if max_pending is None: max_pending = 2 * processes
+    args = iter(args)
+    pending = collections.deque() # AsyncResult in order of args
+
+    pool = multiprocessing.get_context("fork").Pool(processes, initializer=_bounded_imap_init, initargs=(func,))
+    try:
+        while True:
+            while len(pending) < max_pending:
+                try: x = next(args)
+                except StopIteration: break
+                pending.append(pool.apply_async(_bounded_imap_call, (x,)))
+
+            if not pending: break
+            yield pending.popleft().get() # exception in func is raised here
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+# bounded_imap()
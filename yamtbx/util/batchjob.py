@@ -11,6 +11,17 @@ from __future__ import unicode_literals
 import os, subprocess, re, threading, time, stat
 import shlex
 import shutil
+import getpass
+import heapq
+import traceback
+import itertools
+import signal
+
+try:
+    import inotify.adapters # pip install inotify
+    import inotify.constants
+except ImportError:
+    inotify = None
 
 # JobState
 #  0: previous job is not finished.
@@ -49,65 +60,240 @@ class JobManager(object): # interface
     def submit(self, j): pass
     def update_stat(self, j): pass # update j's state to RUNNING/FINISHED
     def stop_all(self):pass
+
+    def update_states(self, jobs):
+        # engines may override this to check all jobs at once
+        for job in jobs: self.update_state(job)
+    # update_states()
+
+    def wait_for_change(self, jobs, timeout):
+        """
+        Sleep for timeout seconds, or return earlier when a sentinel file of jobs
+        (written when the job script exits) is created, if inotify is available.
+        """
+        sentinels = set([j.sentinel_file() for j in jobs if j.state not in (STATE_FINISHED, STATE_FAILED)])
+        if inotify is None or not sentinels:
+            time.sleep(timeout)
+            return
+
+        time_end = time.time() + timeout
+        ino = inotify.adapters.Inotify()
+        for d in set([os.path.dirname(x) for x in sentinels]):
+            if os.path.isdir(d): ino.add_watch(d, mask=inotify.constants.IN_CLOSE_WRITE|inotify.constants.IN_MOVED_TO)
+
+        for event in ino.event_gen(yield_nones=True):
+            if event is not None and os.path.join(event[2], event[3]) in sentinels: return
+            if time.time() >= time_end: return
+    # wait_for_change()
+
     def wait_all(self, jobs, interval=5, timeout=-1):
-        acc = 0
+        # failed (cancelled or killed) jobs are also regarded as done
+        time_started = time.time()
         while True:
-            for job in jobs: self.update_state(job)
-            if all([job.state==STATE_FINISHED for job in jobs]):
+            self.update_states([job for job in jobs if job.state not in (STATE_FINISHED, STATE_FAILED)])
+            if all([job.state in (STATE_FINISHED, STATE_FAILED) for job in jobs]):
                 return True
-            
-            time.sleep(interval)
-            acc += interval
-            if timeout > 0 and acc > timeout: return False
+
+            if timeout > 0 and time.time() - time_started > timeout: return False
+            self.wait_for_change(jobs, interval)
     # wait_all()
 # class JobManager
+
+class QueueingSystem(JobManager):
+    """
+    Base of SGE and Slurm. finished_ids() checks all submitted jobs by one command, and
+    the result is reused for status_max_age seconds, so that update_state() of many jobs
+    does not run a command for each job. A job is also regarded as finished when
+    its sentinel file exists.
+    """
+    status_max_age = 3.
+
+    def __init__(self):
+        JobManager.__init__(self)
+        self.job_id = {} # [Job: jobid]
+        self.submit_time = {} # {jobid: time}
+        self._finished_ids = set()
+        self._status_time = 0.
+    # __init__()
+
+    def finished_ids(self, job_ids): # returns set of finished ones in job_ids, or None if failed
+        raise NotImplementedError
+
+    def register_job(self, j, job_id):
+        self.job_id[j] = job_id
+        self.submit_time[job_id] = time.time()
+    # register_job()
+
+    def update_states(self, jobs):
+        jobs = [j for j in jobs if j in self.job_id] # if job_id is unknown (waiting or finished), state won't be changed
+        if not jobs: return
+
+        newest = max([self.submit_time.get(self.job_id[j], 0) for j in jobs])
+        if time.time() - self._status_time > self.status_max_age or self._status_time < newest:
+            status_time = time.time()
+            finished = self.finished_ids(list(self.job_id.values()))
+            if finished is not None:
+                self._finished_ids, self._status_time = finished, status_time
+
+        for j in jobs:
+            job_id = self.job_id[j]
+            if job_id in self._finished_ids or os.path.isfile(j.sentinel_file()):
+                print("job %s finished." % job_id)
+                j.state = STATE_FINISHED
+                self.job_id.pop(j)
+                self.submit_time.pop(job_id, None)
+                self._finished_ids.discard(job_id)
+            else: # RUNNING or WAITING.
+                j.state = STATE_RUNNING
+    # update_states()
+
+    def update_state(self, j): self.update_states([j])
+# class QueueingSystem
+
 class LocalThread(threading.Thread):
-    def __init__(self, num_jobs):
+    """
+    Runs jobs in local processes. A job is started when it fits in the budget:
+    number of jobs (num_jobs), sum of Job.nproc (max_cores) and sum of Job.mem_gb (max_mem_gb).
+    None means no limit. A job larger than the budget is started when nothing else is running.
+    Jobs are started in order of Job.priority (higher first), then submission. A smaller job
+    may start while a larger one waits for free resources, up to max_backfill_wait seconds.
+    """
+    def __init__(self, num_jobs, max_cores=None, max_mem_gb=None):
         self._stopevent = threading.Event()
         self._sleepperiod = 1.0
 
         self.num_jobs = num_jobs
-        self.waiting_jobs = [] # [Job, ...]
+        self.max_cores = max_cores
+        self.max_mem_gb = max_mem_gb
+        self.lock = threading.Lock()
+        self.waiting_jobs = [] # heap of (-priority, serial number, Job)
+        self._serial = itertools.count()
         self.p_list = [] # running process list [(Job, subprocess.Popen), ..]
+        self.finished_event = threading.Event() # set when any job finished
+        self.accounting = [] # [(wdir, script_name, nproc, wall_time, peak_rss_mb, returncode), ..]
+        self.max_backfill_wait = 60 # seconds
 
         threading.Thread.__init__(self)
         self.setDaemon(True)
     # __init__()
 
+    def add_job(self, j):
+        with self.lock:
+            heapq.heappush(self.waiting_jobs, (-j.priority, next(self._serial), j))
+    # add_job()
+
     def start_job(self, j):
+        # new session to kill all processes of the job by killpg()
         p = subprocess.Popen(os.path.join(".", j.script_name), shell=True, cwd=j.wdir,
                              stdout=open(os.path.join(j.wdir, j.script_name + ".out"), "w"),
                              stderr=open(os.path.join(j.wdir, j.script_name + ".err"), "w"),
-                             universal_newlines=True)
+                             universal_newlines=True, start_new_session=True)
+        j.time_started = time.time()
         return p
     # start_job()
-    
+
+    def fits(self, j):
+        if not self.p_list: return True
+        if self.num_jobs is not None and len(self.p_list) >= self.num_jobs: return False
+        if self.max_cores is not None and sum([x[0].nproc for x in self.p_list]) + j.nproc > self.max_cores: return False
+        if self.max_mem_gb is not None and j.mem_gb is not None:
+            if sum([x[0].mem_gb or 0 for x in self.p_list]) + j.mem_gb > self.max_mem_gb: return False
+        return True
+    # fits()
+
+    def check_finished(self, j, p):
+        """returns True if finished. Wall time and peak RSS of the process (and its descendants) are recorded."""
+        try:
+            pid, status, rusage = os.wait4(p.pid, os.WNOHANG)
+        except ChildProcessError: # already collected
+            return p.poll() is not None
+        if pid == 0: return False
+
+        # os.waitstatus_to_exitcode() is only in python>=3.9
+        p.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+        j.returncode = p.returncode
+        j.wall_time = time.time() - j.time_started
+        j.peak_rss_mb = rusage.ru_maxrss / 1024. # KB on Linux
+        j.state = STATE_FAILED if j.cancelled else STATE_FINISHED
+        self.accounting.append((j.wdir, j.script_name, j.nproc, j.wall_time, j.peak_rss_mb, j.returncode))
+        self.finished_event.set()
+        return True
+    # check_finished()
+
+    def cancel(self, j):
+        """remove j if waiting, or kill if running. returns False if not found"""
+        with self.lock:
+            for i, x in enumerate(self.waiting_jobs):
+                if x[2] is j:
+                    self.waiting_jobs.pop(i)
+                    heapq.heapify(self.waiting_jobs)
+                    j.cancelled = True
+                    j.state = STATE_FAILED
+                    self.finished_event.set()
+                    return True
+
+            for x, p in self.p_list:
+                if x is j:
+                    j.cancelled = True
+                    try: os.killpg(p.pid, signal.SIGTERM)
+                    except OSError: pass
+                    return True
+        return False
+    # cancel()
+
     def run(self):
         while not self._stopevent.isSet():
-            # Change state if finished
-            for j, p in self.p_list:
-                if p.poll() is not None:
-                    j.state = STATE_FINISHED
-
-            # Keep unfinished jobs
-            self.p_list = [p for p in self.p_list if p[1].poll() is None]
+            # errors must not stop this thread, otherwise no local job finishes
+            try:
+                self.update()
+            except:
+                print("Error in local job thread:\n%s" % traceback.format_exc())
 
-            # Register new jobs
-            for i in range(self.num_jobs - len(self.p_list)):
-                # Start conversion
-                if len(self.waiting_jobs) > 0:
-                    j = self.waiting_jobs.pop(0)
-                    self.p_list.append( (j, self.start_job(j)) )
-                    j.state = STATE_RUNNING
-            
             time.sleep(0.1)
 
         if self._stopevent.isSet():
             for j, p in self.p_list:
-                p.kill()
+                try: os.killpg(p.pid, signal.SIGKILL)
+                except OSError: pass
                 j.state = STATE_FAILED
     # run()
 
+    def update(self):
+        """collect finished jobs and start waiting jobs"""
+        with self.lock:
+            # Keep unfinished jobs
+            p_list = []
+            for j, p in self.p_list:
+                try:
+                    if self.check_finished(j, p): continue
+                except:
+                    print("Error in checking job %s in %s:\n%s" % (j.script_name, j.wdir, traceback.format_exc()))
+                p_list.append((j, p))
+            self.p_list = p_list
+
+            # Register new jobs
+            skipped = []
+            try:
+                while self.waiting_jobs:
+                    x = heapq.heappop(self.waiting_jobs)
+                    if self.fits(x[2]):
+                        try:
+                            self.p_list.append( (x[2], self.start_job(x[2])) )
+                            x[2].state = STATE_RUNNING
+                        except:
+                            print("Failed to start job %s in %s:\n%s" % (x[2].script_name, x[2].wdir, traceback.format_exc()))
+                            x[2].state = STATE_FAILED
+                            self.finished_event.set()
+                    else:
+                        skipped.append(x)
+                        # stop backfilling if the first blocked job waits too long (avoid starvation)
+                        if len(skipped) == 1:
+                            if x[2].time_blocked is None: x[2].time_blocked = time.time()
+                            if time.time() - x[2].time_blocked > self.max_backfill_wait: break
+            finally:
+                for x in skipped: heapq.heappush(self.waiting_jobs, x)
+    # update()
+
     def join(self, timeout=None):
         self._stopevent.set()
         threading.Thread.join(self, timeout)
@@ -117,32 +303,44 @@ class LocalThread(threading.Thread):
  
 class ExecLocal(JobManager):
        
-    def __init__(self, max_parallel):
+    def __init__(self, max_parallel, max_cores=None, max_mem_gb=None):
         JobManager.__init__(self)
         self.num_jobs = max_parallel # referred by control tower when pickling
-        self._thread = LocalThread(num_jobs=self.num_jobs)
+        self._thread = LocalThread(num_jobs=self.num_jobs, max_cores=max_cores, max_mem_gb=max_mem_gb)
         self._thread.start()
         
     # __init__()
 
     def submit(self, j):
-        self._thread.waiting_jobs.append(j)
         j.state = STATE_SUBMITTED
+        self._thread.add_job(j)
     # submit()
     
     def update_state(self, j):
         # if running locally, state is changed during execution loop
         pass
-                                            
+
+    def wait_for_change(self, jobs, timeout):
+        self._thread.finished_event.wait(timeout)
+        self._thread.finished_event.clear()
+    # wait_for_change()
+
+    def cancel(self, j): return self._thread.cancel(j)
+
+    def accounting(self):
+        """list of (wdir, script_name, nproc, wall_time, peak_rss_mb, returncode) of finished jobs"""
+        return list(self._thread.accounting)
+    # accounting()
+
     def stop_all(self):
         self._thread.join()
 
 # class ExecLocal
         
 
-class SGE(JobManager):
+class SGE(QueueingSystem):
     def __init__(self, pe_name="par"):
-        JobManager.__init__(self)
+        QueueingSystem.__init__(self)
         self.pe_name = pe_name
 
         qsub_found, qstat_found = False, False
@@ -160,13 +358,12 @@ class SGE(JobManager):
                 self.qstat = self.Slurm.qstat
                 self.submit = self.Slurm.submit
                 self.update_state = self.Slurm.update_state
+                self.update_states = self.Slurm.update_states
                 self.qstat = self.Slurm.qstat
                 self.stop_all = self.Slurm.stop_all
                 self.qdel = self.Slurm.qdel
             else:
                 raise SgeError("cannot find qsub or qstat command under $PATH")
-                
-        self.job_id = {} # [Job: jobid]
     # __init__()
 
     def submit(self, j):
@@ -177,6 +374,7 @@ class SGE(JobManager):
         script_name = j.script_name
         wdir = j.wdir
 
+        j.clear_sentinel()
         if j.nproc > 1:
             cmd = "qsub -j y -pe %s %d %s" % (self.pe_name, j.nproc, script_name)
         else:
@@ -196,25 +394,22 @@ class SGE(JobManager):
         if job_id == "":
             raise SgeError("cannot read job-id from qsub result. please contact author. stdout is:\n" % stdout)
         
-        self.job_id[j] = job_id
+        self.register_job(j, job_id)
         print("Job %s on %s is started. id=%s"%(j.script_name, j.wdir, job_id))
 
     # submit()
 
-    def update_state(self, j):
-        # if job_id is unknown (waiting or finished), state won't be changed
-        if j in self.job_id:
-            status = self.qstat(self.job_id[j])
-
-            if status is None: # if qsub failed, flagged as FINISHED
-                j.state = STATE_FINISHED
-                self.job_id.pop(j)
-                #j.check_after_run() # j.state may be changed to FAILED
+    def finished_ids(self, job_ids):
+        # qstat lists all unfinished jobs
+        p = subprocess.Popen(["qstat", "-xml"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        stdout, stderr = p.communicate()
+        if p.returncode != 0:
+            print("qstat failed (returned %s): %s" % (p.returncode, stderr))
+            return None
 
-            else: # if qsub succeeded, RUNNING or WAITING.
-                j.state = STATE_RUNNING
-            
-    # update_state()
+        queued = set(re.findall(r"<JB_job_number>([0-9]+)</JB_job_number>", stdout))
+        return set(job_ids) - queued
+    # finished_ids()
 
     def qstat(self, job_id):
         cmd = "qstat -j %s" % job_id
@@ -262,9 +457,11 @@ class SGE(JobManager):
 
 # class SGE
 
-class Slurm(JobManager):
+slurm_end_states = ("COMPLETED", "FAILED", "CANCELLED", "TIMEOUT", "OUT_OF_MEMORY", "NODE_FAIL", "PREEMPTED", "BOOT_FAIL", "DEADLINE")
+
+class Slurm(QueueingSystem):
     def __init__(self, pe_name="default",mem_per_cpu="default"):
-        JobManager.__init__(self)
+        QueueingSystem.__init__(self)
         self.pe_name = pe_name
         self.mem_per_cpu = mem_per_cpu
         sbatch_found, squeue_found = False, False
@@ -277,8 +474,6 @@ class Slurm(JobManager):
 
         if not( sbatch_found and squeue_found ):
             raise SlurmError("cannot find sbatch or squeue command under $PATH")
-                
-        self.job_id = {} # [Job: jobid]
     # __init__()
 
     def submit(self, j):
@@ -295,6 +490,7 @@ class Slurm(JobManager):
         if self.mem_per_cpu != "default":
             memory = f"--mem-per-cpu={self.mem_per_cpu}"
         cmd = "sbatch %s %s -c %d %s" % (partition, memory, j.nproc, script_name)
+        j.clear_sentinel()
 
         p = subprocess.Popen(cmd, shell=True, cwd=wdir, 
                              stdout=subprocess.PIPE, universal_newlines=True)
@@ -310,28 +506,41 @@ class Slurm(JobManager):
         if job_id == "":
             raise SlurmError("cannot read job-id from sbatch result. please contact author. stdout is:\n" % stdout)
         
-        self.job_id[j] = job_id
+        self.register_job(j, job_id)
         print("Job %s on %s is started. id=%s"%(j.script_name, j.wdir, job_id))
-        self.submit_time = time.time()
         self.registered_job = False
 
 
     # submit()
 
-    def update_state(self, j):
-        # if job_id is unknown (waiting or finished), state won't be changed
-        if j in self.job_id:
-            status = self.qstat(self.job_id[j])
-
-            if status is None: # if sbatch failed, flagged as FINISHED?
-                j.state = STATE_FINISHED
-                self.job_id.pop(j)
-                #j.check_after_run() # j.state may be changed to FAILED
-
-            else: # if sbatch succeeded, RUNNING or WAITING.
-                j.state = STATE_RUNNING
-            
-    # update_state()
+    def finished_ids(self, job_ids):
+        if shutil.which("sacct"):
+            cmd = ["sacct", "-n", "-X", "-P", "--format=JobID,State", "-j", ",".join(job_ids)]
+            p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+            stdout, stderr = p.communicate()
+            if p.returncode != 0:
+                print("sacct failed (returned %s): %s" % (p.returncode, stderr))
+                return None
+
+            # jobs not yet in the database are regarded as running
+            ret = set()
+            for l in stdout.splitlines():
+                sp = l.split("|")
+                if len(sp) > 1 and sp[1].split() and sp[1].split()[0] in slurm_end_states: # e.g. "CANCELLED by 123"
+                    ret.add(sp[0])
+            return ret
+        else:
+            p = subprocess.Popen(["squeue", "-h", "-o", "%i", "-u", getpass.getuser()],
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+            stdout, stderr = p.communicate()
+            if p.returncode != 0:
+                print("squeue failed (returned %s): %s" % (p.returncode, stderr))
+                return None
+
+            # jobs are not displayed if squeue is run before the database is updated. wait 15 seconds.
+            queued = set(stdout.split())
+            return set([x for x in job_ids if x not in queued and time.time() - self.submit_time.get(x, 0) > 15])
+    # finished_ids()
 
     def qstat(self, job_id):
         # for the problem that jobs are not displayed if squeue before the database is updated.
@@ -349,7 +558,7 @@ class Slurm(JobManager):
             return "running"  # better to parse ST
         else:
             # Waiting period of 15 seconds on systems that do not support sacct
-            if self.submit_time and ((time.time() - self.submit_time) > 15):
+            if time.time() - self.submit_time.get(job_id, 0) > 15:
                 cmd = "squeue --job %s" % job_id
                 p = subprocess.Popen(cmd, shell=True,
                                      stdout=subprocess.PIPE, universal_newlines=True)
@@ -402,15 +611,29 @@ class Job(object):
     ##
     # This class will be overridden
     #
-    def __init__(self, wdir, script_name, nproc=1, copy_environ=True):
+    def __init__(self, wdir, script_name, nproc=1, copy_environ=True, mem_gb=None, priority=0):
         self.wdir = wdir
         self.state = STATE_WAITING
         self.script_name = script_name
         self.nproc = nproc
+        self.mem_gb = mem_gb # expected memory usage. used by ExecLocal
+        self.priority = priority # higher first. used by ExecLocal
+        self.cancelled = False
+        self.time_started, self.wall_time, self.peak_rss_mb, self.returncode = None, None, None, None # set by ExecLocal
+        self.time_blocked = None
         self.expects_out = []
         self.copy_environ = copy_environ
     # __init__()
 
+    def sentinel_file(self):
+        # written when the job script exits
+        return os.path.join(self.wdir, ".%s.exited" % self.script_name)
+    # sentinel_file()
+
+    def clear_sentinel(self):
+        if os.path.isfile(self.sentinel_file()): os.remove(self.sentinel_file())
+    # clear_sentinel()
+
     def write_script(self, script_text):
         env = ""
         re_allowed_env = re.compile(r"^[a-zA-Z_][a-zA-Z0-9_]*$")
@@ -431,7 +654,9 @@ class Job(object):
                 
             env += "\n"
 
-        script = job_header + env + script_text + job_footer 
+        trap = "trap 'touch \"%s\"' EXIT\n\n" % os.path.abspath(self.sentinel_file())
+        script = job_header + trap + env + script_text + job_footer 
+        self.clear_sentinel()
         
         open(os.path.join(self.wdir, self.script_name), "w").write(script)
         os.chmod(os.path.join(self.wdir, self.script_name) , stat.S_IXUSR + stat.S_IWUSR + stat.S_IRUSR + stat.S_IRGRP + stat.S_IROTH)
@@ -451,6 +676,8 @@ class AutoJobManager(JobManager):
         self.qstat = self.engine.qstat
         self.submit = self.engine.submit
         self.update_state = self.engine.update_state
+        self.update_states = self.engine.update_states
+        self.wait_for_change = self.engine.wait_for_change
         self.qstat = self.engine.qstat
         self.stop_all = self.engine.stop_all
         self.qdel = self.engine.qdel
@@ -0,0 +1,183 @@
+"""
+Numpy arrays in shared memory, to be passed between processes by name instead of pickled copies.
+
+SharedArrays holds several named arrays in one segment. descriptor() returns a small picklable
+object; other processes call SharedArrays.attach(descriptor) to get views of the same memory.
+multiprocessing.shared_memory is used if available (python>=3.8), otherwise a mmap'ed temporary file.
+
+(c) RIKEN 2026. All rights reserved.
+Author: Keitaro Yamashita
+
+This software is released under the new BSD License; see LICENSE.
+"""
+from __future__ import print_function
+from __future__ import division
+from __future__ import unicode_literals
+
+import os
+import secrets
+import tempfile
+import numpy
+
+try:
+    from multiprocessing import shared_memory
+    from multiprocessing import resource_tracker
+except ImportError:
+    shared_memory = None
+
+def _untrack(shm):
+    """
+    Memory is freed explicitly by unlink(). Without this, resource_tracker of a worker
+    process would free the memory when the worker exits, even if the main process still uses it.
+    """
+    try:
+        resource_tracker.unregister(shm._name, "shared_memory")
+    except Exception:
+        pass
+# _untrack()
+
+def _mmap_dir():
+    return "/dev/shm" if os.path.isdir("/dev/shm") else None
+# _mmap_dir()
+
+def new_prefix():
+    """
+    Unique name prefix for segments created by workers. Segments are not tracked
+    (see _untrack()), so the consumer should call unlink_all(prefix) in finally,
+    to free those still in flight when an error occurred.
+    """
+    return "yamtbx%d_%s" % (os.getpid(), secrets.token_hex(4))
+# new_prefix()
+
+def unlink_all(prefix):
+    """Free all segments created with prefix. Returns the number of freed segments."""
+    count = 0
+    dirs = set(["/dev/shm", _mmap_dir() or tempfile.gettempdir()])
+    for d in dirs:
+        if not os.path.isdir(d): continue
+        for f in os.listdir(d):
+            if not f.startswith(prefix+"_"): continue
+            try:
+                os.remove(os.path.join(d, f)) # POSIX shared memory is a file in /dev/shm on Linux
+                count += 1
+            except OSError:
+                pass
+    return count
+# unlink_all()
+
+_align = 64
+
+class SharedArrays(object):
+    def __init__(self, name, layout, buf, owner, shm=None, mmap_file=None):
+        # layout: list of (key, dtype str, shape, offset)
+        self.name = name
+        self.layout = layout
+        self.owner = owner
+        self._shm = shm
+        self._mmap_file = mmap_file
+        self._buf = buf
+        self.arrays = {}
+        for key, dtype, shape, offset in layout:
+            self.arrays[key] = numpy.ndarray(shape, dtype=numpy.dtype(dtype), buffer=buf, offset=offset)
+    # __init__()
+
+    @staticmethod
+    def make_layout(specs):
+        """specs: list of (key, dtype, shape). returns (layout, total_bytes)"""
+        layout = []
+        offset = 0
+        for key, dtype, shape in specs:
+            dtype = numpy.dtype(dtype)
+            shape = tuple(int(x) for x in shape)
+            layout.append((key, dtype.str, shape, offset))
+            nbytes = dtype.itemsize * int(numpy.prod(shape))
+            offset += -(-nbytes // _align) * _align
+        return layout, max(offset, 1)
+    # make_layout()
+
+    @classmethod
+    def create(cls, specs, use_shm=True, prefix=None):
+        """
+        Allocate new (uninitialized) arrays. specs: list of (key, dtype, shape).
+        The caller owns the memory and must call unlink() when no longer needed.
+        If prefix (from new_prefix()) is given, the segment can also be freed by unlink_all(prefix).
+        """
+        layout, nbytes = cls.make_layout(specs)
+        if use_shm and shared_memory is not None:
+            name = "%s_%s" % (prefix, secrets.token_hex(8)) if prefix else None
+            shm = shared_memory.SharedMemory(name=name, create=True, size=nbytes)
+            _untrack(shm)
+            return cls(shm.name, layout, shm.buf, True, shm=shm)
+        else:
+            fd, path = tempfile.mkstemp(prefix=(prefix+"_") if prefix else "yamtbx_shared_", dir=_mmap_dir())
+            os.close(fd)
+            mm = numpy.memmap(path, dtype=numpy.uint8, mode="w+", shape=(nbytes,))
+            return cls(path, layout, mm, True, mmap_file=path)
+    # create()
+
+    @classmethod
+    def from_arrays(cls, arrays, use_shm=True, prefix=None):
+        """arrays: list of (key, numpy array). data are copied into shared memory."""
+        arrays = [(k, numpy.ascontiguousarray(a)) for k, a in arrays]
+        ret = cls.create([(k, a.dtype, a.shape) for k, a in arrays], use_shm=use_shm, prefix=prefix)
+        for k, a in arrays: ret.arrays[k][...] = a
+        return ret
+    # from_arrays()
+
+    def descriptor(self):
+        return dict(name=self.name, layout=self.layout, mmap=self._mmap_file is not None)
+    # descriptor()
+
+    @classmethod
+    def attach(cls, descriptor):
+        if descriptor["mmap"]:
+            mm = numpy.memmap(descriptor["name"], dtype=numpy.uint8, mode="r+")
+            return cls(descriptor["name"], descriptor["layout"], mm, False, mmap_file=descriptor["name"])
+        else:
+            shm = shared_memory.SharedMemory(name=descriptor["name"])
+            _untrack(shm)
+            return cls(shm.name, descriptor["layout"], shm.buf, False, shm=shm)
+    # attach()
+
+    def __getitem__(self, key): return self.arrays[key]
+
+    def copy_arrays(self):
+        """returns dict of private copies (still valid after close())"""
+        return dict([(k, a.copy()) for k, a in self.arrays.items()])
+    # copy_arrays()
+
+    def close(self):
+        """release views of this process. arrays cannot be used after this."""
+        self.arrays = {}
+        self._buf = None
+        if self._shm is not None:
+            self._shm.close()
+    # close()
+
+    def unlink(self):
+        """free the memory. should be called once (by the owner or the last user)"""
+        self.close()
+        if self._shm is not None:
+            try: resource_tracker.register(self._shm._name, "shared_memory") # unlink() unregisters it
+            except Exception: pass
+            self._shm.unlink()
+        elif self._mmap_file is not None and os.path.exists(self._mmap_file):
+            os.remove(self._mmap_file)
+    # unlink()
+# class SharedArrays
+
+def miller_array_as_numpy(array):
+    """returns (indices, data, sigmas) of cctbx miller.array as numpy arrays"""
+    indices = array.indices().as_vec3_double().as_numpy_array().astype(numpy.int32)
+    sigmas = array.sigmas().as_numpy_array() if array.sigmas() is not None else None
+    return indices, array.data().as_numpy_array(), sigmas
+# miller_array_as_numpy()
+
+def numpy_as_flex(indices, data, sigmas=None):
+    """inverse of miller_array_as_numpy(). returns (flex.miller_index, flex.double, flex.double or None)"""
+    from cctbx.array_family import flex
+    ret_sigmas = flex.double(numpy.ascontiguousarray(sigmas, dtype=numpy.float64)) if sigmas is not None else None
+    return (flex.miller_index(numpy.asarray(indices).tolist()),
+            flex.double(numpy.ascontiguousarray(data, dtype=numpy.float64)),
+            ret_sigmas)
+# numpy_as_flex()